@@ -33,10 +33,19 @@ import pandas as pd
 import dicom
 import numpy as np
 from datetime import datetime, timedelta
-from multiprocessing import Pool
+from functools import partial
 import sys
 from dicom.filereader import InvalidDicomError
 from optparse import OptionParser
+from dcmheader import read_dicom_header
+from dcmpipeline import walk_directories, stream_directories, DicomSniffer, make_pool, BACKENDS
+from dcmindex import ScanIndex, to_text
+from dcmsort import isFolderSorted
+from dcmoutput import DatabaseWriter
+from dcmstats import RunStats
+from dcmcatalog import FileCatalog
+from dcmrecord import Record
+from dcmqueue import WorkQueue, shard_tree, walk_unit, run_worker, relative_path, local_path
 
 # fields should correspond to dcmfields (except the last two "nimgs" and "dir")
 # ie, pxname = PatientName; pxid = PatientID. The locations make a difference for where the columns will be located
@@ -46,8 +55,14 @@ dcmfields = ['PatientName','PatientID','StudyDate','AcquisitionTime','StudyInsta
 
 # These are the indices to check whether you have the same series or not.
 inds = [0,1,2,4,5,6]
+
+# The row for a file (or a series). The numbers are kept as floats, everything else as text.
+class SeriesRow(Record):
+    __slots__ = fields + ['nimgs', 'dir', 'sopuid']
+    TEXT = frozenset(['pxname','pxid','datestr','acqtstr','studyuid','seriesuid','mrseq','manu','sopuid'])
+    NUMERIC = frozenset(['fa','tr','te','ti'])
 			 
-def get_db_dicominfo(filename):
+def get_db_dicominfo(filename, force=False, catalog=False):
     
     cnt = 0;
 
@@ -64,11 +79,23 @@ def get_db_dicominfo(filename):
     cnt += 1;
 
     # Error catching in case the file is not a valid dicom.
+    # Only the header is read; parsing stops after the last of the "dcmfields".
     try:
-        dcminf = dicom.read_file(filename)
+        dcminf = read_dicom_header(filename, dcmfields, force=force)
     except:
         return []
 
+    row = dicominfo_from_header(dcminf)
+
+    # The SOPInstanceUID comes before the last of the "dcmfields", so it has already been read
+    if catalog:
+        row['sopuid'] = getattr(dcminf, 'SOPInstanceUID', None)
+
+    return row
+
+# The database row for a header that has already been read
+def dicominfo_from_header(dcminf):
+
     dcmvals = []
     # If dicominfo exists, append all selected "dcmfields" into the list.
     if dcminf:
@@ -95,13 +122,166 @@ def get_db_dicominfo(filename):
     # if bIsDcmValUnique & (dcmvals[3] != '000000'):
     #     dcm_inf_holder.append(dcmvals)
 
-    # Return a dictionary
-    return dict(zip(fields,dcmvals))
+    # Return a row (used like a dictionary)
+    return SeriesRow(*dcmvals)
+
+def open_index(filename):
+
+    # Index with one column for each of the "fields"
+    return ScanIndex(filename, fields)
+
+def index_walker(base, index, pending, stats=None, keep=None, **kwargs):
+
+    # Only the files that are new or have changed since the last scan are sent to the pool.
+    # The rows for unchanged files (and the files that need to be read) are kept in "pending"
+    # until the directory comes back from the pool. kwargs are passed on to walk_directories.
+    # "keep" (ie, a DicomSniffer) is only given the stale files, so an unchanged file is never
+    # opened. The files it drops are kept in the index as non-dicoms. Files are compared with
+    # the index by the stat that comes with the folder listing, where there is one.
+    file_stats = {}
+    for dirname, fullfilenames in walk_directories([base], file_stats=file_stats, **kwargs):
+        rows, stale = index.scan_directory(dirname, fullfilenames, file_stats)
+        rejected = []
+        if keep is not None:
+            kept = []
+            for item in stale:
+                (kept if keep(item[0]) else rejected).append(item)
+            stale = kept
+        pending[dirname] = (rows, stale, rejected)
+        if stats is not None:
+            stats.add('skipped', len(fullfilenames) - len(stale) - len(rejected))
+        yield dirname, [filename for filename, stat in stale]
+
+# Files of a folder that are read by one pool task when sampling, so a large folder is spread
+# over every worker
+SAMPLE_FILES = 256
+
+# For a group of files from one directory. Returns one row per series (the row of its first file),
+# with the number of images ("nimgs"). Every file is read, so a file of another series is found
+# even in a folder sorted by dcmsort.py (IMAGE.SSSS.IIII), where it can't be told apart by its name.
+# The header is only read up to the last of the "dcmfields", which is as far as the series is.
+def sample_directory(fullfilenames, force=False):
+
+    series = {}
+    rows = []
+    for filename in fullfilenames:
+        row = get_db_dicominfo(filename, force)
+        if not row:
+            continue
+        first = series.get(row['seriesuid'])
+        if first is None:
+            row['nimgs'] = 1
+            series[row['seriesuid']] = row
+            rows.append(row)
+        else:
+            first['nimgs'] += 1
+
+    return rows
+
+def sample_groups(fullfilenames):
+
+    # Splits the files of a directory into groups of SAMPLE_FILES. A sorted folder is split in
+    # order of name, so the row of each series is from its first image.
+    if isFolderSorted([os.path.basename(filename) for filename in fullfilenames]):
+        fullfilenames = sorted(fullfilenames, key=os.path.basename)
+    return [fullfilenames[ind:ind + SAMPLE_FILES] for ind in range(0, len(fullfilenames), SAMPLE_FILES)]
+
+def merge_series(rows):
+
+    # The rows of the groups of a directory, with the rows of a series that was split between
+    # groups added together (the first row is kept)
+    series = {}
+    out = []
+    for row in rows:
+        first = series.get(row['seriesuid'])
+        if first is None:
+            series[row['seriesuid']] = row
+            out.append(row)
+        else:
+            first['nimgs'] += row['nimgs']
+    return out
 
 def remove_same_series(dcm_inf_holder):
 
-    # Since there can be different series within a folder, this ensures that all series are captured. 
-    return [dict(y) for y in set(tuple(x.items()) for x in dcm_inf_holder)]
+    # Since there can be different series within a folder, this ensures that all series are captured.
+    # Rows with the same values are kept once, in the order they first show up.
+    seen = set()
+    out = []
+    for row in dcm_inf_holder:
+        key = tuple(row.get(field) for field in fields) + (row.get('nimgs'),)
+        if key not in seen:
+            seen.add(key)
+            out.append(row)
+    return out
+
+def catalog_directories(p, walker, stats, sample=False, force=False, index=None, pending=None, add_files=None):
+
+    # Yields (dirname, rows) for every directory from the walker, once all of its files have been
+    # read. With an index, "pending" holds what index_walker kept for each directory.
+    # "add_files" is an optional function of (dirname, records) that is given a record for every
+    # dicom in the directory (see FileCatalog.update_directory).
+
+    # The file of every row is needed for the records, so the filenames of each directory are
+    # kept until it comes back
+    filenames = {}
+    if add_files is not None:
+        def named(walker):
+            for dirname, fullfilenames in walker:
+                filenames[dirname] = fullfilenames
+                yield dirname, fullfilenames
+        walker = named(walker)
+
+    # When sampling, each directory is sent to the pool in groups of files (each counted as one file)
+    walker = stats.walk(walker)
+    if sample:
+        walker = ((dirname, sample_groups(fullfilenames)) for dirname, fullfilenames in walker)
+        stream = stream_directories(p, stats.timed(partial(sample_directory, force=force)), walker, chunksize=1)
+    else:
+        stream = stream_directories(p, stats.timed(partial(get_db_dicominfo, force=force, catalog=add_files is not None)), walker)
+
+    # Files from every subdirectory are read by the pool as they are found. A directory
+    # comes back (as "dirname") once all of its files have been read.
+    for dirname, test, nfailed in stats.stream(stream):
+
+        test = stats.directory(dirname, test, nfailed)
+
+        if add_files is not None:
+            records = []
+            for filename, row in zip(filenames.pop(dirname), test):
+                if row:
+                    records.append([filename, row['pxid'], row['studyuid'], row['seriesuid'], row.pop('sopuid')])
+            add_files(dirname, records)
+
+        if index is not None:
+            rows, stale, rejected = pending.pop(dirname)
+            test = index.update_directory(dirname, stale + rejected, test + [[]] * len(rejected)) + rows
+
+        if sample:
+            test = merge_series(sum(filter(None,test), []))
+
+        test = filter(None,test)
+        print dirname
+        print len(test)
+        test = remove_same_series(test)
+        print "SAME SERIES REMOVED: ", len(test)
+
+        for row in test:
+            row['dir'] = dirname
+
+        yield dirname, test
+
+# Rows sent back through a queue (see dcmqueue.py) only hold plain values, the same as the rows
+# taken from an index. The folder is relative to the base.
+def row_to_json(row, base):
+
+    out = {}
+    for key, value in row.items():
+        if value is None or isinstance(value, (int, long)):
+            out[key] = value
+        else:
+            out[key] = to_text(value)
+    out['dir'] = relative_path(base, row['dir'])
+    return out
 
 
 
@@ -120,7 +300,7 @@ def main():
                       type="string",
                       dest="filename",
                       default='MR_Database.csv',
-                      help="Name of output csvfile")
+                      help="Name of output file (.csv, .parquet or .db)")
     parser.add_option("-d", "--dir",
                       action="store", # optional because action defaults to "store"
                       type="string",
@@ -136,45 +316,228 @@ def main():
                       dest="nullfolder",
                       default=False,
                       help="Choose whether to store folder with no dicoms")
+    parser.add_option("-i", "--index",
+                      action="store",
+                      type="string",
+                      dest="index",
+                      default='',
+                      help="Index file to keep between runs. Only new or changed files are read")
+    parser.add_option("-c", "--catalog",
+                      action="store",
+                      type="string",
+                      dest="catalog",
+                      default='',
+                      help="Catalog file to keep a record of every dicom in (path and UIDs), to look up with dcmquery.py")
+    parser.add_option("-s", "--sample",
+                      action="store_true",
+                      dest="sample",
+                      default=False,
+                      help="One row per series, with the number of images in the series")
+    parser.add_option("--stats",
+                      action="store",
+                      type="string",
+                      dest="stats",
+                      default='',
+                      help="File to write run statistics to (one JSON line per folder and a summary)")
+    parser.add_option("--progress",
+                      action="store_true",
+                      dest="progress",
+                      default=False,
+                      help="Show a progress line while running")
+    parser.add_option("--lenient",
+                      action="store_true",
+                      dest="lenient",
+                      default=False,
+                      help="Also read files without the 128 byte preamble if they look like a dicom")
+    parser.add_option("-a", "--archives",
+                      action="store_true",
+                      dest="archives",
+                      default=False,
+                      help="Also read the dicoms inside zip and tar files (without extracting them)")
+    parser.add_option("-b", "--backend",
+                      action="store",
+                      type="choice",
+                      choices=BACKENDS,
+                      dest="backend",
+                      default='process',
+                      help="Workers to use: process, thread (for network shares) or hybrid")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=0,
+                      help="Number of workers. Default is to choose from the cores and the speed of the tree")
+    parser.add_option("--walk-threads",
+                      action="store",
+                      type="int",
+                      dest="walk_threads",
+                      default=0,
+                      help="Number of threads listing folders at once (for slow network shares). Default is one")
+    parser.add_option("--depth",
+                      action="store",
+                      type="int",
+                      dest="depth",
+                      default=None,
+                      help="Only walk this many levels of folders below the directory (0 is just the directory)")
+    parser.add_option("--include",
+                      action="append",
+                      type="string",
+                      dest="include",
+                      default=[],
+                      help="Only read files that match this pattern (ie, \"*.dcm\"). Can be given more than once")
+    parser.add_option("--exclude",
+                      action="append",
+                      type="string",
+                      dest="exclude",
+                      default=[],
+                      help="Leave out files and folders that match this pattern. Can be given more than once")
+    parser.add_option("--coordinator",
+                      action="store",
+                      type="string",
+                      dest="coordinator",
+                      default='',
+                      help="Queue folder to publish the tree to. Workers on any machine do the reading, and the rows are written here")
+    parser.add_option("--worker",
+                      action="store",
+                      type="string",
+                      dest="worker",
+                      default='',
+                      help="Queue folder to take work from (made by a coordinator), until the queue is finished")
+    parser.add_option("--unit-files",
+                      action="store",
+                      type="int",
+                      dest="unit_files",
+                      default=0,
+                      help="Files per unit of work for the coordinator. Default is one unit per top level folder")
 
     (options, args) = parser.parse_args()
+
+    if options.sample and options.index:
+        parser.error("--sample can't be used with --index")
+    if options.index and (options.coordinator or options.worker):
+        parser.error("--index can't be used with --coordinator or --worker")
+    if options.depth is not None and (options.coordinator or options.worker):
+        parser.error("--depth can't be used with --coordinator or --worker")
+    if options.catalog and (options.sample or options.index or options.coordinator or options.worker):
+        parser.error("--catalog needs every file to be read, so it can't be used with --sample, --index or a queue")
+
+    # How the tree is walked, for every walk of the run
+    walk = dict(depth=options.depth, include=options.include, exclude=options.exclude, threads=options.walk_threads)
     
     # base is the base directory to search in and get ALL subfolders
     base = options.directory
 
-    # csvname is the output filename
-    csvname = options.filename
+    # Queues are only shared by runs that make the same rows
+    key = 'create_mr_db sample' if options.sample else 'create_mr_db'
+
+    stats = RunStats('create_mr_db', options.stats, options.progress)
+
+    # The coordinator doesn't read any files, it only writes the rows the workers send back
+    if options.coordinator:
+        try:
+            queue = WorkQueue(options.coordinator, key, shard_tree(base, options.unit_files, options.exclude))
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+        print "UNITS: ", queue.nunits
+
+        writer = DatabaseWriter(os.path.join(options.output, options.filename), fields, export)
+        nrejected = 0
+        for unit, result in queue.results():
+            rows = result['rows']
+            for row in rows:
+                row['dir'] = local_path(base, row['dir'])
+            with stats.stage('write'):
+                writer.append(rows)
+            stats.merge(result['counts'], result['ndirs'])
+            nrejected += result['nondicom']
+
+        with stats.stage('write'):
+            writer.close()
 
-    p = Pool(10)
+        for unit in queue.failed_units():
+            print "UNIT FAILED: ", unit['dirs'], unit['errors'][-1]
+
+        print "NON-DICOM FILES SKIPPED: ", nrejected
+
+        stats.close()
+        return
+
+    p, workers = make_pool(options.backend, [base], options.workers)
+    print "WORKERS: ", options.backend, "(%s)" % workers
 
     cnt = 0
 
-    # os.walk goes through every subdirectory as a loop. The current directory
-    # in the loop is "dirname". All files in dirname are in a list, "filenames"
-    for dirname, dirnames, filenames in os.walk(base):
+    stats.info.update(backend=options.backend, workers=workers)
 
-        df = pd.DataFrame(data = None, columns = fields)        
+    # Files that are clearly not dicoms are dropped by the walker. Files without a preamble
+    # are only let through when lenient, and then have to be forced.
+    sniffer = DicomSniffer(options.lenient, stats)
 
-        fullfilenames = [os.path.join(dirname,filename) for filename in filenames]
-        test = p.map(get_db_dicominfo,fullfilenames)
-        test = filter(None,test)
-        print dirname
-        print len(test)
-        test = remove_same_series(test)
-        print "SAME SERIES REMOVED: ", len(test)
+    # A worker sends the rows of every unit back to the coordinator
+    if options.worker:
+        try:
+            queue = WorkQueue(options.worker, key)
+        except ValueError as e:
+            parser.error(str(e))
 
-        # # Should have an option to append all empty folders without dicoms to the dataframe or not.
-        # df = pd.DataFrame(data = info, columns = fields)
-        # cnt+=1
+        def catalog_unit(unit):
+            counts = dict(stats.counts)
+            ndirs = stats.ndirs
+            nrejected = sniffer.nrejected
+            walker = walk_unit(base, unit, keep=sniffer, archives=options.archives, **walk)
+            rows = []
+            for dirname, test in catalog_directories(p, walker, stats, options.sample, options.lenient):
+                rows.extend(row_to_json(row, base) for row in test)
+            return {'rows': rows, 'nondicom': sniffer.nrejected - nrejected, 'ndirs': stats.ndirs - ndirs,
+                    'counts': dict((counter, stats.counts[counter] - counts[counter]) for counter in counts)}
 
-        # # Failsafe in case the date or acquisition time doesn't exist. For some reason, this is actually a thing.
-        # df['date'] = df['datestr'].apply(lambda s: '1900-00-00' if not s else datetime(year=int(s[0:4]), month=int(s[4:6]), day=int(s[6:8])))
-        # df['acqt'] = df['acqtstr'].apply(lambda s: '00:00:00' if not s else str(s[:2]+':'+s[2:4]+':'+s[4:6]))
+        ncompleted = run_worker(queue, catalog_unit)
+        print "UNITS COMPLETED: ", ncompleted
+        print "NON-DICOM FILES SKIPPED: ", sniffer.nrejected
 
-        # # Outputs are always appended to the csvfile. Nothing is ever overwritten.
-        # with open(options.output + '/' + csvname, 'a') as f:
-        #     df[export].to_csv(f,sep=',',header=False)
-            
+        stats.close()
+        return
+
+    # csvname is the output filename. Rows are written out in batches as the folders come in.
+    csvname = options.filename
+    writer = DatabaseWriter(os.path.join(options.output, csvname), fields, export)
+
+    # If there is an index, files that haven't changed since the last run are not read again
+    index = None
+    pending = {}
+    if options.index:
+        index = open_index(options.index)
+        walker = index_walker(base, index, pending, stats, keep=sniffer, archives=options.archives, **walk)
+    else:
+        walker = walk_directories([base], keep=sniffer, archives=options.archives, **walk)
+
+    # Every file read is also written to the catalog, if there is one
+    catalog = None
+    add_files = None
+    if options.catalog:
+        catalog = FileCatalog(options.catalog)
+        add_files = catalog.update_directory
+
+    for dirname, test in catalog_directories(p, walker, stats, options.sample, options.lenient, index, pending, add_files):
+
+        # The date and acquisition time columns are added when each batch is written
+        with stats.stage('write'):
+            writer.append(test)
+
+    with stats.stage('write'):
+        writer.close()
+
+    if index is not None:
+        index.finish(base)
+        index.close()
+
+    if catalog is not None:
+        catalog.finish(base)
+        catalog.close()
+
+    print "NON-DICOM FILES SKIPPED: ", sniffer.nrejected
+
+    stats.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
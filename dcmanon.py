@@ -21,11 +21,19 @@
 import re
 import os
 import dicom
-import numpy as np
 import sys
 from dicom.filereader import InvalidDicomError
 from optparse import OptionParser
-from multiprocessing import Pool
+from functools import partial
+from dcmheader import read_dicom_header
+from dcmpatch import get_raw_elements, patch_dicom_file, temp_name, recover_temp_file, _replace_file
+from dcmpipeline import walk_directories, walk_file_list, stream_directories, DicomSniffer, make_pool, BACKENDS
+from dcmstats import RunStats
+from dcmjournal import Journal
+from dcmmanifest import ManifestWriter, read_with_checksum, dataset_checksum
+from dcmcatalog import read_file_list
+from dcmdeid import load_profile, hash_value, UidMap
+from dcmqueue import WorkQueue, shard_tree, walk_unit, run_worker, relative_path, local_path
 
 def create_ascii_encrypt_key():
     pi = '314159265358979323846264338327\
@@ -39,17 +47,15 @@ def create_ascii_encrypt_key():
 527120190914564856692346034861\
 045432664821339360726024914127'
     
-    seq = np.arange(32,128)
-    randomizer = np.empty(0)
+    seq = range(32,128)
+    randomizer = []
 
-    while (seq.size != 0) & (len(pi) > 1):
-        if int(pi[:2]) < seq.size:
-            randomizer = np.append(randomizer,seq[int(pi[:2])])
-            seq = np.delete(seq,int(pi[:2]))
+    while seq and (len(pi) > 1):
+        if int(pi[:2]) < len(seq):
+            randomizer.append(seq.pop(int(pi[:2])))
             pi = pi[2:]
-        elif int(pi[:1]) < seq.size:
-            randomizer = np.append(randomizer,seq[int(pi[:1])])
-            seq = np.delete(seq,int(pi[:1]))
+        elif int(pi[:1]) < len(seq):
+            randomizer.append(seq.pop(int(pi[:1])))
             pi = pi[1:]
         else:
             # Skip number
@@ -57,12 +63,37 @@ def create_ascii_encrypt_key():
 
     return randomizer
 
+def create_translation_tables(randomizer):
+
+    # Translation tables for str.translate, one entry for each of the 256 byte values.
+    # Characters 32-127 are substituted using the key. Characters below 32 wrap around to the
+    # end of the key (same as the original negative index lookup). Anything above 127 is left
+    # alone, which is also what makes it safe to use as a separator in the batch functions.
+    unencrypt = [0] * len(randomizer)
+    for ind, val in enumerate(randomizer):
+        unencrypt[val - 32] = ind + 32
+
+    encrypt_table = ''
+    unencrypt_table = ''
+    for val in xrange(256):
+        if val < 128:
+            encrypt_table += chr(randomizer[(val - 32) % len(randomizer)])
+            unencrypt_table += chr(unencrypt[(val - 32) % len(unencrypt)])
+        else:
+            encrypt_table += chr(val)
+            unencrypt_table += chr(val)
+
+    return encrypt_table, unencrypt_table
+
 # Global variables
+# The tables are built once at import, so each pool worker gets them when it starts
 KEY = create_ascii_encrypt_key();
+ENCRYPT_TABLE, UNENCRYPT_TABLE = create_translation_tables(KEY)
+BATCH_SEPARATOR = '\xff'
 fields_to_anon = ['PatientsName','MedicalAlerts','PatientsAddress','SpecialNeeds']
 
 # For a single dicom file.
-def encrypt_dicom_name(dcm):
+def encrypt_dicom_name(dcm, force=False, checksum=False):
 
     # ( dicomname, (bool_encrypt, bool_digitcheck))
     dcmname = dcm[0]
@@ -70,15 +101,35 @@ def encrypt_dicom_name(dcm):
     bool_encrypt = opts[0]
     bool_digitcheck = opts[1]
 
-    bool_write = False
-
-    
+    # Only read the header to check the fields. The full file is only read if the new values
+    # can't be patched into the file directly.
+    # With checksum, the whole file is read so the pixel data can be hashed (see dcmmanifest.py)
     try:
-        dcminf = dicom.read_file(dcmname)
+        if checksum:
+            dcminf, size, digest = read_with_checksum(dcmname, force=force)
+        else:
+            dcminf = read_dicom_header(dcmname, fields_to_anon, force=force)
     except:
         # If not readable, simply exit
         return
 
+    # Where each field is in the file, so the new values can be patched in
+    raw_elements = get_raw_elements(dcminf, fields_to_anon)
+
+    anon_fields = get_anon_fields(dcminf, bool_encrypt, bool_digitcheck)
+    write_anon_fields(dcmname, dcminf, raw_elements, anon_fields, force)
+
+    # True if the file was changed, False if there was nothing to change (None if not a dicom).
+    # With checksum, also the size of the new file and the checksum.
+    if checksum:
+        return bool(anon_fields), os.path.getsize(dcmname), digest
+    return bool(anon_fields)
+
+# Returns the new values for each field that needs to change
+def get_anon_fields(dcminf, bool_encrypt, bool_digitcheck):
+
+    anon_fields = {}
+
     # If it is a dicom, scramble all information.
     for field in fields_to_anon:
 
@@ -110,39 +161,100 @@ def encrypt_dicom_name(dcm):
                 # has any numbers, the patient field has already been anonymized.
                 if (name[-4:] != "_JNO") & (not bool_hasdigits):
 
-                    anon_name = encrypt_string(name,KEY) + "_JNO"
-                    setattr(dcminf,field,anon_name)
-                    bool_write = True
+                    anon_fields[field] = encrypt_string(name) + "_JNO"
 
             else:
 
                 # If the name has "_JNO" as the ending, it has been encrypted
                 # and needs to be unencrypted.
                 if name[-4:] == "_JNO":
-                    anon_name = unencrypt_string(name[:-4],KEY)
-                    setattr(dcminf,field,anon_name)
-                    bool_write = True
+                    anon_fields[field] = unencrypt_string(name[:-4])
+
+    return anon_fields
 
-    if bool_write:
+def write_anon_fields(dcmname, dcminf, raw_elements, anon_fields, force=False):
+
+    # Only the changed values are written to the file. If that can't be done safely, the
+    # whole file is re-written.
+    if anon_fields and not patch_dicom_file(dcmname, dcminf, raw_elements, anon_fields):
+        dcminf = dicom.read_file(dcmname, force=force)
+        for field in anon_fields:
+            setattr(dcminf,field,anon_fields[field])
         dicom.write_file(dcmname,dcminf)
 
 
-def encrypt_string(string,randomizer):
-    encryptd_string = ''
+# For a single dicom file, with a de-identification profile instead of the fields above (see dcmdeid.py).
+# Returns the same as encrypt_dicom_name, and the old -> new UIDs of the file.
+def deidentify_dicom(dcm, profile, salt='', force=False, checksum=False):
+
+    dcmname = dcm[0]
+
+    # Files that this profile has already been applied to are left alone, without reading the rest
+    # of them. Files that were de-identified some other way (ie, by the scanner) still get the
+    # profile, so their UIDs are mapped the same as the rest of the study.
+    profile = load_profile(profile)
+    try:
+        dcminf = read_dicom_header(dcmname, ['DeidentificationMethod'], force=force)
+    except:
+        return
+
+    uids = {}
+    changed = False
+    if profile.method is None or dcminf.get('DeidentificationMethod') != profile.method:
+        try:
+            dcminf = dicom.read_file(dcmname, force=force)
+        except:
+            return
+        changed = bool(profile.apply(dcminf, salt, uids))
+        if changed:
+            # Written next to the file and renamed over it, so other hard links to the file (ie, a
+            # linked dcmsort.py output or dcmdedup.py --link) keep the original, and a run that is
+            # stopped never leaves half a file
+            tmpname = temp_name(dcmname)
+            dicom.write_file(tmpname, dcminf)
+            _replace_file(tmpname, dcmname)
+
+    if checksum:
+        # A file that was written is hashed from the dataset, instead of being read a third time
+        if changed:
+            return (changed, os.path.getsize(dcmname), dataset_checksum(dcminf)), uids
+        dcminf, size, digest = read_with_checksum(dcmname, force=force)
+        return (changed, size, digest), uids
+    return changed, uids
+
+def encrypt_string(string,table=ENCRYPT_TABLE):
+    return string.translate(table)
+
+def unencrypt_string(string,table=UNENCRYPT_TABLE):
+    return string.translate(table)
+
+# Encrypt/unencrypt a list of (ascii) strings with a single translate call
+def encrypt_strings(strings,table=ENCRYPT_TABLE):
+    return BATCH_SEPARATOR.join(strings).translate(table).split(BATCH_SEPARATOR)
+
+def unencrypt_strings(strings,table=UNENCRYPT_TABLE):
+    return BATCH_SEPARATOR.join(strings).translate(table).split(BATCH_SEPARATOR)
+
+# Goes through every subdirectory of every base directory and appends the dicom options
+# to each file
+def anon_walker(directories_to_anonymize, opt_tuple, options, keep=None, done=None, walk=None):
 
-    for char in string:
-        encryptd_string += chr(int(randomizer[int(ord(char)-32)]))
+    # base is the base directory to search in and get ALL subfolders
+    for base in directories_to_anonymize:
 
-    return encryptd_string
+        print "Current main directory:", base
 
-def unencrypt_string(string,randomizer):
-    unencrypt = np.argsort(KEY) + 32
-    unencryptd_string = ''
-    for char in string:
-        unencryptd_string += chr(int(unencrypt[int(ord(char)-32)]))
-        
-    return unencryptd_string
-    
+        if options.verbose:
+            if options.anon:
+                print "Encrypting the following folders..."
+            else:
+                print "Decrypting the following folders..."
+
+        for dirname, fullfilenames in walk_directories([base], keep=keep, done=done, **(walk or {})):
+            if options.verbose:
+                print dirname
+
+            yield dirname, [ [fullfilename,opt_tuple] for fullfilename in fullfilenames]
 
 def main():
 
@@ -161,6 +273,12 @@ def main():
                       dest="filename",
                       default="",
                       help="Directory file to search through")    
+    parser.add_option("--files",
+                      action="store",
+                      type="string",
+                      dest="files",
+                      default="",
+                      help="File list to anonymize (ie, written by dcmquery.py) instead of a directory")
     parser.add_option("-v", "--verbose",
                       action="store_true", # optional because action defaults to "store"
                       dest="verbose", # Do you want the script to show ALL directories it's going through?
@@ -175,12 +293,146 @@ def main():
                       dest="numbers",          # flag to encrypt names
                       default=False,
                       help="Check for numbers (0-9) in the field. If numbers exist in field, do not encrypt")
+    parser.add_option("-p", "--profile",
+                      action="store",
+                      type="string",
+                      dest="profile",
+                      default='',
+                      help="De-identification profile to apply instead of encrypting the names (ie, deid_basic.txt)")
+    parser.add_option("--salt",
+                      action="store",
+                      type="string",
+                      dest="salt",
+                      default='',
+                      help="Secret for the hashes of the profile (needed if it hashes anything). The same salt gives the same UIDs and names in every run")
+    parser.add_option("--uid-map",
+                      action="store",
+                      type="string",
+                      dest="uid_map",
+                      default='',
+                      help="File to add the old and new UIDs of the profile to (old,new on every line)")
+    parser.add_option("--stats",
+                      action="store",
+                      type="string",
+                      dest="stats",
+                      default='',
+                      help="File to write run statistics to (one JSON line per folder and a summary)")
+    parser.add_option("--progress",
+                      action="store_true",
+                      dest="progress",
+                      default=False,
+                      help="Show a progress line while running")
+    parser.add_option("--lenient",
+                      action="store_true",
+                      dest="lenient",
+                      default=False,
+                      help="Also read files without the 128 byte preamble if they look like a dicom")
+    parser.add_option("-b", "--backend",
+                      action="store",
+                      type="choice",
+                      choices=BACKENDS,
+                      dest="backend",
+                      default='process',
+                      help="Workers to use: process, thread (for network shares) or hybrid")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=0,
+                      help="Number of workers. Default is to choose from the cores and the speed of the tree")
+    parser.add_option("--walk-threads",
+                      action="store",
+                      type="int",
+                      dest="walk_threads",
+                      default=0,
+                      help="Number of threads listing folders at once (for slow network shares). Default is one")
+    parser.add_option("--depth",
+                      action="store",
+                      type="int",
+                      dest="depth",
+                      default=None,
+                      help="Only walk this many levels of folders below the directory (0 is just the directory)")
+    parser.add_option("--include",
+                      action="append",
+                      type="string",
+                      dest="include",
+                      default=[],
+                      help="Only read files that match this pattern (ie, \"*.dcm\"). Can be given more than once")
+    parser.add_option("--exclude",
+                      action="append",
+                      type="string",
+                      dest="exclude",
+                      default=[],
+                      help="Leave out files and folders that match this pattern. Can be given more than once")
+    parser.add_option("-j", "--journal",
+                      action="store",
+                      type="string",
+                      dest="journal",
+                      default='',
+                      help="Journal file. A run with the same journal skips the folders that were finished")
+    parser.add_option("--manifest",
+                      action="store",
+                      type="string",
+                      dest="manifest",
+                      default='',
+                      help="File to add the size and pixel data checksum of every anonymized file to (see dcmverify.py)")
+    parser.add_option("--coordinator",
+                      action="store",
+                      type="string",
+                      dest="coordinator",
+                      default='',
+                      help="Queue folder to publish the directory to. Workers on any machine anonymize it")
+    parser.add_option("--worker",
+                      action="store",
+                      type="string",
+                      dest="worker",
+                      default='',
+                      help="Queue folder to take work from (made by a coordinator), until the queue is finished")
+    parser.add_option("--unit-files",
+                      action="store",
+                      type="int",
+                      dest="unit_files",
+                      default=0,
+                      help="Files per unit of work for the coordinator. Default is one unit per top level folder")
 
     (options, args) = parser.parse_args()
+
+    if (options.coordinator or options.worker) and (options.filename or options.journal):
+        parser.error("--coordinator and --worker only work on a single directory (-d), without a journal")
+    if options.manifest and (options.coordinator or options.worker):
+        parser.error("--manifest can't be used with --coordinator or --worker")
+    if options.depth is not None and (options.coordinator or options.worker):
+        parser.error("--depth can't be used with --coordinator or --worker")
+    if options.files and (options.filename or options.coordinator or options.worker):
+        parser.error("--files can't be used with -f or a queue")
+    if options.profile and (not options.anon or options.numbers):
+        parser.error("--profile can't be used with -u or -n")
+    if (options.salt or options.uid_map) and not options.profile:
+        parser.error("--salt and --uid-map need a profile (-p)")
+    if options.uid_map and (options.coordinator or options.worker):
+        parser.error("--uid-map can't be used with --coordinator or --worker")
+
+    # The profile is compiled here first, so a mistake in it is found before any file is changed
+    # A hash without a secret salt can be undone by hashing every likely name or ID and comparing
+    if options.profile:
+        try:
+            profile = load_profile(options.profile)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+        if profile.hashes and not options.salt:
+            parser.error("Profile %s hashes values, which needs a secret --salt" % options.profile)
+
+    # How the tree is walked, for every walk of the run
+    walk = dict(depth=options.depth, include=options.include, exclude=options.exclude, threads=options.walk_threads)
     
     
     # Allow a textfile to be read to automatically anonymize multiple folders
-    if options.filename:
+    file_list = None
+    if options.files:
+        # Only the files in the list are anonymized, wherever they are
+        file_list = read_file_list(options.files)
+        directories_to_anonymize = sorted(set(os.path.dirname(filename) for filename in file_list))
+    elif options.filename:
         with open(options.filename,'r') as f:
             dirs = f.read()
 
@@ -194,43 +446,154 @@ def main():
     # Create a tuple to send over to the encrypt_dicom_name
     opt_tuple = (options.anon,options.numbers)
 
-    p = Pool(20) # Use 15 processes to paralleze dicom anonymization
+    # Journals and queues are only shared by runs with the same options
+    key = 'dcmanon %s%s' % ('encrypt' if options.anon else 'decrypt', ' numbers' if options.numbers else '')
+    if options.profile:
+        # Same profile and salt, without writing the salt down
+        with open(options.profile, 'r') as f:
+            key = 'dcmanon profile %s' % hash_value(f.read(), options.salt)[:16]
+    base = options.directory
+
+    # The coordinator doesn't read any files, it only waits for the workers and reports back
+    if options.coordinator:
+        stats = RunStats('dcmanon', options.stats, options.progress, worker_stage='anonymize')
+        try:
+            queue = WorkQueue(options.coordinator, key, shard_tree(base, options.unit_files, options.exclude))
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+        print "UNITS: ", queue.nunits
+
+        nrejected = 0
+        for unit, result in queue.results():
+            for rel in result['failed']:
+                print "DIRECTORY FAILED TO ANONYMIZE: ", local_path(base, rel)
+            stats.merge(result['counts'], result['ndirs'])
+            nrejected += result['nondicom']
+
+        for unit in queue.failed_units():
+            print "UNIT FAILED: ", unit['dirs'], unit['errors'][-1]
+
+        print "NON-DICOM FILES SKIPPED: ", nrejected
+
+        stats.close()
+        return
+
+    p, workers = make_pool(options.backend, directories_to_anonymize, options.workers)
+    print "WORKERS: ", options.backend, "(%s)" % workers
 
     print directories_to_anonymize
 
-    # base is the base directory to search in and get ALL subfolders
-    for base in directories_to_anonymize:
+    # Files from every subdirectory of every base directory are sent to the pool as they
+    # are found, instead of waiting for one directory to finish before starting the next.
+    # Files with nothing to change are counted as skipped
+    stats = RunStats('dcmanon', options.stats, options.progress, worker_stage='anonymize')
+    stats.info.update(backend=options.backend, workers=workers)
+
+    # Files that are clearly not dicoms are dropped by the walker. Files without a preamble
+    # are only let through when lenient, and then have to be forced.
+    sniffer = DicomSniffer(options.lenient, stats)
+
+    # What is left of a file that was being rewritten when a run was stopped is cleaned up
+    # before the sniffer can take it for a dicom (see recover_temp_file)
+    def keep(filename):
+        return not recover_temp_file(filename) and sniffer(filename)
+
+    # Folders that were finished by an earlier run with the same journal (and options) are skipped
+    journal = None
+    if options.journal:
+        try:
+            journal = Journal(options.journal, key)
+        except ValueError as e:
+            parser.error(str(e))
+
+    manifest = ManifestWriter(options.manifest) if options.manifest else None
+
+    uid_map = None
+    if options.uid_map:
+        try:
+            uid_map = UidMap(options.uid_map, options.salt)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # The file names are only needed for the manifest
+    filenames = {}
+    def named(walker):
+        for dirname, items in walker:
+            if manifest is not None:
+                filenames[dirname] = [item[0] for item in items]
+            yield dirname, items
+
+    # Returns the directories where some of the files failed
+    def anonymize(walker):
+        failed = []
+        if options.profile:
+            encrypt = partial(deidentify_dicom, profile=options.profile, salt=options.salt,
+                              force=options.lenient, checksum=manifest is not None)
+        else:
+            encrypt = partial(encrypt_dicom_name, force=options.lenient, checksum=manifest is not None)
+        stream = stream_directories(p, stats.timed(encrypt), stats.walk(named(walker)))
+        for dirname, results, nfailed in stats.stream(stream):
+            if options.profile:
+                # The new UIDs of the whole folder are added to the map at once
+                if uid_map is not None:
+                    uids = {}
+                    for result in results:
+                        if result is not None and result[0] is not None:
+                            uids.update(result[0][1])
+                    uid_map.add(uids)
+                results = [(result[0] and result[0][0], result[1]) if result is not None else None for result in results]
+            if manifest is not None:
+                # Files are anonymized where they are, so src and dst are the same
+                for filename, result in zip(filenames.pop(dirname), results):
+                    if result is not None and result[0] is not None:
+                        changed, size, digest = result[0]
+                        manifest.add_file(filename, filename, size, digest)
+                results = [(result[0] and result[0][0], result[1]) if result is not None else None for result in results]
+            stats.directory(dirname, results, nfailed)
+            if nfailed:
+                print "DIRECTORY FAILED TO ANONYMIZE: ", dirname
+                failed.append(dirname)
+            elif journal is not None:
+                journal.mark_done(dirname)
+        return failed
+
+    if options.worker:
+        try:
+            queue = WorkQueue(options.worker, key)
+        except ValueError as e:
+            parser.error(str(e))
+
+        def anonymize_unit(unit):
+            counts = dict(stats.counts)
+            ndirs = stats.ndirs
+            nrejected = sniffer.nrejected
+            walker = ((dirname, [[fullfilename, opt_tuple] for fullfilename in fullfilenames])
+                      for dirname, fullfilenames in walk_unit(base, unit, keep=keep, **walk))
+            failed = anonymize(walker)
+            return {'failed': [relative_path(base, dirname) for dirname in failed],
+                    'counts': dict((counter, stats.counts[counter] - counts[counter]) for counter in counts),
+                    'ndirs': stats.ndirs - ndirs, 'nondicom': sniffer.nrejected - nrejected}
+
+        ncompleted = run_worker(queue, anonymize_unit)
+        print "UNITS COMPLETED: ", ncompleted
+    elif file_list is not None:
+        anonymize((dirname, [[fullfilename, opt_tuple] for fullfilename in fullfilenames])
+                  for dirname, fullfilenames in walk_file_list(file_list, keep=keep, done=journal))
+    else:
+        anonymize(anon_walker(directories_to_anonymize, opt_tuple, options, keep=keep, done=journal, walk=walk))
 
-        print "Current main directory:", base
+    if journal is not None:
+        journal.close()
 
-        if options.verbose:
-            if options.anon:
-                print "Encrypting the following folders..."
-            else:
-                print "Decrypting the following folders..."
+    if manifest is not None:
+        manifest.close()
 
-        # os.walk goes through every subdirectory as a loop. The current directory
-        # in the loop is "dirname". All files in dirname are in a list, "filenames"
-        for dirname, dirnames, filenames in os.walk(base):
-            if options.verbose:
-                print dirname
+    if uid_map is not None:
+        uid_map.close()
 
-            #Append dicom options to each item        
-            fullfilenames_options = [ [os.path.join(dirname,filename),opt_tuple] for filename in filenames]
-
-            # Sometimes this pulls an error. I'm not sure why, but there are five chances for it to retry.
-            for x in xrange(5):
-                try:
-                    # Use the pool to parallelze encryption
-                    p.map(encrypt_dicom_name,fullfilenames_options)
-                except:
-                    # If it's the fourth try, print the failed directory.
-                    if x == 4:
-                        print "DIRECTORY FAILED TO ANONYMIZE: ", dirname
-                    # Continue onto next "iteration" if it fails; skip the break
-                    continue
+    print "NON-DICOM FILES SKIPPED: ", sniffer.nrejected
 
-                break
+    stats.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,190 @@
+###################################################################################################
+#
+#    Reading dicoms inside zip and tar archives
+#
+# -Used by create_mr_db.py and dcmsort.py so that a tree that arrives as archives can be
+# catalogued (or planned, or sorted into a new tree) without being extracted first.
+#
+# -A file inside an archive is named "<archive>::<member>", ie:
+#   Z:\Images\Incoming\transfer.zip::PATIENT000/STUDY00/IM0001
+# and a folder inside an archive is named the same way. These names go through the walker, the
+# pool and the tools like any other filename.
+#
+# -zip files have a central directory, so every member can be read on its own. Workers open the
+# archive themselves (once per worker) and read only the start of the members they are given.
+# -tar files (plain or compressed) can only be read from start to end. The walker streams through
+# them once and sends the start of every member along with its name (see ArchiveMember), so the
+# workers never have to go back to the archive.
+#
+###################################################################################################
+
+import os
+import shutil
+import tarfile
+import zipfile
+import posixpath
+import threading
+
+ARCHIVE_SEP = '::'
+
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+
+# Number of bytes read from the start of every member. Enough for the header fields of nearly
+# every file (the rest of the member is only read if the header is longer).
+MEMBER_PREFIX_SIZE = 16 * 1024
+
+# Bytes copied at a time when a member is extracted
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Open archives kept by each worker (thread or process)
+MAX_OPEN_ARCHIVES = 4
+
+# Errors from opening or reading a member that mean it can't be read (missing, corrupt, etc.)
+ARCHIVE_ERRORS = (IOError, OSError, KeyError, zipfile.BadZipfile, tarfile.TarError)
+
+_local = threading.local()
+
+# Name of a member that also carries the start of its data (from a streamed tar), so it doesn't
+# have to be read again. It is a str, so it can be used anywhere a filename is.
+class ArchiveMember(str):
+
+    def __new__(cls, name, data='', size=0):
+        member = str.__new__(cls, name)
+        member.data = data
+        member.size = size
+        return member
+
+    def complete(self):
+        return len(self.data) >= self.size
+
+def is_archive(filename):
+    name = filename.lower()
+    return name.endswith(ZIP_EXTENSIONS) or name.endswith(TAR_EXTENSIONS)
+
+def is_member(filename):
+    return ARCHIVE_SEP in filename
+
+def member_name(archive, member):
+    return archive + ARCHIVE_SEP + member
+
+def split_member(filename):
+    # Returns (archive, member)
+    return tuple(filename.split(ARCHIVE_SEP, 1))
+
+def member_path(filename):
+    # Path a member would have if its archive was extracted into a folder of the same name
+    if not is_member(filename):
+        return filename
+    archive, member = split_member(filename)
+    return os.path.normpath(os.path.join(archive, *member.split('/')))
+
+def _open_archive(archive):
+
+    # Archives stay open between calls, since opening a zip reads its whole central directory.
+    # A zip file object can't be shared between threads, so every thread has its own.
+    cache = getattr(_local, 'archives', None)
+    if cache is None:
+        cache = _local.archives = {}
+
+    if archive not in cache:
+        if len(cache) >= MAX_OPEN_ARCHIVES:
+            for f in cache.values():
+                f.close()
+            cache.clear()
+        if archive.lower().endswith(ZIP_EXTENSIONS):
+            cache[archive] = zipfile.ZipFile(archive, 'r')
+        else:
+            cache[archive] = tarfile.open(archive, 'r:*')
+
+    return cache[archive]
+
+def read_member(filename, size=-1):
+
+    # Returns (data, complete). data is the first "size" bytes of the member (all of it if
+    # size is -1), complete is True if that is the whole member.
+    data = getattr(filename, 'data', None)
+    if data is not None and (filename.complete() or 0 <= size <= len(data)):
+        if size >= 0:
+            data = data[:size]
+        return data, len(data) >= filename.size
+
+    fp, total = open_member(filename)
+    try:
+        data = fp.read(size) if size >= 0 else fp.read()
+    finally:
+        fp.close()
+
+    return data, len(data) >= total
+
+def open_member(filename):
+
+    # Returns (file object of the member's data, size of the member)
+    archive, member = split_member(filename)
+    f = _open_archive(archive)
+    if isinstance(f, zipfile.ZipFile):
+        return f.open(member), f.getinfo(member).file_size
+
+    # Only for data that the walker didn't send along. The tar has to be read up to the
+    # member again.
+    info = f.getmember(member)
+    return f.extractfile(info), info.size
+
+def extract_member(filename, dst):
+
+    # Writes the whole member to dst, a chunk at a time (a member can be larger than memory)
+    data = getattr(filename, 'data', None)
+    if data is not None and filename.complete():
+        with open(dst, 'wb') as f:
+            f.write(data)
+        return
+
+    fp, total = open_member(filename)
+    try:
+        with open(dst, 'wb') as f:
+            shutil.copyfileobj(fp, f, COPY_CHUNK_SIZE)
+    finally:
+        fp.close()
+
+def _group_members(archive, names):
+
+    # Yields (folder, members) for every folder in a list of member names
+    folders = {}
+    for name in names:
+        folders.setdefault(posixpath.dirname(name), []).append(name)
+
+    for folder in sorted(folders):
+        yield member_name(archive, folder), [member_name(archive, name) for name in folders[folder]]
+
+def walk_archive(archive, prefix_size=MEMBER_PREFIX_SIZE):
+
+    # Yields (dirname, member names) for every folder in the archive, same as walk_directories
+    if archive.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(archive, 'r') as f:
+            names = [info.filename for info in f.infolist() if not info.filename.endswith('/')]
+        for out in _group_members(archive, names):
+            yield out
+        return
+
+    # Members of a folder are normally stored next to each other, so a folder is handed back as
+    # soon as the tar moves on to another one. If a folder comes back later, it is handed back
+    # again (as if it had been walked twice).
+    f = tarfile.open(archive, 'r|*')
+    try:
+        folder = None
+        members = []
+        for info in f:
+            if not info.isfile():
+                continue
+            dirname = posixpath.dirname(info.name)
+            if dirname != folder:
+                if members:
+                    yield member_name(archive, folder), members
+                folder = dirname
+                members = []
+            fp = f.extractfile(info)
+            members.append(ArchiveMember(member_name(archive, info.name), fp.read(prefix_size), info.size))
+        if members:
+            yield member_name(archive, folder), members
+    finally:
+        f.close()
@@ -0,0 +1,729 @@
+###################################################################################################
+#
+#    Benchmarking the DICOM tools
+#
+# -The purpose of this script is to measure how much of each file the tools read, and how fast.
+# Every dicom file under the directory is read with the full parse (dicom.read_file) and with the
+# header-only reader (dcmheader.py) for the fields that each tool needs.
+#
+# -The cipher benchmark compares the translation tables in dcmanon.py against the original
+# per-character loops, in names per second.
+#
+# -The naming benchmark (-s) times the IMAGE.SSSS.IIII / DCMSSSS_PROTOCOL naming of dcmsort.py
+# against the original per-row pandas version, on a single (made up) folder with many files.
+#
+# -The row benchmark (-r) compares the rows of create_mr_db.py (see dcmrecord.py) against the
+# dicts of pydicom values they replace: bytes to pickle a row back from a worker, time to pickle
+# and unpickle it, and the peak RSS of holding many of them.
+#
+# -The de-identification benchmark (-i) compares the four fields of dcmanon.py against a full
+# profile (deid_basic.txt, see dcmdeid.py) on headers with sequences and private tags: looked up
+# by name like the four fields, and compiled and applied in a single pass. It times the change
+# on headers already in memory, and then whole files (read, change, write).
+#
+# -The tree benchmark (-t) makes a synthetic tree with dcmsynth.py and runs the core path of each
+# tool on it (create_mr_db, dcmsort and dcmanon, each on its own copy of the tree). It reports
+# files/s, bytes read, peak RSS and the wall time of each stage, and can save everything as JSON
+# (-o) so results can be compared between versions.
+#
+# -To test out, type in:
+# python dcmbench.py -d "Z:\Images\Databases\SamplePatient"
+# python dcmbench.py -c 1000000
+# python dcmbench.py -s 100000
+# python dcmbench.py -r 1000000
+# python dcmbench.py -i 10000
+# python dcmbench.py -t --patients 10 --series 8 --slices 100 --junk 2 -o bench.json
+# -d = directory
+# -n = maximum number of files to read (default is all files)
+# -c = number of names for the cipher benchmark
+# -s = number of files in the folder for the naming benchmark
+# -r = number of rows for the row benchmark
+# -i = number of headers for the de-identification benchmark (--profile for another profile)
+# -t = run the tree benchmark (see "python dcmbench.py -h" for the tree options)
+# -o = JSON file for the tree benchmark results
+#
+###################################################################################################
+
+import os
+import sys
+import time
+import json
+import cPickle
+import cStringIO
+import shutil
+import random
+import tempfile
+import platform
+import multiprocessing
+import dicom
+import numpy as np
+import pandas as pd
+from optparse import OptionParser
+from dcmheader import read_dicom_header, read_dicom_fields
+from dcmpipeline import walk_directories, stream_directories, make_pool, BACKENDS
+from dcmsynth import generate_tree
+from dcmsort import sortfields, isFolderSorted, readDicomFile, planDirectory, planFolderRenames, nameDirectory, \
+    executePlan
+from create_mr_db import fields, dcmfields, get_db_dicominfo, remove_same_series
+from dcmanon import fields_to_anon, KEY, encrypt_string, unencrypt_string, \
+    encrypt_strings, unencrypt_strings, encrypt_dicom_name, get_anon_fields, deidentify_dicom
+from dcmdeid import Profile, hash_uid, hash_text, TEXT_VRS
+from dicom.datadict import CleanName
+from dicom.dataset import Dataset
+from dicom.sequence import Sequence
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Keeps track of how many bytes are actually read from a file
+class CountingFile(object):
+
+    def __init__(self, filename):
+        self.fp = open(filename, 'rb')
+        self.name = filename
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.fp.seek(offset, whence)
+
+    def tell(self):
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+
+def full_parse(fp, fields):
+    dcminf = dicom.read_file(fp)
+    return [getattr(dcminf, field, None) for field in fields]
+
+def header_parse(fp, fields):
+    return read_dicom_fields(fp, fields)
+
+# Reads every file with "reader" and returns (number of dicoms, bytes read, seconds)
+def time_reader(reader, filenames, fields):
+
+    ndicoms = 0
+    nbytes = 0
+    start_time = time.time()
+
+    for filename in filenames:
+        fp = CountingFile(filename)
+        try:
+            reader(fp, fields)
+            ndicoms += 1
+        except:
+            pass
+        finally:
+            fp.close()
+        nbytes += fp.bytes_read
+
+    return ndicoms, nbytes, time.time() - start_time
+
+def print_result(name, ndicoms, nbytes, seconds):
+
+    rate = ndicoms / seconds if seconds > 0 else 0
+    print "  %-8s %8d files %14d bytes read %10.1f files/s" % (name, ndicoms, nbytes, rate)
+
+# The original per-character cipher from dcmanon.py, kept as the reference for the benchmark
+def encrypt_string_loop(string,randomizer):
+    encryptd_string = ''
+
+    for char in string:
+        encryptd_string += chr(int(randomizer[int(ord(char)-32)]))
+
+    return encryptd_string
+
+def unencrypt_string_loop(string,randomizer):
+    unencrypt = np.argsort(randomizer) + 32
+    unencryptd_string = ''
+    for char in string:
+        unencryptd_string += chr(int(unencrypt[int(ord(char)-32)]))
+
+    return unencryptd_string
+
+def random_names(nnames):
+
+    # Names that look like PatientsName values, eg. "DOE^JOHN"
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    rand = random.Random(0)
+
+    names = []
+    for x in xrange(nnames):
+        last = ''.join(rand.choice(letters) for y in xrange(rand.randint(3, 12)))
+        first = ''.join(rand.choice(letters) for y in xrange(rand.randint(3, 10)))
+        names.append(last + '^' + first)
+
+    return names
+
+def time_cipher(name, func, names):
+
+    start_time = time.time()
+    out = func(names)
+    seconds = time.time() - start_time
+
+    rate = len(names) / seconds / 1e6 if seconds > 0 else 0
+    print "  %-22s %12.3f million names/s" % (name, rate)
+
+    return out
+
+def bench_cipher(nnames):
+
+    names = random_names(nnames)
+    key = np.array(KEY, dtype=float)
+
+    # The loops are much slower, so they only get a sample of the names
+    sample = names[:max(1, nnames // 100)]
+    encrypted = encrypt_strings(sample)
+
+    print "cipher (%d names, %d for the loops)" % (nnames, len(sample))
+    loop = time_cipher('encrypt (loop)', lambda x: [encrypt_string_loop(n, key) for n in x], sample)
+    time_cipher('unencrypt (loop)', lambda x: [unencrypt_string_loop(n, key) for n in x], encrypted)
+
+    table = time_cipher('encrypt (table)', lambda x: [encrypt_string(n) for n in x], names)
+    time_cipher('unencrypt (table)', lambda x: [unencrypt_string(n) for n in x], table)
+    batch = time_cipher('encrypt (batch)', encrypt_strings, names)
+    time_cipher('unencrypt (batch)', unencrypt_strings, batch)
+
+    if loop != table[:len(sample)] or batch != table:
+        print "  WARNING: results do not match the original cipher"
+
+# Number of bytes this process has read so far (Linux only, None elsewhere)
+def read_io_bytes():
+
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return None
+
+# Peak RSS in KB of this process and of its (finished) workers
+def peak_rss():
+
+    if resource is None:
+        return None, None
+
+    scale = 1 if sys.platform != 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+# Runs a function in the pool and also returns the number of bytes the worker read while running it
+class CountedCall(object):
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        before = read_io_bytes()
+        result = self.func(item)
+        after = read_io_bytes()
+        return result, (after - before if before is not None else None)
+
+# The original naming from dcmsort.py (without the df.sort, whose result was never used), kept as
+# the reference for the benchmark
+def name_directory_pandas(dcminfo_container):
+
+    df_dcminfo = pd.DataFrame(dcminfo_container, columns =['fn', 'sid', 'pn', 'sn', 'in'])
+
+    df_dcminfo['sn2'] = df_dcminfo['sn'].apply(lambda x: '000' + str(x))
+    df_dcminfo['in2'] = df_dcminfo['in'].apply(lambda x: '000' + str(x))
+
+    df_dcminfo['fname'] = 'IMAGE.' + df_dcminfo['sn2'].apply(lambda x: x[-4:]) + '.' + \
+        df_dcminfo['in2'].apply(lambda x: x[-4:])
+    df_dcminfo['fldr'] = 'DCM' + df_dcminfo['sn2'].apply(lambda x: x[-4:]) + \
+        '_' + df_dcminfo['pn']
+
+    single = len(df_dcminfo['sid'].unique()) == 1 and len(df_dcminfo['pn'].unique()) == 1
+
+    return df_dcminfo['fname'].tolist(), df_dcminfo['fldr'].tolist(), single
+
+def sort_folder(nfiles, nseries=16, series_step=1, protocol=None):
+
+    # dcminfo_container (see readDicomFile) for a folder with nfiles files spread over nseries series
+    rand = random.Random(0)
+    container = []
+    for ind in xrange(nfiles):
+        series = 1 + (ind % nseries) * series_step
+        container.append(['/nonexistent/IM%06d' % ind, '2.25.%d' % series, protocol or 'PROTOCOL%d' % series,
+                          str(series), str(ind // nseries + 1)])
+    rand.shuffle(container)
+
+    return container
+
+def time_naming(name, func, container, repeat=3):
+
+    # Best of a few runs
+    seconds = None
+    for ind in xrange(repeat):
+        start_time = time.time()
+        out = func(container)
+        if seconds is None or time.time() - start_time < seconds:
+            seconds = time.time() - start_time
+
+    rate = len(container) / seconds if seconds > 0 else 0
+    print "  %-22s %10.3f s %12.0f files/s" % (name, seconds, rate)
+
+    return out
+
+def bench_naming(nfiles):
+
+    container = sort_folder(nfiles)
+
+    print "naming (%d files in one folder)" % nfiles
+    old = time_naming('pandas apply', name_directory_pandas, container)
+    new = time_naming('nameDirectory', nameDirectory, container)
+    time_naming('planDirectory', lambda x: planDirectory('/nonexistent', x), container)
+
+    if list(old[0]) != list(new[0]) or list(old[1]) != list(new[1]) or old[2] != new[2]:
+        print "  WARNING: names do not match the original naming"
+
+    # Numbers above 9999 were cut down to their last 4 digits, so repeats of the same protocol as
+    # series 1, 10001, 20001, ... all got the same names
+    container = sort_folder(nfiles, series_step=10000, protocol='T1_MPRAGE')
+    old = name_directory_pandas(container)
+    new = nameDirectory(container)
+    print "  series numbers above 9999: %d distinct names (pandas), %d (nameDirectory), %d files" % \
+        (len(set(zip(old[1], old[0]))), len(set(zip(new[1], new[0]))), nfiles)
+
+# The row create_mr_db.py used to make: a dict of the values pydicom read
+def dict_row(filename):
+
+    dcminf = read_dicom_header(filename, dcmfields)
+    return dict(zip(fields, [getattr(dcminf, field, None) for field in dcmfields]))
+
+def time_rows(name, make_row, filenames, nrows, queue):
+
+    # Runs in its own process, so the peak RSS is only this kind of row
+    rows = [make_row(filename) for filename in filenames]
+    data = cPickle.dumps(rows, 2)
+
+    start_time = time.time()
+    for ind in xrange(max(1, nrows // len(rows) // 10)):
+        cPickle.loads(cPickle.dumps(rows, 2))
+    pickle_time = (time.time() - start_time) / (max(1, nrows // len(rows) // 10) * len(rows))
+
+    # Every batch that comes back from a worker is a new set of objects
+    rss = peak_rss()[0]
+    held = []
+    while len(held) < nrows:
+        held.extend(cPickle.loads(data))
+
+    queue.put({'name': name, 'bytes': len(data) / float(len(rows)), 'pickle_us': pickle_time * 1e6,
+               'rss_kb': peak_rss()[0] - rss if rss is not None else None})
+
+def bench_rows(nrows):
+
+    base = tempfile.mkdtemp(prefix='dcmbench_')
+    try:
+        generate_tree(base, npatients=2, nstudies=1, nseries=4, nslices=16, rows=16)
+        filenames = [filename for dirname, fullfilenames in walk_directories([base])
+                     for filename in fullfilenames]
+
+        print "rows (%d rows, made from %d files)" % (nrows, len(filenames))
+        results = []
+        for name, make_row in [('dict (pydicom values)', dict_row), ('SeriesRow', get_db_dicominfo)]:
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=time_rows, args=(name, make_row, filenames, nrows, queue))
+            proc.start()
+            result = queue.get()
+            proc.join()
+            results.append(result)
+
+            print "  %-22s %8.0f bytes/row %8.1f us/row (pickle + unpickle) %10s KB peak RSS" % \
+                (name, result['bytes'], result['pickle_us'], result['rss_kb'])
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    return results
+
+def clinical_header(filename, rand):
+
+    # A synthetic file with what a clinical header also has: names, dates, addresses, a sequence of
+    # referenced images and a block of private tags. Returns the file as a string.
+    ds = dicom.read_file(filename)
+    ds.InstanceCreationDate = ds.StudyDate
+    ds.SeriesDate = ds.StudyDate
+    ds.ContentDate = ds.StudyDate
+    ds.StudyTime = ds.AcquisitionTime
+    ds.AccessionNumber = 'A%08d' % rand.randint(0, 99999999)
+    ds.InstitutionName = 'GENERAL HOSPITAL'
+    ds.InstitutionAddress = '1 MAIN STREET'
+    ds.ReferringPhysiciansName = 'DOE^JANE'
+    ds.StationName = 'MR01'
+    ds.StudyDescription = 'BRAIN'
+    ds.OperatorsName = 'SMITH^J'
+    ds.PatientsBirthDate = '19700101'
+    ds.PatientsSex = 'F'
+    ds.PatientsAge = '045Y'
+    ds.PatientsWeight = '70'
+    ds.PatientsAddress = '2 SIDE STREET'
+    ds.MedicalAlerts = 'NONE'
+    ds.SpecialNeeds = 'NONE'
+    ds.DeviceSerialNumber = '12345'
+    ds.StudyID = '1'
+    ds.FrameofReferenceUID = ds.StudyInstanceUID + '.1'
+
+    items = []
+    for ind in xrange(3):
+        item = Dataset()
+        item.ReferencedSOPClassUID = ds.SOPClassUID
+        item.ReferencedSOPInstanceUID = ds.SOPInstanceUID + '.%d' % ind
+        items.append(item)
+    ds.ReferencedImages = Sequence(items)
+
+    ds.add_new(0x00290010, 'LO', 'ACME 1.0')
+    for ind in xrange(20):
+        ds.add_new(0x00291010 + ind, 'LO', 'PRIVATE %d' % ind)
+
+    f = cStringIO.StringIO()
+    dicom.write_file(f, ds)
+    return f.getvalue()
+
+def anon_by_name(ds, rules, salt=''):
+
+    # The profile applied the same way as the four fields: every rule looked up by name, and only
+    # at the top level (no sequences, no private tags)
+    for name, action, value in rules:
+        if action == 'replace':
+            setattr(ds, name, value)
+        elif not hasattr(ds, name):
+            continue
+        elif action == 'remove':
+            delattr(ds, name)
+        elif action == 'empty':
+            setattr(ds, name, '')
+        elif action == 'hash':
+            VR = ds.data_element(name).VR
+            if VR == 'UI':
+                setattr(ds, name, hash_uid(str(getattr(ds, name)), salt))
+            elif VR in TEXT_VRS:
+                setattr(ds, name, hash_text(str(getattr(ds, name)), salt))
+
+def time_deid(name, func, headers, nheaders):
+
+    # Only the change is timed, not reading the header
+    seconds = 0.0
+    for ind in xrange(nheaders):
+        ds = dicom.read_file(cStringIO.StringIO(headers[ind % len(headers)]))
+        start_time = time.time()
+        func(ds)
+        seconds += time.time() - start_time
+
+    rate = nheaders / seconds if seconds > 0 else 0
+    print "  %-26s %10.1f us/header %12.0f headers/s" % (name, seconds / nheaders * 1e6, rate)
+    return ds
+
+def time_deid_files(name, func, filenames):
+
+    start_time = time.time()
+    for filename in filenames:
+        func([filename, (True, False)])
+    seconds = time.time() - start_time
+
+    rate = len(filenames) / seconds if seconds > 0 else 0
+    print "  %-26s %10.1f ms/file %14.0f files/s" % (name, seconds / len(filenames) * 1e3, rate)
+
+def bench_deid(nheaders, profile_name):
+
+    start_time = time.time()
+    with open(profile_name, 'r') as f:
+        profile = Profile(f, os.path.basename(profile_name))
+    compile_time = time.time() - start_time
+
+    # Names are looked up once, which is the best the by name version can do
+    rules = [(CleanName(tag), action, value) for tag, (action, value) in sorted(profile.rules.items())]
+    rules = [rule for rule in rules if rule[0]]
+
+    def four_fields(ds):
+        anon_fields = get_anon_fields(ds, True, False)
+        for field in anon_fields:
+            setattr(ds, field, anon_fields[field])
+
+    base = tempfile.mkdtemp(prefix='dcmbench_')
+    try:
+        generate_tree(base, npatients=2, nstudies=1, nseries=4, nslices=16, rows=128)
+        filenames = [filename for dirname, fullfilenames in walk_directories([base])
+                     for filename in fullfilenames]
+        rand = random.Random(0)
+        headers = [clinical_header(filename, rand) for filename in filenames]
+
+        print "de-identification (%d headers, %s: %d rules, compiled in %.1f ms)" % \
+            (nheaders, profile.name, len(profile.rules), compile_time * 1e3)
+        time_deid('four fields (by name)', four_fields, headers, nheaders)
+        by_name = time_deid('profile (by name)', lambda ds: anon_by_name(ds, rules), headers, nheaders)
+        compiled = time_deid('profile (compiled)', lambda ds: profile.apply(ds), headers, nheaders)
+
+        # Both have to agree on everything the by name version can reach
+        for tag in profile.rules:
+            if tag.group != 2 and (by_name.get(tag) and by_name[tag].value) != (compiled.get(tag) and compiled[tag].value):
+                print "  WARNING: %s differs between the by name and compiled profiles" % tag
+        original = dicom.read_file(cStringIO.StringIO(headers[(nheaders - 1) % len(headers)]))
+        print "  left by the by name profile: %d private tags, %d UIDs in sequences" % \
+            (len([tag for tag in by_name.keys() if tag.group & 1]),
+             len([item for item, old in zip(by_name.ReferencedImages, original.ReferencedImages)
+                  if item.ReferencedSOPInstanceUID == old.ReferencedSOPInstanceUID]))
+
+        # Whole files, one at a time: the four fields are patched in place, the profile rewrites the file
+        for ind, filename in enumerate(filenames):
+            with open(filename, 'wb') as f:
+                f.write(headers[ind])
+        time_deid_files('four fields (patched)', encrypt_dicom_name, filenames)
+        for ind, filename in enumerate(filenames):
+            with open(filename, 'wb') as f:
+                f.write(headers[ind])
+        time_deid_files('profile (rewritten)', lambda dcm: deidentify_dicom(dcm, profile_name), filenames)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+def run_tool(tool, root, workers, backend='process'):
+
+    stats = {'tool': tool, 'backend': backend, 'stages': {}}
+    stages = stats['stages']
+    start_time = time.time()
+
+    # Listing the tree on its own
+    skip = isFolderSorted if tool == 'dcmsort' else None
+    nfiles = 0
+    for dirname, fullfilenames in walk_directories([root], skip=skip):
+        nfiles += len(fullfilenames)
+    stages['walk'] = time.time() - start_time
+
+    if tool == 'create_mr_db':
+        func = get_db_dicominfo
+        items = lambda dirname, fullfilenames: fullfilenames
+    elif tool == 'dcmsort':
+        func = readDicomFile
+        items = lambda dirname, fullfilenames: fullfilenames
+    else:
+        func = encrypt_dicom_name
+        items = lambda dirname, fullfilenames: [[filename, (True, False)] for filename in fullfilenames]
+
+    walker = ((dirname, items(dirname, fullfilenames))
+              for dirname, fullfilenames in walk_directories([root], skip=skip))
+
+    p, stats['workers'] = make_pool(backend, [root], workers)
+    nbytes = 0
+    nrows = 0
+    fldrs_to_rename = []
+    directory_time = 0.0
+    stream_start = time.time()
+    io_start = read_io_bytes()
+
+    for dirname, results, nfailed in stream_directories(p, CountedCall(func), walker):
+
+        results = [result for result in results if result is not None]
+        nbytes += sum(result[1] or 0 for result in results)
+        results = filter(None, [result[0] for result in results])
+
+        # Directory level steps, timed separately from the pool
+        step_start = time.time()
+        if tool == 'create_mr_db':
+            nrows += len(remove_same_series(results))
+        elif tool == 'dcmsort' and results:
+            plan, fldrs, skipped = planDirectory(dirname, results)
+            executePlan(plan)
+            fldrs_to_rename.extend(fldrs)
+        directory_time += time.time() - step_start
+
+    p.close()
+    p.join()
+
+    # Threads share the counters of this process, so their reads are only counted as a total
+    # (for the hybrid backend, that is what the prefetch threads read)
+    if backend == 'thread':
+        nbytes = 0
+    if backend != 'process' and io_start is not None:
+        nbytes += read_io_bytes() - io_start
+
+    parse_stage = 'anonymize' if tool == 'dcmanon' else 'parse'
+    stages[parse_stage] = time.time() - stream_start - directory_time
+
+    if tool == 'create_mr_db':
+        stages['dedup'] = directory_time
+        stats['nrows'] = nrows
+    elif tool == 'dcmsort':
+        step_start = time.time()
+        plan, skipped = planFolderRenames(fldrs_to_rename)
+        executePlan(plan)
+        stages['rename'] = directory_time + time.time() - step_start
+
+    stats['wall'] = time.time() - start_time
+    stats['nfiles'] = nfiles
+    stats['files_per_s'] = nfiles / stats['wall'] if stats['wall'] > 0 else 0
+    stats['bytes_read'] = nbytes if read_io_bytes() is not None else None
+    stats['peak_rss_kb'], stats['peak_rss_workers_kb'] = peak_rss()
+
+    return stats
+
+def _run_tool_process(queue, tool, root, workers, backend):
+    queue.put(run_tool(tool, root, workers, backend))
+
+def bench_tree(options):
+
+    # Each tool runs in its own process so its peak RSS isn't mixed up with the others
+    tree = {'npatients': options.npatients, 'nstudies': options.nstudies,
+            'nseries': options.nseries, 'nslices': options.nslices, 'mixed': options.mixed,
+            'presorted': options.presorted, 'encrypted': options.encrypted,
+            'njunk': options.njunk, 'rows': options.rows, 'seed': options.seed}
+
+    base = tempfile.mkdtemp(prefix='dcmbench_')
+    results = {'python': platform.python_version(), 'pydicom': dicom.__version__,
+               'platform': platform.platform(), 'cpus': multiprocessing.cpu_count(),
+               'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'tree': tree, 'tools': []}
+
+    try:
+        for tool in ['create_mr_db', 'dcmsort', 'dcmanon']:
+            root = os.path.join(base, tool)
+            results['files'] = generate_tree(root, **tree)
+
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_run_tool_process,
+                                           args=(queue, tool, root, options.workers, options.backend))
+            proc.start()
+            stats = queue.get()
+            proc.join()
+
+            results['tools'].append(stats)
+
+            print "%-14s %8d files %10.1f files/s %14s bytes read" % \
+                (tool, stats['nfiles'], stats['files_per_s'], stats['bytes_read'])
+            print "               peak RSS %s KB (workers %s KB)" % \
+                (stats['peak_rss_kb'], stats['peak_rss_workers_kb'])
+            for stage in sorted(stats['stages']):
+                print "               %-10s %8.3f s" % (stage, stats['stages'][stage])
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+def main():
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-d", "--dir",
+                      action="store",
+                      type="string",
+                      dest="directory",
+                      default=os.getcwd(),
+                      help="Directory file to search through")
+    parser.add_option("-n", "--nfiles",
+                      action="store",
+                      type="int",
+                      dest="nfiles",
+                      default=0,
+                      help="Maximum number of files to read")
+    parser.add_option("-c", "--cipher",
+                      action="store",
+                      type="int",
+                      dest="cipher",
+                      default=0,
+                      help="Number of names for the cipher benchmark")
+    parser.add_option("-s", "--sortnames",
+                      action="store",
+                      type="int",
+                      dest="sortnames",
+                      default=0,
+                      help="Number of files in the folder for the naming benchmark")
+    parser.add_option("-r", "--records",
+                      action="store",
+                      type="int",
+                      dest="nrows",
+                      default=0,
+                      help="Number of rows for the row benchmark")
+    parser.add_option("-i", "--deid",
+                      action="store",
+                      type="int",
+                      dest="deid",
+                      default=0,
+                      help="Number of headers for the de-identification benchmark")
+    parser.add_option("--profile",
+                      action="store",
+                      type="string",
+                      dest="profile",
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deid_basic.txt'),
+                      help="De-identification profile for the benchmark (default is deid_basic.txt)")
+    parser.add_option("-t", "--tree",
+                      action="store_true",
+                      dest="tree",
+                      default=False,
+                      help="Run the tools on a synthetic tree")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      type="string",
+                      dest="json",
+                      default='',
+                      help="JSON file for the tree benchmark results")
+    parser.add_option("-w", "--workers", type="int", dest="workers", default=0,
+                      help="Number of pool workers for the tree benchmark (default is to choose)")
+    parser.add_option("-b", "--backend", type="choice", choices=BACKENDS, dest="backend",
+                      default='process', help="Pool backend for the tree benchmark")
+    parser.add_option("--patients", type="int", dest="npatients", default=4,
+                      help="Number of patients in the synthetic tree")
+    parser.add_option("--studies", type="int", dest="nstudies", default=2,
+                      help="Number of studies per patient")
+    parser.add_option("--series", type="int", dest="nseries", default=5,
+                      help="Number of series per study")
+    parser.add_option("--slices", type="int", dest="nslices", default=20,
+                      help="Number of slices per series")
+    parser.add_option("--mixed", type="float", dest="mixed", default=0.2,
+                      help="Fraction of studies with all series in one folder")
+    parser.add_option("--sorted", type="float", dest="presorted", default=0.2,
+                      help="Fraction of series folders that are already sorted")
+    parser.add_option("--encrypted", type="float", dest="encrypted", default=0.2,
+                      help="Fraction of patients with encrypted names")
+    parser.add_option("--junk", type="int", dest="njunk", default=2,
+                      help="Number of non-DICOM files in every unsorted folder")
+    parser.add_option("--rows", type="int", dest="rows", default=128,
+                      help="Image size (rows = columns)")
+    parser.add_option("--seed", type="int", dest="seed", default=0,
+                      help="Random seed for the synthetic tree")
+
+    (options, args) = parser.parse_args()
+
+    if options.cipher:
+        bench_cipher(options.cipher)
+        return
+
+    if options.tree:
+        bench_tree(options)
+        return
+
+    if options.nrows:
+        bench_rows(options.nrows)
+        return
+
+    if options.sortnames:
+        bench_naming(options.sortnames)
+        return
+
+    if options.deid:
+        bench_deid(options.deid, options.profile)
+        return
+
+    filenames = []
+    for dirname, dirnames, files in os.walk(options.directory):
+        filenames.extend(os.path.join(dirname, filename) for filename in files)
+
+    if options.nfiles:
+        filenames = filenames[:options.nfiles]
+
+    tools = [('dcmsort', sortfields), ('create_mr_db', dcmfields), ('dcmanon', fields_to_anon)]
+
+    for tool, fields in tools:
+        print tool
+        print_result('full', *time_reader(full_parse, filenames, fields))
+        print_result('header', *time_reader(header_parse, filenames, fields))
+
+if __name__ == '__main__':
+    main()
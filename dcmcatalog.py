@@ -0,0 +1,114 @@
+###################################################################################################
+#
+#    Catalog of every dicom file in a tree
+#
+# -The database made by create_mr_db.py has one row per series and no file names, so finding the
+# files of a patient, study or series means walking the whole tree again. The catalog keeps a
+# record for every dicom instead: its path and the UIDs it belongs to.
+#
+# -The catalog is a SQLite file with one row per file: path, folder, PatientID, StudyInstanceUID,
+# SeriesInstanceUID and SOPInstanceUID. Every UID (and the PatientID) has its own index, so a
+# lookup only touches the rows it returns, however large the catalog is.
+# -It is filled in by create_mr_db.py (--catalog) and looked up with dcmquery.py. The file lists
+# that dcmquery.py writes can be given to dcmsort.py and dcmanon.py (--files) instead of a folder.
+# -A folder is replaced as a whole every time it is scanned. Folders under the scanned base that
+# weren't seen in the scan are removed at the end, the same as the scan index (see dcmindex.py).
+#
+###################################################################################################
+
+import sqlite3
+from dcmindex import to_text
+
+# Dicom fields kept for every file (after its path and folder)
+CATALOG_FIELDS = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID']
+
+# What each field is looked up by, in query() and dcmquery.py
+QUERY_KEYS = {'patient': 'PatientID', 'study': 'StudyInstanceUID', 'series': 'SeriesInstanceUID', 'sop': 'SOPInstanceUID'}
+
+# Number of directories to update between commits
+COMMIT_EVERY = 100
+
+class FileCatalog(object):
+
+    def __init__(self, filename):
+
+        self.conn = sqlite3.connect(filename)
+        self.conn.text_factory = str
+        self.nupdated = 0
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dirname TEXT, " +
+                          ', '.join('%s TEXT' % field for field in CATALOG_FIELDS) + ")")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_dirname ON files (dirname)")
+        for field in CATALOG_FIELDS:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_%s ON files (%s)" % (field, field))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dirs (dirname TEXT PRIMARY KEY, scan INTEGER)")
+
+        # Every scan gets a number, so folders that weren't seen in this scan can be removed
+        self.scan = (self.conn.execute("SELECT MAX(scan) FROM dirs").fetchone()[0] or 0) + 1
+
+        self.insert_sql = "INSERT OR REPLACE INTO files VALUES (%s)" % ', '.join('?' * (len(CATALOG_FIELDS) + 2))
+
+    def update_directory(self, dirname, records):
+
+        # records are [path, PatientID, StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID]
+        # for every dicom in the folder. Whatever was in the catalog for the folder is replaced.
+        self.conn.execute("DELETE FROM files WHERE dirname = ?", (dirname,))
+        self.conn.executemany(self.insert_sql, [[record[0], dirname] + [to_text(value) for value in record[1:]]
+                                                for record in records])
+        self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (dirname, self.scan))
+
+        self.nupdated += 1
+        if self.nupdated % COMMIT_EVERY == 0:
+            self.conn.commit()
+
+    def finish(self, base):
+
+        # Remove folders under base that weren't seen in this scan
+        base = base.rstrip('\\/')
+        old = "SELECT dirname FROM dirs WHERE scan < ? AND (dirname = ? OR substr(dirname, 1, ?) IN (?, ?))"
+        args = (self.scan, base, len(base) + 1, base + '/', base + '\\')
+
+        self.conn.execute("DELETE FROM files WHERE dirname IN (%s)" % old, args)
+        self.conn.execute("DELETE FROM dirs WHERE dirname IN (%s)" % old, args)
+        self.conn.commit()
+
+    def query(self, **criteria):
+
+        # Returns [path, PatientID, StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID] for every
+        # file that matches all of the criteria (see QUERY_KEYS, ie patient="123"), by path.
+        # Raises ValueError for an unknown key.
+        where = []
+        args = []
+        for key, value in sorted(criteria.items()):
+            if value is None:
+                continue
+            if key not in QUERY_KEYS:
+                raise ValueError("Unknown query key: %s (use %s)" % (key, ', '.join(sorted(QUERY_KEYS))))
+            where.append("%s = ?" % QUERY_KEYS[key])
+            args.append(value)
+
+        sql = "SELECT path, %s FROM files" % ', '.join(CATALOG_FIELDS)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return [list(row) for row in self.conn.execute(sql + " ORDER BY path", args)]
+
+    def shared_uids(self):
+
+        # Yields (SOPInstanceUID, path) for every file whose SOPInstanceUID is shared with another
+        # file, by UID and then path. The UIDs are grouped by SQLite (with the SOPInstanceUID
+        # index), so the rest of the catalog is never read into memory.
+        sql = ("SELECT SOPInstanceUID, path FROM files WHERE SOPInstanceUID IN "
+               "(SELECT SOPInstanceUID FROM files GROUP BY SOPInstanceUID HAVING COUNT(*) > 1) "
+               "ORDER BY SOPInstanceUID, path")
+        for row in self.conn.execute(sql):
+            yield row
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def read_file_list(filename):
+
+    # Returns the paths in a file list (one per line, as written by dcmquery.py)
+    with open(filename, 'r') as f:
+        return [line.rstrip('\r\n') for line in f if line.strip()]
@@ -0,0 +1,330 @@
+###################################################################################################
+#
+#    Finding duplicate dicoms across a tree
+#
+# -The same study can end up exported into several folders. Every copy is sorted, anonymized and
+# backed up again, and create_mr_db.py only removes repeated rows within a single folder. The
+# purpose of this script is to find every file that is a copy of another one anywhere in the tree,
+# and to report them or replace them with hard links to a single copy.
+#
+# -Files are grouped by SOPInstanceUID (read by the pool, or taken from a catalog made by
+# create_mr_db.py --catalog). Two files with the same UID are only taken to be copies once they
+# pass every check, cheapest first, so most files are never read in full:
+#   size       files of different sizes are different
+#   partial    hash of the first PARTIAL_SIZE bytes (the header and the start of the pixel data)
+#   full       hash of the whole file
+# -Files that are already hard links of each other are the same file and are not read at all.
+# They are told apart by device and inode, where there is an inode (Python 2 on Windows gives 0
+# for every file, so there every name is checked as a file of its own).
+# -Files with the same UID but different content (ie, one of them was anonymized) are reported,
+# but never linked.
+# -With --link, every copy is replaced by a hard link to the first file of its group (by path).
+# The link is made next to the copy and renamed over it, so a copy is never missing.
+#
+# -To test out, type in:
+# python dcmdedup.py -d "Z:\Images\Incoming"
+# python dcmdedup.py -c catalog.db --link
+# -d = directory (can be given more than once)
+# -c = catalog to take the files and UIDs from instead of reading them
+# --link = replace the copies with hard links
+#
+###################################################################################################
+
+import os
+import time
+import errno
+import hashlib
+from functools import partial
+from optparse import OptionParser
+from dcmheader import read_dicom_fields
+from dcmpipeline import walk_directories, stream_directories, DicomSniffer, make_pool, BACKENDS
+from dcmstats import RunStats
+from dcmcatalog import FileCatalog
+from dcmmanifest import CHECKSUM, CHUNK_SIZE
+
+# Bytes hashed by the partial check
+PARTIAL_SIZE = 64 * 1024
+
+# For a single file. Returns [SOPInstanceUID, size, device, inode], or [] if it is not a dicom
+# with a SOPInstanceUID.
+def read_instance(filename, force=False):
+
+    try:
+        sopuid = read_dicom_fields(filename, ['SOPInstanceUID'], force=force)[0]
+    except:
+        return []
+    if not sopuid:
+        return []
+
+    st = os.stat(filename)
+    return [str(sopuid), st.st_size, st.st_dev, st.st_ino]
+
+def stat_instance(filename):
+
+    # Same as read_instance, for a file whose UID is already known. None if it is gone.
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_dev, st.st_ino]
+
+def file_key(item):
+
+    # What tells the files of [filename, size, device, inode] apart. Names with the same key are
+    # hard links of a single file. Without an inode, every name is taken to be a file of its own.
+    return tuple(item[2:]) if item[3] else (item[0],)
+
+def hash_file(filename, size=None):
+
+    # Checksum of the first "size" bytes of a file (all of it if None)
+    h = hashlib.new(CHECKSUM)
+    nleft = size
+    with open(filename, 'rb') as f:
+        while nleft is None or nleft > 0:
+            chunk = f.read(CHUNK_SIZE if nleft is None else min(CHUNK_SIZE, nleft))
+            if not chunk:
+                break
+            h.update(chunk)
+            if nleft is not None:
+                nleft -= len(chunk)
+    return h.hexdigest()
+
+def split_groups(p, groups, func):
+
+    # groups is a list of lists of [filename, size, device, inode]. func is applied to every
+    # file in the pool. Returns the groups, split by the result. Groups that end up with a single
+    # file are left out, and so are files that fail.
+    out = []
+    stream = stream_directories(p, func, ((ind, [item[0] for item in group]) for ind, group in enumerate(groups)))
+    for ind, results, nfailed in stream:
+        split = {}
+        for item, result in zip(groups[ind], results):
+            if result is not None:
+                split.setdefault(result, []).append(item)
+        out.extend(group for group in split.values() if len(group) > 1)
+
+    return out
+
+def find_duplicates(p, instances, stats):
+
+    # instances is a dict of SOPInstanceUID -> list of [filename, size, device, inode].
+    # Returns (duplicates, conflicts). duplicates is a list of groups of names with the same
+    # content, sorted by path (the first one is kept). conflicts is a list of SOPInstanceUIDs
+    # with files that differ.
+
+    # Names of the same file (hard links) only need to be checked once. The first name, by path,
+    # stands in for the others. Name -> every name of the file.
+    linked = {}
+    sopuids = {}
+    nfiles = {}
+    candidates = []
+    for sopuid, items in instances.items():
+        if len(items) < 2:
+            continue
+
+        files = {}
+        for item in sorted(items):
+            files.setdefault(file_key(item), []).append(item)
+        nfiles[sopuid] = len(files)
+
+        by_size = {}
+        for names in files.values():
+            linked[names[0][0]] = names
+            sopuids[names[0][0]] = sopuid
+            by_size.setdefault(names[0][1], []).append(names[0])
+        candidates.extend(group for group in by_size.values() if len(group) > 1)
+
+    with stats.stage('partial'):
+        groups = split_groups(p, candidates, partial(hash_file, size=PARTIAL_SIZE))
+
+    # Files that fit in the partial hash have already been hashed in full
+    with stats.stage('full'):
+        small = [group for group in groups if group[0][1] <= PARTIAL_SIZE]
+        groups = small + split_groups(p, [group for group in groups if group[0][1] > PARTIAL_SIZE], hash_file)
+
+    duplicates = [sorted(item for first in group for item in linked[first[0]]) for group in groups]
+
+    # Hard links of a single file are duplicates that have already been dealt with
+    checked = set(item[0] for group in groups for item in group)
+    for first, names in linked.items():
+        if len(names) > 1 and first not in checked:
+            duplicates.append(names)
+
+    # Every file of a UID has to end up in a single group, or some of them differ
+    grouped = {}
+    for group in groups:
+        grouped.setdefault(sopuids[group[0][0]], []).append(len(group))
+    conflicts = [sopuid for sopuid, n in nfiles.items() if n > 1 and grouped.get(sopuid) != [n]]
+
+    return sorted(duplicates), sorted(conflicts)
+
+def link_duplicate(original, duplicate):
+
+    # Replaces duplicate with a hard link to original. Raises OSError if it can't be done.
+    if not hasattr(os, 'link'):
+        raise OSError(errno.ENOSYS, "Hardlinks are not supported on this platform", duplicate)
+    tmpname = duplicate + '.dedup'
+    os.link(original, tmpname)
+    try:
+        os.rename(tmpname, duplicate)
+    except OSError:
+        os.remove(tmpname)
+        raise
+
+def main():
+    start_time = time.time()
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-d", "--dir",
+                      action="append",
+                      type="string",
+                      dest="directories",
+                      default=[],
+                      help="Directory to look for copies in. Can be given more than once")
+    parser.add_option("-c", "--catalog",
+                      action="store",
+                      type="string",
+                      dest="catalog",
+                      default='',
+                      help="Catalog to take the files and UIDs from (made by create_mr_db.py --catalog) instead of reading them")
+    parser.add_option("--link",
+                      action="store_true",
+                      dest="link",
+                      default=False,
+                      help="Replace every copy with a hard link to the file that is kept")
+    parser.add_option("--stats",
+                      action="store",
+                      type="string",
+                      dest="stats",
+                      default='',
+                      help="File to write run statistics to (one JSON line per folder and a summary)")
+    parser.add_option("--progress",
+                      action="store_true",
+                      dest="progress",
+                      default=False,
+                      help="Show a progress line while running")
+    parser.add_option("--lenient",
+                      action="store_true",
+                      dest="lenient",
+                      default=False,
+                      help="Also read files without the 128 byte preamble if they look like a dicom")
+    parser.add_option("-b", "--backend",
+                      action="store",
+                      type="choice",
+                      choices=BACKENDS,
+                      dest="backend",
+                      default='process',
+                      help="Workers to use: process, thread (for network shares) or hybrid")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=0,
+                      help="Number of workers. Default is to choose from the cores and the speed of the tree")
+    parser.add_option("--walk-threads",
+                      action="store",
+                      type="int",
+                      dest="walk_threads",
+                      default=0,
+                      help="Number of threads listing folders at once (for slow network shares). Default is one")
+    parser.add_option("--exclude",
+                      action="append",
+                      type="string",
+                      dest="exclude",
+                      default=[],
+                      help="Leave out files and folders that match this pattern. Can be given more than once")
+
+    (options, args) = parser.parse_args()
+
+    if bool(options.directories) == bool(options.catalog):
+        parser.error("Either directories (-d) or a catalog (-c) is needed, not both")
+    if options.catalog and not os.path.isfile(options.catalog):
+        parser.error("No catalog %s" % options.catalog)
+
+    stats = RunStats('dcmdedup', options.stats, options.progress, worker_stage='read')
+
+    p, workers = make_pool(options.backend, options.directories, options.workers)
+    print "WORKERS: ", options.backend, "(%s)" % workers
+    stats.info.update(backend=options.backend, workers=workers)
+
+    # SOPInstanceUID -> list of [filename, size, device, inode]
+    instances = {}
+    nrejected = 0
+
+    if options.catalog:
+        # Only the files that share a UID with another one need to be looked at
+        catalog = FileCatalog(options.catalog)
+        for sopuid, filename in catalog.shared_uids():
+            stat = stat_instance(filename)
+            if stat is not None:
+                instances.setdefault(sopuid, []).append([filename] + stat)
+        catalog.close()
+
+    else:
+        # Files that are clearly not dicoms are dropped by the walker
+        sniffer = DicomSniffer(options.lenient, stats)
+
+        # The file of every result is needed, so the filenames of each folder are kept until it comes back
+        filenames = {}
+        def named(walker):
+            for dirname, fullfilenames in walker:
+                filenames[dirname] = fullfilenames
+                yield dirname, fullfilenames
+
+        walker = walk_directories(options.directories, keep=sniffer, exclude=options.exclude, threads=options.walk_threads)
+        stream = stream_directories(p, stats.timed(partial(read_instance, force=options.lenient)), stats.walk(named(walker)))
+        for dirname, results, nfailed in stats.stream(stream):
+            results = stats.directory(dirname, results, nfailed)
+            for filename, result in zip(filenames.pop(dirname), results):
+                if result:
+                    instances.setdefault(result[0], []).append([filename] + result[1:])
+
+        nrejected = sniffer.nrejected
+
+    duplicates, conflicts = find_duplicates(p, instances, stats)
+
+    p.close()
+    p.join()
+
+    # The first file of every group is kept, every other file that isn't already linked to it is a copy
+    ncopies = 0
+    nbytes = 0
+    nlinked = 0
+    failed = []
+    for group in duplicates:
+        original = group[0]
+        for item in group[1:]:
+            if file_key(item) == file_key(original):
+                nlinked += 1
+                continue
+
+            print "DUPLICATE: ", item[0], "->", original[0]
+            ncopies += 1
+            nbytes += item[1]
+
+            if options.link:
+                with stats.stage('link'):
+                    try:
+                        link_duplicate(original[0], item[0])
+                    except OSError as e:
+                        failed.append((item[0], e))
+
+    stats.close()
+
+    for sopuid in conflicts:
+        print "SAME UID, DIFFERENT CONTENT: ", sopuid, ' '.join(item[0] for item in sorted(instances[sopuid]))
+
+    for filename, e in failed:
+        print "FAILED TO LINK: ", filename, e
+
+    print "NON-DICOM FILES SKIPPED: ", nrejected
+    print "DUPLICATE FILES: ", ncopies
+    print "BYTES IN DUPLICATES: ", nbytes
+    print "ALREADY LINKED: ", nlinked
+    if options.link:
+        print "FILES LINKED: ", ncopies - len(failed)
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
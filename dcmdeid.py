@@ -0,0 +1,307 @@
+###################################################################################################
+#
+#    De-identification profiles
+#
+# -dcmanon.py only changes four fields (fields_to_anon). A de-identification profile says what to
+# do with every tag that can identify a patient, which is a few hundred of them (names, dates,
+# UIDs, addresses, private tags, ...). Looking each of them up by name (hasattr/getattr/setattr)
+# would cost hundreds of lookups for every file, whether the tag is there or not, and would still
+# miss the tags inside sequences.
+#
+# -A profile is compiled once (per process) into a dict of tag -> action. Every dataset is then
+# gone through a single time, element by element and into every item of every sequence, and each
+# element only costs a dict lookup. Elements without a rule are never converted from the file.
+#
+# -A profile is a text file with one rule per line, "tag action [value]" (see deid_basic.txt):
+#   (0010,0010)  hash              # Patient's Name
+#   PatientID    hash
+#   (0012,0062)  replace  YES
+#   (60xx,3000)  remove            # Overlay Data, in every overlay group
+#   private      remove            # Every private tag without a rule of its own
+# -The actions are:
+#   keep       leave the element as it is (ie, to keep a private tag)
+#   remove     delete the element (with everything in it, for a sequence)
+#   empty      keep the element, with an empty value
+#   replace    set the value to the rest of the line. Added to the dataset if it isn't there.
+#   hash       a UID is replaced by a new UID made from a keyed hash of it (2.25.<number>), so the
+#              same UID gets the same new UID in every file, on every worker and in every run with
+#              the same salt. Text is replaced by the start of the hash, and anything else is emptied.
+# -Sequences are gone through unless they are removed or emptied. Group lengths (gggg,0000) are
+# removed, since they would be wrong once an element is removed (the file meta one is rewritten).
+#
+# -UidMap keeps the old -> new UID pairs in a file, so a new UID can be traced back to the original.
+# Each worker returns the pairs of its file, and the map is written once per folder.
+#
+###################################################################################################
+
+import os
+import re
+import hmac
+import hashlib
+from dicom.datadict import tag_for_name, dictionaryVR
+from dicom.dataelem import DataElement
+from dicom.sequence import Sequence
+from dicom.tag import Tag
+
+ACTIONS = ['keep', 'remove', 'empty', 'replace', 'hash']
+
+# Rule for every private tag (odd groups) that doesn't have its own
+PRIVATE = 'private'
+
+# UIDs made from a number (see PS3.5 B.2), up to 39 digits
+UID_ROOT = '2.25.'
+
+# Hex digits of the hash that replace a text value (the longest that fits every text VR)
+HASH_DIGITS = 16
+TEXT_VRS = frozenset(['AE', 'AS', 'CS', 'LO', 'LT', 'PN', 'SH', 'ST', 'UT'])
+
+# New UIDs kept by each process, so the UIDs shared by a whole series are only hashed once
+UID_CACHE_SIZE = 10000
+
+# (gggg,eeee), with "xx" as the last two digits of a repeating group (ie, 60xx) and "xxxx" for
+# every element of it
+tag_pattern = re.compile(r'^\(?([0-9a-f]{2})([0-9a-f]{2}|xx),([0-9a-f]{4}|xxxx)\)?$', re.I)
+
+GROUP_LENGTH_RULE = ('remove', None)
+
+DEIDENTIFICATION_METHOD = Tag(0x0012, 0x0063)
+
+_profiles = {}
+_uid_cache = {}
+
+def hash_value(value, salt=''):
+    return hmac.new(salt, value, hashlib.sha256).hexdigest()
+
+def hash_uid(uid, salt=''):
+
+    # The first 128 bits of the hash, as a 2.25 UID
+    key = (salt, uid)
+    new = _uid_cache.get(key)
+    if new is None:
+        if len(_uid_cache) >= UID_CACHE_SIZE:
+            _uid_cache.clear()
+        new = _uid_cache[key] = UID_ROOT + str(int(hash_value(uid, salt)[:32], 16))
+    return new
+
+def hash_text(value, salt=''):
+    return hash_value(value, salt)[:HASH_DIGITS].upper()
+
+class Profile(object):
+
+    def __init__(self, lines, name='profile'):
+
+        # lines is any iterable of the lines of a profile (ie, an open file). Raises ValueError
+        # with the line number for a rule that can't be read.
+        self.name = name
+
+        # Tag -> (action, value)
+        self.rules = {}
+        # First two digits of a repeating group (ie, 0x6000) -> {element (None for all): (action, value)}
+        self.repeating = {}
+        self.private = None
+
+        for lineno, line in enumerate(lines, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            parts = line.split(None, 2)
+            if len(parts) < 2 or parts[1] not in ACTIONS:
+                raise ValueError("%s, line %d: expected a tag and one of %s" % (name, lineno, ', '.join(ACTIONS)))
+            key, action = parts[:2]
+            value = parts[2] if len(parts) > 2 else None
+            if (action == 'replace') != (value is not None):
+                raise ValueError("%s, line %d: replace needs a value, and nothing else takes one" % (name, lineno))
+            rule = (action, value)
+
+            if key == PRIVATE:
+                self.private = rule
+                continue
+
+            match = tag_pattern.match(key)
+            if match:
+                high, low, element = match.groups()
+                if low.lower() == 'xx':
+                    elements = self.repeating.setdefault(int(high, 16) << 8, {})
+                    elements[None if element.lower() == 'xxxx' else int(element, 16)] = rule
+                    continue
+                if element.lower() == 'xxxx':
+                    raise ValueError("%s, line %d: only a repeating group (ie, 60xx) can have every element" % (name, lineno))
+                tag = Tag(int(high + low, 16), int(element, 16))
+            else:
+                tag = tag_for_name(key)
+                if tag is None:
+                    raise ValueError("%s, line %d: unknown tag %s" % (name, lineno, key))
+                tag = Tag(tag)
+
+            self.rules[tag] = rule
+
+        # True if any rule hashes (which is only safe with a secret salt)
+        rules = self.rules.values() + [rule for elements in self.repeating.values() for rule in elements.values()]
+        self.hashes = any(action == 'hash' for action, value in rules + [self.private or GROUP_LENGTH_RULE])
+
+        # What the profile writes to DeidentificationMethod (None if it doesn't), which is how a
+        # file that it has already been applied to is told apart
+        rule = self.rules.get(DEIDENTIFICATION_METHOD)
+        self.method = rule[1] if rule is not None and rule[0] == 'replace' else None
+
+        # Values that are added when the dataset doesn't have them (only known tags, since the VR
+        # has to come from the dictionary, and not the file meta)
+        self.inserts = []
+        for tag, (action, value) in sorted(self.rules.items()):
+            if action == 'replace' and tag.group != 2:
+                try:
+                    self.inserts.append((tag, dictionaryVR(tag), value))
+                except KeyError:
+                    pass
+
+    def rule(self, tag):
+
+        # (action, value) for a tag, or None if it has no rule
+        rule = self.rules.get(tag)
+        if rule is None:
+            # Same as tag.group and tag.elem, without the property calls (this is done for every element)
+            group = tag >> 16
+            elem = tag & 0xffff
+            if elem == 0:
+                return GROUP_LENGTH_RULE if group != 2 else None
+            if group & 1:
+                return self.private
+            if self.repeating:
+                elements = self.repeating.get(group & 0xff00)
+                if elements:
+                    rule = elements.get(elem, elements.get(None))
+        return rule
+
+    def apply(self, dataset, salt='', uids=None):
+
+        # Applies the profile to a dataset read by pydicom (and its file meta), in place.
+        # uids is an optional dict that gets every old -> new UID. Returns the number of elements
+        # that were changed.
+        if uids is None:
+            uids = {}
+
+        nchanged = self._apply(dataset, salt, uids)
+        file_meta = getattr(dataset, 'file_meta', None)
+        if file_meta is not None:
+            nchanged += self._apply(file_meta, salt, uids)
+
+        for tag, VR, value in self.inserts:
+            if tag not in dataset:
+                dataset.add_new(tag, VR, value)
+                nchanged += 1
+
+        return nchanged
+
+    def _apply(self, dataset, salt, uids):
+
+        nchanged = 0
+        for tag in dataset.keys():
+            rule = self.rule(tag)
+            action = rule[0] if rule is not None else 'keep'
+
+            if action == 'remove':
+                del dataset[tag]
+                nchanged += 1
+                continue
+
+            # Raw elements of implicit VR files don't have a VR (and unknown tags aren't in the dictionary)
+            elem = dict.__getitem__(dataset, tag)
+            VR = elem.VR or element_VR(tag) or 'UN'
+
+            # Sequences are gone through unless they are removed or emptied. Nothing else without
+            # a rule is looked at.
+            if VR == 'SQ' and action != 'empty':
+                for item in dataset[tag].value:
+                    nchanged += self._apply(item, salt, uids)
+                continue
+            if action == 'keep':
+                continue
+
+            old = element_value(dataset, tag, elem)
+            if VR == 'SQ' or action == 'empty' or (action == 'hash' and VR not in TEXT_VRS and VR != 'UI'):
+                value = Sequence() if VR == 'SQ' else ''
+            elif action == 'replace':
+                value = rule[1]
+            else:
+                value = self._hash(old, VR, salt, uids)
+
+            # The new value replaces the element, the old one is never converted
+            if old != value:
+                dataset[tag] = DataElement(tag, VR, value)
+                nchanged += 1
+
+        return nchanged
+
+    def _hash(self, old, VR, salt, uids):
+
+        new = []
+        for value in (old if isinstance(old, list) else [old]):
+            if not value:
+                new.append(value)
+            elif VR == 'UI':
+                uids[value] = hash_uid(value, salt)
+                new.append(uids[value])
+            else:
+                new.append(hash_text(value, salt))
+
+        return new if isinstance(old, list) else new[0]
+
+def element_VR(tag):
+    try:
+        return dictionaryVR(tag)
+    except KeyError:
+        return None
+
+def element_value(dataset, tag, elem):
+
+    # The value of an element as text (a list for more than one value), without converting it
+    # from the file. Sequences are the list of their items.
+    if isinstance(elem, tuple) and elem.value is not None:
+        values = elem.value.rstrip('\x00 ').split('\\')
+    else:
+        # Already converted, or not read yet (deferred)
+        value = dataset[tag].value
+        if isinstance(value, Sequence):
+            return list(value)
+        values = value if isinstance(value, list) else [value]
+        values = [(value.encode('utf-8') if isinstance(value, unicode) else str(value)).rstrip('\x00 ')
+                  for value in values]
+
+    return values if len(values) > 1 else values[0]
+
+def load_profile(filename):
+
+    # Profiles are compiled once per process (ie, once in every pool worker)
+    if filename not in _profiles:
+        with open(filename, 'r') as f:
+            _profiles[filename] = Profile(f, os.path.basename(filename))
+    return _profiles[filename]
+
+class UidMap(object):
+
+    # old,new lines, appended, so a resumed run adds to the map. A UID is only written once.
+    def __init__(self, filename, salt=''):
+
+        self.uids = set()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    old, new = line.rstrip('\r\n').split(',')
+                    if not self.uids and hash_uid(old, salt) != new:
+                        raise ValueError("UID map %s was made with a different salt" % filename)
+                    self.uids.add(old)
+
+        self.f = open(filename, 'a')
+
+    def add(self, pairs):
+
+        # pairs is a dict of old -> new UIDs (ie, from a whole folder)
+        lines = ['%s,%s\n' % (old, new) for old, new in sorted(pairs.items()) if old not in self.uids]
+        self.uids.update(pairs)
+        if lines:
+            self.f.writelines(lines)
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
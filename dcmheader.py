@@ -0,0 +1,166 @@
+###################################################################################################
+#
+#    Reading DICOM headers
+#
+# -Shared header reader for dcmsort.py, create_mr_db.py and dcmanon.py. All three scripts only
+# need a handful of header fields, so there is no reason to read (and hold on to) the pixel data.
+#
+# -read_dicom_header parses a file until it passes the highest requested tag or reaches the pixel
+# data, whichever comes first. Large values in between (private blobs, icons, etc.) are skipped
+# over instead of being read into memory.
+# -read_dicom_fields returns only the requested fields, in the order they were requested.
+# -sniff_dicom is a cheap check (a single small read) that is done before a file is handed to
+# pydicom, so thumbnails, reports, etc. never cost a parse attempt.
+# -Both also take the name of a file inside a zip or tar archive (see dcmarchive.py).
+# -The hybrid backend of dcmpipeline.py reads the start of every file in a thread and sends it along
+# with the batch (see set_prefetched). A header that fits in it is parsed from there, and the file
+# is only opened again if it doesn't.
+#
+###################################################################################################
+
+import struct
+from cStringIO import StringIO
+from dicom.datadict import tag_for_name
+from dicom.filereader import read_partial
+from dcmarchive import is_member, read_member, MEMBER_PREFIX_SIZE, ARCHIVE_ERRORS
+
+# Values larger than this (in bytes) are not read into memory. If a deferred value is
+# accessed later, pydicom will go back to the file to read it.
+HEADER_DEFER_SIZE = 1024
+
+PIXEL_DATA_TAG = 0x7fe00010
+
+# Group a dataset without a preamble is expected to start with (identifying information)
+FIRST_GROUP = 0x0008
+
+# Largest length the first element of a preamble-less implicit VR file is expected to have
+MAX_FIRST_LENGTH = 0x10000
+
+# Cache of stop conditions so they are only built once per set of fields in each process
+_stop_conditions = {}
+
+# Start of the files of the batch being run, filename -> (data, complete)
+_prefetched = {}
+
+def set_prefetched(prefetched):
+
+    # prefetched is a dict of filename -> (start of the file, True if that is the whole file)
+    global _prefetched
+    _prefetched = prefetched
+
+def fields_to_tags(fields):
+
+    tags = []
+    for field in fields:
+        tag = tag_for_name(field)
+        if tag is None:
+            raise ValueError("Unknown DICOM field: %s" % field)
+        tags.append(tag)
+
+    return tags
+
+def _at_pixel_data(tag, VR, length):
+    return tag == PIXEL_DATA_TAG
+
+def get_stop_condition(fields):
+
+    # No fields means "everything but the pixels"
+    if not fields:
+        return _at_pixel_data
+
+    key = tuple(fields)
+    if key not in _stop_conditions:
+        max_tag = max(fields_to_tags(fields))
+
+        # Top level tags are stored in ascending order, so once a tag is past the highest
+        # requested tag, nothing else that we need is left in the file.
+        def stop_when(tag, VR, length):
+            return tag > max_tag or tag == PIXEL_DATA_TAG
+
+        _stop_conditions[key] = stop_when
+
+    return _stop_conditions[key]
+
+def read_dicom_header(fp, fields=None, force=False):
+
+    # fp can be a filename or a file-like object (same as dicom.read_file)
+    stop_when = get_stop_condition(fields)
+
+    if isinstance(fp, basestring):
+        if is_member(fp):
+            return read_member_header(fp, stop_when, force)
+
+        # Only used once, since the file can be rewritten after it is read (ie, by dcmanon.py)
+        prefetched = _prefetched.pop(fp, None)
+        if prefetched is not None:
+            dcminf = read_header_prefix(prefetched[0], prefetched[1], stop_when, force)
+            if dcminf is not None:
+                # Deferred values are read from the file itself, same as when it is opened here
+                dcminf.filename = fp
+                dcminf.fileobj_type = open
+                return dcminf
+
+        with open(fp, 'rb') as f:
+            return read_partial(f, stop_when, defer_size=HEADER_DEFER_SIZE, force=force)
+
+    return read_partial(fp, stop_when, defer_size=HEADER_DEFER_SIZE, force=force)
+
+def read_header_prefix(data, complete, stop_when, force=False):
+
+    # Parses a header from the start of a file ("complete" if data is the whole file). Returns None
+    # if the parse reached the end of the data without getting to the stop condition, since the
+    # header is longer (or the data ends in the middle of it).
+    f = StringIO(data)
+    if complete:
+        return read_partial(f, stop_when, defer_size=HEADER_DEFER_SIZE, force=force)
+
+    try:
+        dcminf = read_partial(f, stop_when, defer_size=HEADER_DEFER_SIZE, force=force)
+        if f.tell() < len(data):
+            return dcminf
+    except Exception:
+        pass
+    return None
+
+def read_member_header(filename, stop_when, force=False):
+
+    # Members are parsed from the start of their data. If the parse reached the end of that data
+    # without getting to the stop condition, the header is longer and the whole member is read.
+    data, complete = read_member(filename, MEMBER_PREFIX_SIZE)
+    dcminf = read_header_prefix(data, complete, stop_when, force)
+    if dcminf is None:
+        data, complete = read_member(filename)
+        dcminf = read_header_prefix(data, True, stop_when, force)
+
+    return dcminf
+
+def read_dicom_fields(fp, fields, default=None, force=False):
+
+    # Raises the same exceptions as dicom.read_file if the file is not a dicom
+    dcminf = read_dicom_header(fp, fields, force=force)
+
+    return [getattr(dcminf, field, default) for field in fields]
+
+def sniff_dicom(filename, lenient=False):
+
+    # True if the file has the 128 byte preamble followed by "DICM".
+    # When lenient, files without a preamble are also accepted if they start like an implicit VR
+    # dataset: a tag in FIRST_GROUP followed by a sensible length. These files can only be read
+    # with force=True (pydicom reads them as implicit VR little endian, so nothing else is accepted).
+    try:
+        if is_member(filename):
+            data, complete = read_member(filename, 132)
+        else:
+            with open(filename, 'rb') as f:
+                data = f.read(132)
+    except ARCHIVE_ERRORS:
+        return False
+
+    if data[128:132] == 'DICM':
+        return True
+
+    if not lenient or len(data) < 8:
+        return False
+
+    group, elem, length = struct.unpack('<HHL', data[:8])
+    return group == FIRST_GROUP and length < MAX_FIRST_LENGTH
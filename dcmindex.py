@@ -0,0 +1,147 @@
+###################################################################################################
+#
+#    Keeping a scan index between runs
+#
+# -The purpose of this module is to remember what was read from every file the last time a tree
+# was scanned, so that the next scan only has to read files that are new or have changed.
+#
+# -The index is a SQLite file with one row per file: path, size, modification time, inode and the
+# values that were read from the header (or a flag saying that the file is not a dicom).
+# -On a rescan, each file is stat'ed (or its stat is taken from the folder listing, see
+# walk_directories) and compared with its row. Files that are unchanged are taken
+# from the index, everything else is read again. Rows for files and folders that no longer exist
+# are removed.
+#
+###################################################################################################
+
+import os
+import sqlite3
+from dcmarchive import is_member, split_member
+
+# Number of directories to update between commits
+COMMIT_EVERY = 100
+
+# Converts a value read from the header into the text that is stored in the index. Rows read
+# from files are converted the same way, so they compare equal to the rows from the index.
+def to_text(value):
+
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        # The same as the text in the file for whole numbers ("15", not "15.0")
+        return '%d' % value if value.is_integer() else repr(value)
+    return str(value)
+
+def get_file_stat(filename):
+
+    # Files inside an archive are taken to have changed whenever the archive has
+    if is_member(filename):
+        filename = split_member(filename)[0]
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+class ScanIndex(object):
+
+    def __init__(self, filename, fields):
+
+        self.fields = list(fields)
+        self.conn = sqlite3.connect(filename)
+        self.conn.text_factory = str
+        self.nupdated = 0
+
+        columns = ['path', 'dirname', 'size', 'mtime', 'inode', 'isdicom'] + self.fields
+
+        # If the fields have changed since the index was made, start over
+        existing = [row[1] for row in self.conn.execute("PRAGMA table_info(files)")]
+        if existing and existing != columns:
+            self.conn.execute("DROP TABLE files")
+            self.conn.execute("DROP TABLE IF EXISTS dirs")
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dirname TEXT, "
+                          "size INTEGER, mtime REAL, inode INTEGER, isdicom INTEGER, " +
+                          ', '.join('%s TEXT' % field for field in self.fields) + ")")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_dirname ON files (dirname)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dirs (dirname TEXT PRIMARY KEY, scan INTEGER)")
+
+        # Every scan gets a number, so folders that weren't seen in this scan can be removed
+        self.scan = (self.conn.execute("SELECT MAX(scan) FROM dirs").fetchone()[0] or 0) + 1
+
+        self.insert_sql = "INSERT OR REPLACE INTO files VALUES (%s)" % ', '.join('?' * len(columns))
+
+    def scan_directory(self, dirname, fullfilenames, file_stats=None):
+
+        # Returns (rows, stale). rows are the (dicom) rows taken from the index for files that
+        # haven't changed. stale is a list of (filename, stat) for files that need to be read.
+        # file_stats is an optional dict of filename -> stat from the listing (see walk_tree).
+        # The stats of these files are taken out of it, and a file without one is stat'ed.
+        if file_stats is None:
+            file_stats = {}
+        indexed = {}
+        for row in self.conn.execute("SELECT * FROM files WHERE dirname = ?", (dirname,)):
+            indexed[row[0]] = row
+
+        rows = []
+        stale = []
+        for filename in fullfilenames:
+            stat = file_stats.pop(filename, None)
+            if stat is None:
+                try:
+                    stat = get_file_stat(filename)
+                except OSError:
+                    continue
+
+            row = indexed.pop(filename, None)
+            if row is not None and tuple(row[2:5]) == stat:
+                if row[5]:
+                    rows.append(dict(zip(self.fields, row[6:])))
+            else:
+                stale.append((filename, stat))
+
+        # Anything left over has been deleted
+        if indexed:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in indexed])
+
+        self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (dirname, self.scan))
+
+        return rows, stale
+
+    def update_directory(self, dirname, stale, results):
+
+        # results are the rows read from the stale files ([] if not a dicom), in the same order.
+        # Returns the dicom rows, converted the same way as the rows from the index.
+        rows = []
+        records = []
+        for (filename, stat), result in zip(stale, results):
+            # None means the file failed in the pool, so it is left out and read again next time
+            if result is None:
+                continue
+            if result:
+                values = [to_text(result.get(field)) for field in self.fields]
+                rows.append(dict(zip(self.fields, values)))
+                records.append([filename, dirname] + list(stat) + [1] + values)
+            else:
+                records.append([filename, dirname] + list(stat) + [0] + [None] * len(self.fields))
+
+        self.conn.executemany(self.insert_sql, records)
+
+        self.nupdated += 1
+        if self.nupdated % COMMIT_EVERY == 0:
+            self.conn.commit()
+
+        return rows
+
+    def finish(self, base):
+
+        # Remove folders under base that weren't seen in this scan
+        base = base.rstrip('\\/')
+        old = "SELECT dirname FROM dirs WHERE scan < ? AND (dirname = ? OR substr(dirname, 1, ?) IN (?, ?))"
+        args = (self.scan, base, len(base) + 1, base + '/', base + '\\')
+
+        self.conn.execute("DELETE FROM files WHERE dirname IN (%s)" % old, args)
+        self.conn.execute("DELETE FROM dirs WHERE dirname IN (%s)" % old, args)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,231 @@
+###################################################################################################
+#
+#    Ingesting a DICOM tree in a single pass
+#
+# -The purpose of this script is to do what create_mr_db.py, dcmsort.py and dcmanon.py do when
+# they are run one after the other, but with a single walk of the tree and a single header read
+# of every file.
+#
+# -For every file, the header is read once (up to the last field any of the three tools needs):
+#   catalog     the database row (same fields as create_mr_db.py), taken before anonymizing
+#   anonymize   the new values are patched into the file where it is (same as dcmanon.py)
+#   sort        the IMAGE.SSSS.IIII / DCMXXXX_PROTOCOL destination (same as dcmsort.py)
+# -Once all files in a folder have been read, the database rows are written and the files are
+# moved to their sorted names. Folders are renamed at the end. Moving a file is a rename, so the
+# file itself is only ever written once (by the anonymization).
+#
+# -To test out, type in:
+# python dcmingest.py -d "Z:\Images\Incoming" -f "MRDB_Incoming.csv" -o "Z:\Images\Databases"
+# -d = directory
+# -f = filename of the database (.csv, .parquet or .db)
+# -o = location of the database
+#
+###################################################################################################
+
+import os
+import time
+from functools import partial
+from optparse import OptionParser
+from dcmheader import read_dicom_header
+from dcmpatch import get_raw_elements
+from dcmpipeline import walk_directories, stream_directories, DicomSniffer, make_pool, BACKENDS
+from dcmstats import RunStats
+from dcmoutput import DatabaseWriter
+from dcmindex import to_text
+from create_mr_db import dcmfields, dicominfo_from_header, remove_same_series
+from dcmsort import sortfields, isFolderSorted, planDirectory, planFolderRenames, executePlan
+from dcmanon import fields_to_anon, get_anon_fields, write_anon_fields
+
+# Every field that any of the three steps needs, so the header is only read once
+ingest_fields = []
+for field in dcmfields + sortfields + fields_to_anon:
+    if field not in ingest_fields:
+        ingest_fields.append(field)
+
+# For a single file. item is [filename, (bool_anon, bool_encrypt, bool_digitcheck)].
+# Returns (database row, sort info, whether the file was changed), or None if not a dicom.
+def ingest_file(item, force=False):
+
+    filename = item[0]
+    bool_anon, bool_encrypt, bool_digitcheck = item[1]
+
+    try:
+        dcminf = read_dicom_header(filename, ingest_fields, force=force)
+    except:
+        return None
+
+    # Has to be done before any of the values are looked at
+    raw_elements = get_raw_elements(dcminf, fields_to_anon)
+
+    row = dicominfo_from_header(dcminf)
+    sortinfo = [filename] + [to_text(getattr(dcminf, field, '')) for field in sortfields]
+
+    changed = False
+    if bool_anon:
+        anon_fields = get_anon_fields(dcminf, bool_encrypt, bool_digitcheck)
+        write_anon_fields(filename, dcminf, raw_elements, anon_fields, force)
+        changed = bool(anon_fields)
+
+    return row, sortinfo, changed
+
+def main():
+    start_time = time.time()
+
+    fields = ['pxname','pxid','datestr','acqtstr','studyuid','seriesuid','mrseq','manu','fa','tr','te','ti','nimgs','dir']
+    export = ['pxname','pxid','date','acqt','studyuid','seriesuid','mrseq','manu','fa','tr','te','ti','nimgs','dir']
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-d", "--dir",
+                      action="store",
+                      type="string",
+                      dest="directory",
+                      default=os.getcwd(),
+                      help="Directory file to search through")
+    parser.add_option("-f", "--filename",
+                      action="store",
+                      type="string",
+                      dest="filename",
+                      default='MR_Database.csv',
+                      help="Name of output file (.csv, .parquet or .db)")
+    parser.add_option("-o", "--output",
+                      dest="output",
+                      default=os.getcwd(),
+                      help="Folder to write the output file to")
+    parser.add_option("-u", "--decrypt",
+                      action="store_false",
+                      dest="encrypt",
+                      default=True,
+                      help="Decrypt the dicom fields instead of encrypting them")
+    parser.add_option("-n", "--numbers",
+                      action="store_true",
+                      dest="numbers",
+                      default=False,
+                      help="Check for numbers (0-9) in the field. If numbers exist in field, do not encrypt")
+    parser.add_option("--no-anon",
+                      action="store_false",
+                      dest="anon",
+                      default=True,
+                      help="Don't anonymize the files")
+    parser.add_option("--no-sort",
+                      action="store_false",
+                      dest="sort",
+                      default=True,
+                      help="Don't sort the files")
+    parser.add_option("--stats",
+                      action="store",
+                      type="string",
+                      dest="stats",
+                      default='',
+                      help="File to write run statistics to (one JSON line per folder and a summary)")
+    parser.add_option("--progress",
+                      action="store_true",
+                      dest="progress",
+                      default=False,
+                      help="Show a progress line while running")
+    parser.add_option("--lenient",
+                      action="store_true",
+                      dest="lenient",
+                      default=False,
+                      help="Also read files without the 128 byte preamble if they look like a dicom")
+    parser.add_option("-b", "--backend",
+                      action="store",
+                      type="choice",
+                      choices=BACKENDS,
+                      dest="backend",
+                      default='process',
+                      help="Workers to use: process, thread (for network shares) or hybrid")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=0,
+                      help="Number of workers. Default is to choose from the cores and the speed of the tree")
+
+    (options, args) = parser.parse_args()
+
+    base = options.directory
+    writer = DatabaseWriter(os.path.join(options.output, options.filename), fields, export)
+
+    p, workers = make_pool(options.backend, [base], options.workers)
+    print "WORKERS: ", options.backend, "(%s)" % workers
+
+    stats = RunStats('dcmingest', options.stats, options.progress, worker_stage='ingest')
+    stats.info.update(backend=options.backend, workers=workers)
+
+    # Files that are clearly not dicoms are dropped by the walker. Files without a preamble
+    # are only let through when lenient, and then have to be forced.
+    sniffer = DicomSniffer(options.lenient, stats)
+
+    # Folders that have been previously sorted are still catalogued and anonymized, but not sorted
+    sorted_dirs = set()
+    opt_tuple = (options.anon, options.encrypt, options.numbers)
+
+    def ingest_walker():
+        for dirname, fullfilenames in walk_directories([base], keep=sniffer):
+            if isFolderSorted([os.path.basename(filename) for filename in fullfilenames]):
+                sorted_dirs.add(dirname)
+            yield dirname, [[filename, opt_tuple] for filename in fullfilenames]
+
+    fldrs_to_rename = []
+    failed = []
+    skipped = []
+    nchanged = 0
+
+    walker = stats.walk(ingest_walker())
+    stream = stream_directories(p, stats.timed(partial(ingest_file, force=options.lenient)), walker)
+    for dirname, results, nfailed in stats.stream(stream):
+
+        results = filter(None, stats.directory(dirname, results, nfailed))
+        if nfailed:
+            print "DIRECTORY FAILED TO INGEST: ", dirname
+
+        # If no dicoms, continue
+        if not results:
+            sorted_dirs.discard(dirname)
+            continue
+
+        print "Ingesting ", dirname
+
+        nchanged += sum(1 for row, sortinfo, changed in results if changed)
+
+        rows = remove_same_series([row for row, sortinfo, changed in results])
+        for row in rows:
+            row['dir'] = dirname
+
+        with stats.stage('write'):
+            writer.append(rows)
+
+        if options.sort and dirname not in sorted_dirs:
+            with stats.stage('plan'):
+                plan, fldrs, dir_skipped = planDirectory(dirname, [sortinfo for row, sortinfo, changed in results])
+            with stats.stage('rename'):
+                failed.extend(executePlan(plan))
+            fldrs_to_rename.extend(fldrs)
+            skipped.extend(dir_skipped)
+        sorted_dirs.discard(dirname)
+
+    with stats.stage('write'):
+        writer.close()
+
+    # Leave all folder renaming for the end, once every file in the tree has been moved.
+    with stats.stage('rename'):
+        plan, fldrs_skipped = planFolderRenames(fldrs_to_rename)
+        failed.extend(executePlan(plan))
+    skipped.extend(fldrs_skipped)
+
+    stats.close()
+
+    print "NON-DICOM FILES SKIPPED: ", sniffer.nrejected
+    print "FILES CHANGED: ", nchanged
+
+    for src, dst in skipped:
+        print "SKIPPED (NAME ALREADY TAKEN): ", src, "->", dst
+
+    for step in failed:
+        print "FAILED TO SORT: ", step
+
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
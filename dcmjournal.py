@@ -0,0 +1,188 @@
+###################################################################################################
+#
+#    Journal for resuming long runs
+#
+# -Used by dcmsort.py and dcmanon.py so that a run that dies halfway can be started again without
+# redoing the work that was already finished.
+#
+# -The journal is a text file with one JSON record per line. Records are only ever appended:
+#   start     the tool (and mode) the journal belongs to
+#   dir       a directory that was completely processed (with the folder renames it still needs)
+#   plan      a list of mkdir/rename steps that is about to be applied
+#   step      one step of a plan was applied
+#   end       every step of a plan was applied
+#   folders   the folder renames of all finished directories were applied
+# -On a restart, finished directories are kept in a set, so they can be skipped without being
+# read. Plans that were started but never ended are either rolled forward (the remaining steps are
+# applied) or rolled back (the applied steps are undone), depending on what is asked for.
+#
+###################################################################################################
+
+import os
+import json
+from dcmarchive import is_member
+
+# Paths are byte strings, and not always utf-8. They are written as latin-1 so that any path
+# comes back exactly as it was.
+def to_bytes(value):
+
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [to_bytes(x) for x in value]
+    if isinstance(value, dict):
+        return dict((to_bytes(k), to_bytes(v)) for k, v in value.items())
+    return value
+
+class Journal(object):
+
+    def __init__(self, filename, key):
+
+        # key says what the journal is for (ie, "dcmanon encrypt"). A journal can't be used
+        # for anything else, since its finished directories would be wrong.
+        self.filename = filename
+        self.done = set()
+        self.folders = []
+        self.plans = {}
+        self.nplans = 0
+
+        journal_key = None
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        record = to_bytes(json.loads(line))
+                    except ValueError:
+                        # Last line of a run that died while writing it
+                        continue
+                    journal_key = self.load(record, journal_key)
+
+        if journal_key is not None and journal_key != key:
+            raise ValueError("Journal %s is for \"%s\", not \"%s\"" % (filename, journal_key, key))
+
+        self.f = open(filename, 'a')
+        if journal_key is None:
+            self.write({'op': 'start', 'key': key})
+
+    def load(self, record, key):
+
+        op = record['op']
+        if op == 'start':
+            key = record['key']
+        elif op == 'dir':
+            self.done.add(record['path'])
+            self.folders.extend(tuple(fldr) for fldr in record.get('folders', []))
+        elif op == 'plan':
+            self.plans[record['id']] = [[tuple(step) for step in record['steps']], set(), record['kind']]
+            self.nplans = max(self.nplans, record['id'] + 1)
+        elif op == 'step':
+            self.plans[record['id']][1].add(record['step'])
+        elif op == 'end':
+            del self.plans[record['id']]
+        elif op == 'folders':
+            self.folders = []
+
+        return key
+
+    def write(self, record):
+        self.f.write(json.dumps(record, encoding='latin-1') + '\n')
+        self.f.flush()
+
+    def __contains__(self, dirname):
+        return dirname in self.done
+
+    def mark_done(self, dirname, folders=()):
+        self.done.add(dirname)
+        self.folders.extend(folders)
+        self.write({'op': 'dir', 'path': dirname, 'folders': list(folders)})
+
+    def begin_plan(self, plan, kind='files'):
+        planid = self.nplans
+        self.nplans += 1
+        self.write({'op': 'plan', 'id': planid, 'kind': kind, 'steps': plan})
+        return planid
+
+    def step_done(self, planid, ind):
+        self.write({'op': 'step', 'id': planid, 'step': ind})
+
+    def end_plan(self, planid, kind='files'):
+        self.write({'op': 'end', 'id': planid})
+        if kind == 'folders':
+            self.folders = []
+            self.write({'op': 'folders'})
+
+    def recover(self, rollback=False, link=None):
+
+        # Finishes (or undoes) every plan that was started but never ended.
+        # "link" is the function of (src, dst) used to redo link steps.
+        # Returns the steps that couldn't be finished (or undone).
+        failed = []
+        for planid in sorted(self.plans):
+            plan, applied, kind = self.plans[planid]
+            if rollback:
+                failed.extend(undo_steps(plan, applied))
+            else:
+                failed.extend(redo_steps(plan, applied, link))
+            self.end_plan(planid, kind if not rollback else 'files')
+
+        self.plans = {}
+        return failed
+
+    def close(self):
+        self.f.close()
+
+def redo_steps(plan, applied, link=None):
+
+    # A rename is applied if its source exists and its destination doesn't. If it is the other
+    # way around, it was applied before the journal got to record it. A link is applied if its
+    # destination doesn't exist.
+    failed = []
+    for ind, step in enumerate(plan):
+        if ind in applied:
+            continue
+        try:
+            if step[0] == 'mkdir':
+                if not os.path.isdir(step[1]):
+                    os.mkdir(step[1])
+            elif step[0] == 'makedirs':
+                if not os.path.isdir(step[1]):
+                    os.makedirs(step[1])
+            elif step[0] == 'link':
+                if os.path.exists(step[2]):
+                    continue
+                if link is None or not (is_member(step[1]) or os.path.exists(step[1])):
+                    failed.append(step)
+                else:
+                    link(step[1], step[2])
+            elif os.path.exists(step[1]) and not os.path.exists(step[2]):
+                os.rename(step[1], step[2])
+            elif not (os.path.exists(step[2]) and not os.path.exists(step[1])):
+                failed.append(step)
+        except (OSError, IOError):
+            failed.append(step)
+
+    return failed
+
+def undo_steps(plan, applied):
+
+    # Steps are undone last to first. A step that wasn't recorded is undone too if the files
+    # show that it happened.
+    failed = []
+    for ind in reversed(range(len(plan))):
+        step = plan[ind]
+        try:
+            if step[0] in ('mkdir', 'makedirs'):
+                if os.path.isdir(step[1]) and not os.listdir(step[1]):
+                    os.rmdir(step[1])
+            elif step[0] == 'link':
+                # Links are only made where nothing existed, so whatever is there can go
+                if os.path.exists(step[2]):
+                    os.remove(step[2])
+            elif os.path.exists(step[2]) and not os.path.exists(step[1]):
+                os.rename(step[2], step[1])
+            elif ind in applied:
+                failed.append(step)
+        except OSError:
+            failed.append(step)
+
+    return failed
@@ -0,0 +1,165 @@
+###################################################################################################
+#
+#    Checksum manifests
+#
+# -Used by dcmsort.py and dcmanon.py to write down where every file went, and by dcmverify.py to
+# check afterwards that nothing was lost or damaged.
+#
+# -A manifest is a text file with one JSON record per line:
+#   file      src and dst path, size of dst, checksum of the pixel data
+#   folder    a folder that was renamed after its files were written down (dst paths under it
+#             are moved along when the manifest is read)
+# -The checksum only covers the pixel data (everything from the PixelData element to the end of the
+# file), since that is the part no tool is supposed to change. It is worked out by the workers
+# while they have the file open anyway: the header is parsed up to the pixel data, and the rest of
+# the file is hashed as it is read. A file that a tool has just written is hashed from the dataset
+# it wrote (see dataset_checksum), so it doesn't have to be read back.
+#
+###################################################################################################
+
+import os
+import json
+import hashlib
+from cStringIO import StringIO
+from dicom.charset import default_encoding
+from dicom.filebase import DicomFileLike
+from dicom.filewriter import write_data_element
+from dcmheader import read_dicom_header, PIXEL_DATA_TAG
+from dcmarchive import is_member, read_member
+from dcmjournal import to_bytes
+
+CHECKSUM = 'md5'
+
+# Bytes hashed at a time
+CHUNK_SIZE = 1024 * 1024
+
+def hash_rest(f):
+
+    # Returns (checksum, position of the end) of everything from the current position of f
+    h = hashlib.new(CHECKSUM)
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h.hexdigest(), f.tell()
+
+def read_with_checksum(filename, force=False):
+
+    # Returns (dataset, size, checksum). The whole header is read (up to the pixel data), so
+    # every field is in the dataset.
+    if is_member(filename):
+        data, complete = read_member(filename)
+        f = StringIO(data)
+    else:
+        f = open(filename, 'rb')
+
+    try:
+        dcminf = read_dicom_header(f, None, force=force)
+        checksum, size = hash_rest(f)
+    finally:
+        f.close()
+
+    return dcminf, size, checksum
+
+def dataset_checksum(dataset):
+
+    # Checksum of what dicom.write_file writes for a dataset from the pixel data to the end, which
+    # is the same as read_with_checksum gives for the file it was written to
+    f = DicomFileLike(StringIO())
+    f.is_implicit_VR = dataset.is_implicit_VR
+    f.is_little_endian = dataset.is_little_endian
+    encoding = dataset.get('SpecificCharacterSet', default_encoding)
+    for tag in sorted(dataset.keys()):
+        if tag >= PIXEL_DATA_TAG:
+            write_data_element(f, dataset[tag], encoding)
+    return hashlib.new(CHECKSUM, f.parent.getvalue()).hexdigest()
+
+def file_checksum(filename, force=False):
+
+    # Returns (size, checksum) of a file, or None if it can't be read as a dicom
+    try:
+        dcminf, size, checksum = read_with_checksum(filename, force)
+    except:
+        return None
+    return size, checksum
+
+class ManifestWriter(object):
+
+    # Records are appended, the same as a journal, so a resumed run adds to the manifest
+    def __init__(self, filename):
+        self.f = open(filename, 'a')
+
+    def write(self, record):
+        self.f.write(json.dumps(record, encoding='latin-1') + '\n')
+
+    def add_file(self, src, dst, size, checksum):
+        self.write({'op': 'file', 'src': src, 'dst': dst, 'size': size, 'checksum': checksum})
+
+    def add_folder(self, src, dst):
+        self.write({'op': 'folder', 'src': src, 'dst': dst})
+
+    def close(self):
+        self.f.close()
+
+def final_folder(dirname, renames, cache):
+
+    # Where a folder ended up after every folder rename. Folders are only ever renamed within
+    # their parent, so it is the (final) parent joined with the new name.
+    if dirname in cache:
+        return cache[dirname]
+
+    parent, name = os.path.split(dirname)
+    if dirname in renames:
+        name = os.path.basename(renames[dirname])
+    if parent and parent != dirname:
+        final = os.path.join(final_folder(parent, renames, cache), name)
+    else:
+        final = dirname
+
+    cache[dirname] = final
+    return final
+
+def read_manifest(filename):
+
+    # Returns the file records (dicts with src, dst, size and checksum) with their dst moved by
+    # every folder rename. If a src shows up more than once, the last record wins.
+    files = {}
+    renames = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                record = to_bytes(json.loads(line))
+            except ValueError:
+                # Last line of a run that died while writing it
+                continue
+            if record['op'] == 'file':
+                files[record['src']] = record
+            else:
+                renames[record['src']] = record['dst']
+
+    if renames:
+        cache = {}
+        for record in files.values():
+            dirname, name = os.path.split(record['dst'])
+            record['dst'] = os.path.join(final_folder(dirname, renames, cache), name)
+
+    return files.values()
+
+def final_names(plan):
+
+    # Follows the renames of a plan (which can go through a temporary name) to the name each
+    # file ends up with. Returns a dict of original name -> final name (links included).
+    final = {}
+    current = {}
+    for step in plan:
+        if step[0] == 'rename':
+            src = current.pop(step[1], step[1])
+            current[step[2]] = src
+        elif step[0] == 'link':
+            final[step[1]] = step[2]
+
+    for dst, src in current.items():
+        final[src] = dst
+
+    return final
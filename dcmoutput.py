@@ -0,0 +1,139 @@
+###################################################################################################
+#
+#    Writing the MR database
+#
+# -The purpose of this module is to write the rows from create_mr_db.py as they come in, without
+# keeping the whole database in memory. Rows are collected into batches of a fixed size and each
+# batch is written out as a single DataFrame.
+#
+# -The format is chosen from the extension of the output file:
+#   .csv              appended to the file (a header is only written if the file is new)
+#   .parquet          written with pyarrow (needs "pip install pyarrow")
+#   .db / .sqlite     appended to the "mrdb" table, indexed on patient/study/series
+#
+###################################################################################################
+
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from dcmindex import to_text
+
+# Number of rows in each batch that is written out
+BATCHSIZE = 10000
+
+# Name of the table for SQLite outputs
+TABLE = 'mrdb'
+
+def get_format(filename):
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    elif ext in ('.parquet', '.pq'):
+        return 'parquet'
+    elif ext in ('.db', '.sqlite', '.sqlite3'):
+        return 'sqlite'
+
+    raise ValueError("Unknown output format for %s (use .csv, .parquet or .db)" % filename)
+
+# Failsafe in case the date or acquisition time doesn't exist. For some reason, this is actually a thing.
+# Works on whole columns instead of a lambda for each row.
+def add_date_columns(df):
+
+    datestr = df['datestr'].fillna('').astype(str)
+    date = datestr.str[0:4] + '-' + datestr.str[4:6] + '-' + datestr.str[6:8]
+    df['date'] = np.where(datestr.str.len() >= 8, date, '1900-00-00')
+
+    acqtstr = df['acqtstr'].fillna('').astype(str)
+    acqt = acqtstr.str[0:2] + ':' + acqtstr.str[2:4] + ':' + acqtstr.str[4:6]
+    df['acqt'] = np.where(acqtstr.str.len() >= 6, acqt, '00:00:00')
+
+    return df
+
+class DatabaseWriter(object):
+
+    def __init__(self, filename, columns, export, batchsize=BATCHSIZE):
+
+        # columns are the keys of the rows, export are the columns that are written out
+        self.filename = filename
+        self.format = get_format(filename)
+        self.columns = columns
+        self.export = export
+        self.batchsize = batchsize
+        self.rows = []
+        self.nrows = 0
+
+        self.parquet = None
+        self.conn = None
+
+        if self.format == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema([(column, pyarrow.float64() if column == 'nimgs'
+                                           else pyarrow.string()) for column in export])
+        elif self.format == 'sqlite':
+            self.conn = sqlite3.connect(filename)
+            self.conn.text_factory = str
+
+    def append(self, rows):
+
+        for row in rows:
+            values = []
+            for column in self.columns:
+                value = row.get(column)
+                if column != 'nimgs':
+                    value = to_text(value)
+                values.append(value)
+            self.rows.append(values)
+
+        if len(self.rows) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+
+        if not self.rows:
+            return
+
+        df = pd.DataFrame(self.rows, columns=self.columns)
+        df = add_date_columns(df)[self.export]
+        self.rows = []
+
+        if self.format == 'csv':
+            # Outputs are always appended to the csvfile. Nothing is ever overwritten.
+            header = not os.path.isfile(self.filename) or os.path.getsize(self.filename) == 0
+            with open(self.filename, 'a') as f:
+                df.to_csv(f, sep=',', header=header, index=False)
+
+        elif self.format == 'parquet':
+            # Every column is stored as text (except nimgs) so all batches have the same schema
+            df['nimgs'] = df['nimgs'].astype(float)
+            arrays = [self.pyarrow.array(df[field.name].tolist(), type=field.type, from_pandas=True)
+                      for field in self.schema]
+            table = self.pyarrow.Table.from_arrays(arrays, schema=self.schema)
+            if self.parquet is None:
+                self.parquet = self.pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+            self.parquet.write_table(table)
+
+        else:
+            df.to_sql(TABLE, self.conn, if_exists='append', index=False)
+            self.conn.commit()
+
+        self.nrows += len(df)
+
+    def close(self):
+
+        self.flush()
+
+        if self.parquet is not None:
+            self.parquet.close()
+
+        if self.conn is not None:
+            # The table is only made by the first rows written (if there were none, there is nothing to index)
+            if self.nrows:
+                self.conn.execute("CREATE INDEX IF NOT EXISTS %s_patient ON %s (pxid)" % (TABLE, TABLE))
+                self.conn.execute("CREATE INDEX IF NOT EXISTS %s_study ON %s (studyuid)" % (TABLE, TABLE))
+                self.conn.execute("CREATE INDEX IF NOT EXISTS %s_series ON %s (seriesuid)" % (TABLE, TABLE))
+            self.conn.commit()
+            self.conn.close()
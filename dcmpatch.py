@@ -0,0 +1,163 @@
+###################################################################################################
+#
+#    Patching DICOM header values
+#
+# -The purpose of this module is to change a few header values without re-writing the whole file
+# through pydicom (which reads, converts and writes back every element, pixel data included).
+#
+# -If the new value has the same (padded) length as the old one, only the bytes of the value are
+# overwritten in place.
+# -If the length changes, the file is spliced instead: the bytes before and after each changed
+# element are copied as-is, and only the element length and value are replaced. Nothing is parsed.
+# -patch_dicom_file returns False when neither is safe (deflated files, group lengths that would
+# need to change, values too long for the element). The caller should then do a full rewrite.
+# -A spliced (or rewritten) file is written next to the original (see temp_name) and renamed over
+# it. If a run is stopped in between, recover_temp_file cleans up what is left the next time the
+# folder is walked.
+#
+###################################################################################################
+
+import os
+import ctypes
+import shutil
+import struct
+import dicom
+from dicom.datadict import tag_for_name
+from dicom.tag import Tag
+from dicom.valuerep import extra_length_VRs
+
+# Largest value that fits in the 2 byte length of an explicit VR element
+SHORT_LENGTH_MAX = 0xffff
+
+# Added to the name of a file while it is being rewritten
+TEMP_SUFFIX = '.dcmpatch.tmp'
+
+# Flags of MoveFileEx (Windows)
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+def _has_long_length(raw):
+    return raw.is_implicit_VR or raw.VR in extra_length_VRs
+
+def get_raw_elements(dcminf, fields):
+
+    # Returns {field: RawDataElement} with the location of each field in the file.
+    # This has to be called BEFORE the values are accessed, since pydicom replaces the raw
+    # element (and its location) with a converted one the first time the value is read.
+    raw_elements = {}
+    for field in fields:
+        tag = Tag(tag_for_name(field))
+        if tag not in dcminf:
+            continue
+        raw = dcminf.get_item(tag)
+        if isinstance(raw, tuple):
+            raw_elements[field] = raw
+
+    return raw_elements
+
+def pad_value(value):
+
+    # DICOM values are padded with a space to an even length
+    if len(value) % 2:
+        value += ' '
+    return value
+
+def _can_splice(dcminf, raw_elements, new_values):
+
+    for field in new_values:
+        raw = raw_elements[field]
+
+        if raw.length == 0xffffffffL:
+            return False
+
+        # A group length element would have to be updated as well
+        if Tag(raw.tag.group, 0) in dcminf:
+            return False
+
+        if not _has_long_length(raw) and len(pad_value(new_values[field])) > SHORT_LENGTH_MAX:
+            return False
+
+    return True
+
+def temp_name(filename):
+    return filename + TEMP_SUFFIX
+
+def recover_temp_file(filename):
+
+    # Returns True if filename is the temporary file of a rewrite that was stopped, after it has
+    # been removed. The original is only ever replaced in a single step (see _replace_file), so
+    # it is still there, and the temporary file can be half written.
+    if not filename.endswith(TEMP_SUFFIX):
+        return False
+
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+    return True
+
+def _replace_file(src, dst):
+
+    # os.rename won't overwrite an existing file on Windows. MoveFileEx replaces it in a single
+    # step instead, so dst is never missing (removing it first would lose the file if the run
+    # was stopped in between).
+    if os.name == 'nt':
+        kernel32 = ctypes.windll.kernel32
+        move = kernel32.MoveFileExW if isinstance(src, unicode) else kernel32.MoveFileExA
+        if not move(src, dst, MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+        return
+
+    os.rename(src, dst)
+
+def patch_dicom_file(filename, dcminf, raw_elements, new_values):
+
+    # dcminf is the dataset that was read from filename (header only is fine).
+    # new_values is {field: new string value}. Returns True if the file was patched.
+
+    # The locations of deflated elements are in the uncompressed data, not in the file
+    if dcminf.file_meta.get('TransferSyntaxUID') == dicom.UID.DeflatedExplicitVRLittleEndian:
+        return False
+
+    for field in new_values:
+        if field not in raw_elements:
+            return False
+
+    patches = [(raw_elements[field], pad_value(new_values[field])) for field in new_values]
+    patches.sort(key=lambda patch: patch[0].value_tell)
+
+    # Same lengths: overwrite the values in place
+    if all(len(value) == raw.length for raw, value in patches):
+        with open(filename, 'r+b') as f:
+            for raw, value in patches:
+                f.seek(raw.value_tell)
+                f.write(value)
+        return True
+
+    if not _can_splice(dcminf, raw_elements, new_values):
+        return False
+
+    tmpname = temp_name(filename)
+    with open(filename, 'rb') as src:
+        with open(tmpname, 'wb') as dst:
+            for raw, value in patches:
+
+                endian = '<' if raw.is_little_endian else '>'
+                if _has_long_length(raw):
+                    length = struct.pack(endian + 'L', len(value))
+                else:
+                    length = struct.pack(endian + 'H', len(value))
+
+                # Copy everything up to the length of the element
+                nbytes = raw.value_tell - len(length) - src.tell()
+                dst.write(src.read(nbytes))
+
+                dst.write(length)
+                dst.write(value)
+                src.seek(raw.value_tell + raw.length)
+
+            shutil.copyfileobj(src, dst)
+
+    _replace_file(tmpname, filename)
+
+    return True
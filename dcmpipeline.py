@@ -0,0 +1,522 @@
+###################################################################################################
+#
+#    Streaming files through a worker pool
+#
+# -Shared by dcmsort.py, create_mr_db.py and dcmanon.py. Instead of calling Pool.map once per
+# directory (and waiting for every directory to finish before starting the next one), files from
+# the whole tree are sent to the pool in small batches as soon as the walker finds them.
+#
+# -Only a limited number of batches are in flight at any time. When the limit is reached, the walk
+# waits for results to come back, so memory stays flat no matter how large the tree is.
+#
+# -Results are grouped back by directory. A directory is only handed back once ALL of its files
+# have been processed, so directory level steps (sorting, renaming) can safely run on it.
+#
+# -Files that are clearly not dicoms can be dropped by the walker (see DicomSniffer), before
+# anything is sent to the pool.
+# -zip and tar archives can be walked as if they were folders (see dcmarchive.py).
+# -On a share where listing a folder is slow, the walk itself can be the bottleneck. Folders can
+# be listed by several threads at once (see walk_tree), and the walk can be limited to a depth
+# and to file name patterns.
+#
+# -The pool can be one of three backends (see make_pool):
+#   process   a process pool. Best when parsing (CPU) is the bottleneck.
+#   thread    a thread pool. Nothing is pickled, best when waiting on a network share is the
+#             bottleneck.
+#   hybrid    threads read the start of every file, then a process pool parses it from what
+#             was read (see set_prefetched in dcmheader.py).
+# -Unless given, the number of workers is worked out from the number of cores and the time it
+# takes to open and read a few files from the tree, compared with the time it takes to parse them.
+#
+###################################################################################################
+
+import os
+import math
+import fnmatch
+import posixpath
+import time
+import Queue
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from dcmheader import sniff_dicom, read_dicom_header, set_prefetched
+from dcmarchive import is_archive, walk_archive, split_member, ARCHIVE_ERRORS
+
+# scandir lists a folder together with the type of everything in it (Python 3.5+, or the
+# scandir package). Without it, every entry is stat'ed to find the folders.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Number of files sent to a worker at a time
+CHUNKSIZE = 16
+
+# Maximum number of batches waiting on the pool
+MAX_PENDING = 64
+
+# Folders being listed at a time, per listing thread
+MAX_LISTINGS = 4
+
+BACKENDS = ['process', 'thread', 'hybrid']
+
+# Most threads that are ever started, however slow the share is
+MAX_THREADS = 64
+
+# Most processes that are ever started per core (each one holds a full interpreter, so they cost
+# much more than threads)
+MAX_PROCESSES_PER_CPU = 4
+
+# Number of files that are opened to measure the latency of the tree
+NSAMPLE = 8
+
+# Most files and folders that are looked at while measuring, so a tree with few dicoms (or none)
+# doesn't get walked before the run starts
+MAX_SAMPLE_FILES = 256
+MAX_SAMPLE_DIRS = 32
+
+# Number of bytes the hybrid backend reads from every file before it is parsed (enough for
+# the header of most files)
+PREFETCH_SIZE = 64 * 1024
+
+# Runs in the worker. Exceptions are caught here because the pool would otherwise never
+# call back for the batch, and the walk would wait forever.
+def _run_batch(func, batch):
+
+    out = []
+    for dirid, ind, item in batch:
+        try:
+            out.append((dirid, ind, func(item), False))
+        except:
+            out.append((dirid, ind, None, True))
+
+    return out
+
+# Used as the "keep" function of walk_directories. Counts the files that were dropped.
+class DicomSniffer(object):
+
+    def __init__(self, lenient=False, stats=None):
+        self.lenient = lenient
+        self.stats = stats
+        self.nrejected = 0
+
+    def __call__(self, filename):
+        if sniff_dicom(filename, self.lenient):
+            return True
+
+        self.nrejected += 1
+        if self.stats is not None:
+            self.stats.add('nondicom')
+        return False
+
+def list_directory(dirname, stat=False):
+
+    # Returns (names of subfolders that can be walked into, names of everything else, stats), or
+    # None if the folder can't be listed. With scandir, the type of every entry comes with the
+    # listing and nothing has to be stat'ed. Same as os.walk, a link to a folder is not walked
+    # into and is not a file either.
+    # With "stat", stats is a dict of file name -> (size, modification time, inode) from the
+    # listing (on Windows it comes with it, elsewhere it costs the same as os.stat). It is empty
+    # without scandir, or for a file that is gone before it is stat'ed.
+    try:
+        if scandir is not None:
+            subdirs = []
+            filenames = []
+            stats = {}
+            for entry in scandir(dirname):
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                else:
+                    filenames.append(entry.name)
+                    if stat:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        stats[entry.name] = (st.st_size, st.st_mtime, st.st_ino)
+            return subdirs, filenames, stats
+
+        names = os.listdir(dirname)
+    except OSError:
+        return None
+
+    subdirs = []
+    filenames = []
+    for name in names:
+        fullname = os.path.join(dirname, name)
+        if os.path.isdir(fullname):
+            if not os.path.islink(fullname):
+                subdirs.append(name)
+        else:
+            filenames.append(name)
+    return subdirs, filenames, {}
+
+# Runs in a listing thread. Anything unexpected counts as a folder that can't be listed, since
+# the walk would otherwise wait for it forever.
+def _list_directory(dirname, level, stat=False):
+    try:
+        return dirname, level, list_directory(dirname, stat)
+    except:
+        return dirname, level, None
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def walk_tree(bases, depth=None, exclude=None, threads=0, file_stats=None):
+
+    # Yields (dirname, names of everything in it that isn't a folder) for every folder under
+    # every base, down to "depth" levels below the base (0 is just the base, None is no limit).
+    # Folders and files that match an "exclude" pattern are left out, and an excluded folder
+    # isn't walked into.
+    # With more than one thread, many folders are listed at once and folders are yielded as
+    # soon as they are listed (so not in the same order as os.walk).
+    # "file_stats" is an optional dict that gets full filename -> (size, modification time, inode)
+    # for the files that are yielded, when the listing has it (see list_directory). The caller
+    # takes them out as it goes.
+    exclude = exclude or []
+    stat = file_stats is not None
+
+    def entries(dirname, level, listing):
+        subdirs, filenames, stats = listing
+        if exclude:
+            subdirs = [name for name in subdirs if not _matches(name, exclude)]
+            filenames = [name for name in filenames if not _matches(name, exclude)]
+        if depth is not None and level >= depth:
+            subdirs = []
+        if stats:
+            for name in filenames:
+                if name in stats:
+                    file_stats[os.path.join(dirname, name)] = stats[name]
+        return [(os.path.join(dirname, name), level + 1) for name in subdirs], filenames
+
+    if threads <= 1:
+        # Top down, the same as os.walk
+        todo = [(base, 0) for base in reversed(bases)]
+        while todo:
+            dirname, level = todo.pop()
+            listing = list_directory(dirname, stat)
+            if listing is None:
+                continue
+            subdirs, filenames = entries(dirname, level, listing)
+            yield dirname, filenames
+            todo.extend(reversed(subdirs))
+        return
+
+    # Only a few listings are in flight at a time, so a slow consumer doesn't end up with the
+    # whole tree in memory
+    listed = Queue.Queue()
+    pool = ThreadPool(threads)
+    try:
+        todo = [(base, 0) for base in reversed(bases)]
+        npending = 0
+        while todo or npending:
+            while todo and npending < MAX_LISTINGS * threads:
+                pool.apply_async(_list_directory, todo.pop() + (stat,), callback=listed.put)
+                npending += 1
+
+            dirname, level, listing = listed.get()
+            npending -= 1
+            if listing is None:
+                continue
+            subdirs, filenames = entries(dirname, level, listing)
+            todo.extend(reversed(subdirs))
+            yield dirname, filenames
+    finally:
+        pool.terminate()
+
+def walk_directories(bases, skip=None, keep=None, done=None, archives=False, recursive=True,
+                     depth=None, include=None, exclude=None, threads=0, file_stats=None):
+
+    # Yields (dirname, full filenames) for every directory under every base.
+    # "skip" is an optional function of the filenames, if it returns True the folder is skipped.
+    # "keep" is an optional function of each full filename, if it returns False the file is left out.
+    # "done" is an optional set (or Journal) of folders that are skipped without looking at them.
+    # With "archives", every folder inside a zip or tar file is also yielded, after the folder
+    # the archive is in (see dcmarchive.py).
+    # Without "recursive", only the bases themselves are listed (same as a depth of 0).
+    # "include" and "exclude" are lists of patterns (ie, "*.dcm"). Only files that match an
+    # "include" pattern are kept. "depth", "exclude", "threads" and "file_stats" are the same as
+    # walk_tree (the stats of files that aren't yielded are taken back out).
+    if not recursive:
+        depth = 0
+    for dirname, filenames in walk_tree(bases, depth, exclude, threads, file_stats):
+        listed = filenames
+        if archives:
+            archivenames = [os.path.join(dirname, filename) for filename in filenames if is_archive(filename)]
+            filenames = [filename for filename in filenames if not is_archive(filename)]
+        else:
+            archivenames = []
+        if include:
+            filenames = [filename for filename in filenames if _matches(filename, include)]
+
+        walked = not (done is not None and dirname in done) and not (skip is not None and skip(filenames))
+        fullfilenames = []
+        if walked:
+            fullfilenames = [os.path.join(dirname, filename) for filename in filenames]
+            if keep is not None:
+                fullfilenames = filter(keep, fullfilenames)
+
+        if file_stats and len(fullfilenames) < len(listed):
+            kept = set(fullfilenames)
+            for filename in listed:
+                filename = os.path.join(dirname, filename)
+                if filename not in kept:
+                    file_stats.pop(filename, None)
+
+        if walked:
+            yield dirname, fullfilenames
+
+        for archivename in archivenames:
+            for out in walk_archive_directories(archivename, skip, keep, done):
+                yield out
+
+def walk_file_list(filenames, skip=None, keep=None, done=None):
+
+    # Same as walk_directories, for a list of files (ie, written by dcmquery.py) instead of a
+    # tree. Files are grouped by folder, in the order each folder first shows up, and only the
+    # files in the list are yielded (and given to "skip").
+    dirs = {}
+    order = []
+    for filename in filenames:
+        dirname = os.path.dirname(filename)
+        if dirname not in dirs:
+            dirs[dirname] = []
+            order.append(dirname)
+        dirs[dirname].append(filename)
+
+    for dirname in order:
+        fullfilenames = dirs.pop(dirname)
+        if done is not None and dirname in done:
+            continue
+        if skip is not None and skip([os.path.basename(filename) for filename in fullfilenames]):
+            continue
+        if keep is not None:
+            fullfilenames = filter(keep, fullfilenames)
+        yield dirname, fullfilenames
+
+def walk_archive_directories(archivename, skip=None, keep=None, done=None):
+
+    # Same as walk_directories, for the folders inside an archive. An archive that can't be
+    # read is left out (the same as a folder that can't be listed).
+    try:
+        for dirname, membernames in walk_archive(archivename):
+            if done is not None and dirname in done:
+                continue
+            if skip is not None and skip([posixpath.basename(split_member(name)[1]) for name in membernames]):
+                continue
+            if keep is not None:
+                membernames = filter(keep, membernames)
+            yield dirname, membernames
+    except ARCHIVE_ERRORS:
+        return
+
+def stream_directories(pool, func, walker, chunksize=CHUNKSIZE, max_pending=MAX_PENDING):
+
+    # walker yields (dirname, items). func is applied to every item in the pool.
+    # Yields (dirname, results, nfailed) once every item in dirname has been processed.
+    # results are in the same order as the items.
+
+    done = Queue.Queue()
+
+    # Directory id -> [dirname, results, number of items not yet processed, number of items failed]
+    # (an id is used in case the same directory is walked twice)
+    dirs = {}
+
+    # Number of batches sent to the pool that haven't come back yet
+    npending = [0]
+
+    def submit(batch):
+        pool.apply_async(_run_batch, (func, batch), callback=done.put)
+        npending[0] += 1
+
+    def collect(block):
+        # Returns all directories that were completed by the batches that came back
+        completed = []
+        while npending[0]:
+            try:
+                batch = done.get(block)
+            except Queue.Empty:
+                break
+            npending[0] -= 1
+            block = False
+
+            for dirid, ind, result, failed in batch:
+                dirinfo = dirs[dirid]
+                dirinfo[1][ind] = result
+                dirinfo[2] -= 1
+                if failed:
+                    dirinfo[3] += 1
+                if dirinfo[2] == 0:
+                    del dirs[dirid]
+                    completed.append((dirinfo[0], dirinfo[1], dirinfo[3]))
+
+        return completed
+
+    batch = []
+
+    for dirid, (dirname, items) in enumerate(walker):
+
+        if not items:
+            yield dirname, [], 0
+            continue
+
+        dirs[dirid] = [dirname, [None] * len(items), len(items), 0]
+
+        for ind, item in enumerate(items):
+            batch.append((dirid, ind, item))
+
+            if len(batch) == chunksize:
+                submit(batch)
+                batch = []
+
+                # Wait for the pool to catch up before walking any further
+                while npending[0] >= max_pending:
+                    for completed in collect(True):
+                        yield completed
+
+        # Hand back anything that finished while walking
+        for completed in collect(False):
+            yield completed
+
+    if batch:
+        submit(batch)
+
+    while npending[0]:
+        for completed in collect(True):
+            yield completed
+
+def _item_filenames(item):
+
+    # Items are a filename, [filename, options] (dcmanon) or a list of filenames (sampling)
+    if isinstance(item, basestring):
+        return [item]
+    return [x for x in item if isinstance(x, basestring)]
+
+# Runs in a thread of the hybrid backend. Returns filename -> (start of the file, True if that
+# is the whole file). Errors are left for the parse to find.
+def _prefetch_batch(batch):
+
+    prefetched = {}
+    for dirid, ind, item in batch:
+        for filename in _item_filenames(item):
+            try:
+                with open(filename, 'rb') as f:
+                    data = f.read(PREFETCH_SIZE)
+            except (IOError, OSError):
+                continue
+            prefetched[filename] = (data, len(data) < PREFETCH_SIZE)
+    return prefetched
+
+# Runs in a process of the hybrid backend. Headers are parsed from what the thread read.
+def _run_prefetched(prefetched, func, args):
+
+    set_prefetched(prefetched)
+    try:
+        return func(*args)
+    finally:
+        set_prefetched({})
+
+class HybridPool(object):
+
+    # Same apply_async as a Pool. Every batch is read by a thread, then parsed by a process.
+    def __init__(self, nthreads, nprocesses):
+        self.threads = ThreadPool(nthreads)
+        self.processes = Pool(nprocesses)
+
+    def apply_async(self, func, args, callback=None):
+        batch = args[1]
+
+        def prefetched(result):
+            self.processes.apply_async(_run_prefetched, (result, func, args), callback=callback)
+
+        self.threads.apply_async(_prefetch_batch, (batch,), callback=prefetched)
+
+    def close(self):
+        self.threads.close()
+        self.threads.join()
+        self.processes.close()
+
+    def join(self):
+        self.processes.join()
+
+def measure_latency(bases, nsample=NSAMPLE):
+
+    # Returns (seconds to open and read the start of a file, seconds to parse its header),
+    # averaged over the first few dicoms in the tree. None if there are no dicoms in the first
+    # MAX_SAMPLE_FILES files or MAX_SAMPLE_DIRS folders.
+    read_time = 0.0
+    parse_time = 0.0
+    n = 0
+    nfiles = 0
+    for ndirs, (dirname, fullfilenames) in enumerate(walk_directories(bases), 1):
+        for filename in fullfilenames[:MAX_SAMPLE_FILES - nfiles]:
+            nfiles += 1
+            start_time = time.time()
+            if not sniff_dicom(filename):
+                continue
+            read_time += time.time() - start_time
+
+            start_time = time.time()
+            try:
+                read_dicom_header(filename)
+            except:
+                continue
+            parse_time += time.time() - start_time
+
+            n += 1
+            if n == nsample:
+                return read_time / n, parse_time / n
+
+        if nfiles >= MAX_SAMPLE_FILES or ndirs >= MAX_SAMPLE_DIRS:
+            break
+
+    if not n:
+        return None
+    return read_time / n, parse_time / n
+
+def choose_workers(backend, latency=None, ncpus=None):
+
+    # Returns (number of threads, number of processes) for the backend.
+    # While a file is being read, a core sits idle, so there is one worker per core plus as
+    # many as it takes to cover the reads.
+    ncpus = ncpus or cpu_count()
+    if latency is None:
+        ratio = 1.0
+    else:
+        read_time, parse_time = latency
+        ratio = read_time / max(parse_time, 1e-6)
+
+    if backend == 'process':
+        # Each process waits for its own reads, so a core is only kept busy by 1 + ratio of them.
+        # Without a measurement (no dicoms found), one per core.
+        if latency is None:
+            return 0, ncpus
+        return 0, min(MAX_PROCESSES_PER_CPU * ncpus, max(ncpus, int(math.ceil(ncpus * (1 + ratio)))))
+    elif backend == 'thread':
+        # Parsing holds the GIL, so threads only help with the waiting
+        return min(MAX_THREADS, max(ncpus, int(math.ceil(1 + ratio)))), 0
+    elif backend == 'hybrid':
+        return min(MAX_THREADS, max(ncpus, int(math.ceil(ncpus * ratio)))), ncpus
+
+    raise ValueError("Unknown backend: %s (use %s)" % (backend, ', '.join(BACKENDS)))
+
+def make_pool(backend, bases, workers=0):
+
+    # Returns (pool, description). If workers is 0, the number of workers is chosen for the
+    # tree, otherwise it is used for every part of the backend.
+    if workers:
+        nthreads = nprocesses = workers
+    else:
+        nthreads, nprocesses = choose_workers(backend, measure_latency(bases))
+
+    if backend == 'process':
+        return Pool(nprocesses), '%d processes' % nprocesses
+    elif backend == 'thread':
+        return ThreadPool(nthreads), '%d threads' % nthreads
+    elif backend == 'hybrid':
+        return HybridPool(nthreads, nprocesses), '%d threads, %d processes' % (nthreads, nprocesses)
+
+    raise ValueError("Unknown backend: %s (use %s)" % (backend, ', '.join(BACKENDS)))
@@ -0,0 +1,102 @@
+###################################################################################################
+#
+#    Looking up files in a catalog
+#
+# -The purpose of this script is to find every file of a patient, study or series without walking
+# the tree. The catalog is made by create_mr_db.py (--catalog, see dcmcatalog.py).
+#
+# -The paths that match are printed (or written to a file list with -o). The file list can be
+# given to dcmsort.py or dcmanon.py (--files), so only those files are worked on.
+#
+# -To test out, type in:
+# python create_mr_db.py -d "Z:\Images\Incoming" -c catalog.db
+# python dcmquery.py -c catalog.db -p 12345 -o patient.txt
+# python dcmanon.py --files patient.txt
+# -c = catalog to look in
+# -p = PatientID to look for (--study, --series and --sop look for the UIDs)
+# -o = file list to write
+#
+###################################################################################################
+
+import os
+import time
+from optparse import OptionParser
+from dcmcatalog import FileCatalog, CATALOG_FIELDS
+
+def main():
+    start_time = time.time()
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-c", "--catalog",
+                      action="store",
+                      type="string",
+                      dest="catalog",
+                      default='',
+                      help="Catalog to look in (made by create_mr_db.py --catalog)")
+    parser.add_option("-p", "--patient",
+                      action="store",
+                      type="string",
+                      dest="patient",
+                      default=None,
+                      help="PatientID to look for")
+    parser.add_option("--study",
+                      action="store",
+                      type="string",
+                      dest="study",
+                      default=None,
+                      help="StudyInstanceUID to look for")
+    parser.add_option("--series",
+                      action="store",
+                      type="string",
+                      dest="series",
+                      default=None,
+                      help="SeriesInstanceUID to look for")
+    parser.add_option("--sop",
+                      action="store",
+                      type="string",
+                      dest="sop",
+                      default=None,
+                      help="SOPInstanceUID to look for")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      type="string",
+                      dest="output",
+                      default='',
+                      help="File list to write the paths to (one per line) instead of printing them")
+    parser.add_option("-u", "--uids",
+                      action="store_true",
+                      dest="uids",
+                      default=False,
+                      help="Print the UIDs of every file after its path")
+
+    (options, args) = parser.parse_args()
+
+    if not options.catalog:
+        parser.error("A catalog (-c) is needed")
+    if not os.path.isfile(options.catalog):
+        parser.error("No catalog %s" % options.catalog)
+
+    catalog = FileCatalog(options.catalog)
+    rows = catalog.query(patient=options.patient, study=options.study, series=options.series, sop=options.sop)
+    catalog.close()
+
+    if not options.output:
+        if options.uids:
+            print '\t'.join(['path'] + CATALOG_FIELDS)
+        for row in rows:
+            print '\t'.join(value or '' for value in row) if options.uids else row[0]
+        return
+
+    with open(options.output, 'w') as f:
+        for row in rows:
+            f.write(row[0] + '\n')
+
+    print "PATIENTS: ", len(set(row[1] for row in rows))
+    print "STUDIES: ", len(set(row[2] for row in rows))
+    print "SERIES: ", len(set(row[3] for row in rows))
+    print "FILES: ", len(rows)
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+###################################################################################################
+#
+#    Sharing a run between machines
+#
+# -Used by create_mr_db.py, dcmsort.py and dcmanon.py so that one tree can be worked on by any
+# number of machines at once. Nothing is needed apart from a folder that every machine can see
+# (the share the images are on is fine).
+#
+# -A coordinator splits the tree into units (one per top level folder, or folders packed together
+# until they have enough files) and publishes them to the queue. Workers on any machine claim
+# units, run the tool over them with their own pool and put back a result (database rows, folder
+# renames, etc.). The coordinator merges the results as they come in.
+#
+# -The queue is a folder. Every unit is a JSON file that moves between subfolders with a rename,
+# which only one machine can win:
+#   pending    units waiting for a worker
+#   claimed    units being worked on (the name says by whom). The worker touches the file while it
+#              works, so its modification time is the lease.
+#   done       finished units, with their result
+#   failed     units that failed too many times
+# -A unit whose lease runs out (the worker died or lost the share) is put back in pending by
+# whoever notices first, and is tried again up to MAX_ATTEMPTS times. A unit can end up being run
+# twice, so running a unit has to be safe to repeat (it is for all three tools).
+# -A coordinator that is started again on the same queue (same tool and options, same number of
+# units) picks it up where it was: nothing is published again, and the results already in done
+# are collected along with the rest.
+# -Paths in units and results are relative to the base folder, with "/" between folders, since
+# every machine can have the share at a different place.
+#
+###################################################################################################
+
+import os
+import json
+import fnmatch
+import time
+import socket
+import threading
+from dcmjournal import to_bytes
+from dcmpipeline import walk_directories, walk_tree
+
+# Seconds a claimed unit can go without being touched before it is given to someone else
+LEASE_SECONDS = 300
+
+# Times a unit is tried before it is put in failed
+MAX_ATTEMPTS = 3
+
+# Seconds between looks at the queue while waiting
+POLL_SECONDS = 2
+
+QUEUE_FOLDERS = ['pending', 'claimed', 'done', 'failed']
+
+def relative_path(base, path):
+    rel = os.path.relpath(path, base)
+    return '' if rel == os.curdir else rel.replace(os.sep, '/')
+
+def local_path(base, rel):
+    return os.path.normpath(os.path.join(base, *rel.split('/'))) if rel else base
+
+def shard_tree(base, unit_files=0, exclude=None):
+
+    # Returns a list of units. A unit is a list of [relative folder, recursive].
+    # With no unit_files, every top level folder is a unit (and the files in base are another).
+    # Otherwise the tree is walked and folders are packed into units of at least unit_files files.
+    # Folders are never split, since the tools work on whole folders. Folders that match an
+    # "exclude" pattern are left out (the workers leave out the files).
+    if not unit_files:
+        names = sorted(os.listdir(base))
+        if exclude:
+            names = [name for name in names if not any(fnmatch.fnmatch(name, pattern) for pattern in exclude)]
+        units = []
+        if any(os.path.isfile(os.path.join(base, name)) for name in names):
+            units.append([['', False]])
+        for name in names:
+            if os.path.isdir(os.path.join(base, name)):
+                units.append([[name, True]])
+        return units
+
+    units = []
+    unit = []
+    nfiles = 0
+    for dirname, filenames in walk_tree([base], exclude=exclude):
+        unit.append([relative_path(base, dirname), False])
+        nfiles += len(filenames)
+        if nfiles >= unit_files:
+            units.append(unit)
+            unit = []
+            nfiles = 0
+    if unit:
+        units.append(unit)
+
+    return units
+
+def walk_unit(base, unit, **kwargs):
+
+    # Same as walk_directories, for the folders of a unit (under this machine's base)
+    for rel, recursive in unit['dirs']:
+        for out in walk_directories([local_path(base, rel)], recursive=recursive, **kwargs):
+            yield out
+
+def _read_json(filename):
+    with open(filename, 'r') as f:
+        return to_bytes(json.load(f))
+
+def _write_json(filename, record):
+
+    # Written to a temporary name first, so nobody ever reads half a file
+    tmpname = '%s.%s.%d.tmp' % (filename, socket.gethostname(), os.getpid())
+    with open(tmpname, 'w') as f:
+        json.dump(record, f, encoding='latin-1', default=str)
+    try:
+        os.rename(tmpname, filename)
+    except OSError:
+        # Windows won't rename over a file that exists
+        os.remove(filename)
+        os.rename(tmpname, filename)
+
+class Lease(object):
+
+    # Keeps a claimed unit's lease from running out while it is being worked on
+    def __init__(self, filename, seconds=LEASE_SECONDS):
+        self.filename = filename
+        self.seconds = seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.renew)
+        self.thread.daemon = True
+
+    def renew(self):
+        while not self.stopped.wait(self.seconds / 3.0):
+            try:
+                os.utime(self.filename, None)
+            except OSError:
+                # Given to someone else. The result will be thrown away.
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+class WorkQueue(object):
+
+    def __init__(self, path, key, units=None, lease_seconds=LEASE_SECONDS):
+
+        # key says what the queue is for (ie, "create_mr_db"), same as a journal. With units,
+        # a new queue is made (the folder has to be new or empty), unless the folder already
+        # has a queue with the same key and number of units (a coordinator that was restarted),
+        # which is opened as it is. Otherwise an existing queue is opened, and ValueError is
+        # raised if it is missing or for something else.
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.seen = set()
+
+        headername = os.path.join(path, 'queue.json')
+        if units is not None and os.path.isfile(headername):
+            header = _read_json(headername)
+            if header['key'] != key or header['nunits'] != len(units):
+                raise ValueError("Queue folder %s has a queue for \"%s\" with %d units, not \"%s\" with %d" %
+                                 (path, header['key'], header['nunits'], key, len(units)))
+            units = None
+
+        if units is not None:
+            if os.path.isdir(path) and os.listdir(path):
+                raise ValueError("Queue folder %s is not empty" % path)
+            for folder in QUEUE_FOLDERS:
+                os.makedirs(os.path.join(path, folder))
+            for unitid, dirs in enumerate(units):
+                _write_json(self.unit_file('pending', unitid), {'id': unitid, 'dirs': dirs, 'attempts': 0})
+
+            # Written last, so a worker never sees a queue that is still being filled
+            _write_json(headername, {'key': key, 'nunits': len(units)})
+
+        if not os.path.isfile(headername):
+            raise ValueError("No queue in %s" % path)
+        header = _read_json(headername)
+        if header['key'] != key:
+            raise ValueError("Queue %s is for \"%s\", not \"%s\"" % (path, header['key'], key))
+        self.nunits = header['nunits']
+
+    def unit_file(self, folder, unitid, owner=None):
+        name = '%06d.json' % unitid if owner is None else '%06d.%s.json' % (unitid, owner)
+        return os.path.join(self.path, folder, name)
+
+    def list(self, folder):
+        # Returns (unit id, filename) for every unit in a folder
+        out = []
+        for name in sorted(os.listdir(os.path.join(self.path, folder))):
+            if name.endswith('.json'):
+                out.append((int(name.split('.')[0]), os.path.join(self.path, folder, name)))
+        return out
+
+    def claim(self):
+
+        # Returns the next unit (a dict with "id", "dirs" and "attempts"), or None if there
+        # is nothing waiting
+        for unitid, filename in self.list('pending'):
+            claimed = self.unit_file('claimed', unitid, self.owner)
+            try:
+                os.rename(filename, claimed)
+            except OSError:
+                # Someone else got it first
+                continue
+
+            # A unit that timed out can come back after its first worker finished it after all
+            if os.path.exists(self.unit_file('done', unitid)):
+                os.remove(claimed)
+                continue
+
+            os.utime(claimed, None)
+            return _read_json(claimed)
+
+        return None
+
+    def lease(self, unit):
+        return Lease(self.unit_file('claimed', unit['id'], self.owner), self.lease_seconds)
+
+    def complete(self, unit, result):
+
+        # Returns False if the lease ran out before the unit was finished (the result is
+        # thrown away, the unit is being done again by someone else)
+        claimed = self.unit_file('claimed', unit['id'], self.owner)
+        if not os.path.exists(claimed):
+            return False
+
+        record = dict(unit)
+        record['result'] = result
+        record['owner'] = self.owner
+        _write_json(self.unit_file('done', unit['id']), record)
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
+        return True
+
+    def fail(self, unit, error):
+
+        # The unit goes back to pending, or to failed once it has been tried too many times
+        claimed = self.unit_file('claimed', unit['id'], self.owner)
+        self.retry(claimed, unit, error)
+
+    def retry(self, claimed, unit, error):
+
+        # Only the one that renames the claimed file out of the way gets to put the unit back
+        stolen = claimed + '.%s.retry' % self.owner
+        try:
+            os.rename(claimed, stolen)
+        except OSError:
+            return
+
+        unit = dict(unit)
+        unit['attempts'] += 1
+        unit.setdefault('errors', []).append(error)
+        folder = 'pending' if unit['attempts'] < MAX_ATTEMPTS else 'failed'
+        _write_json(self.unit_file(folder, unit['id']), unit)
+        os.remove(stolen)
+
+    def requeue_expired(self):
+
+        # Puts back every unit whose lease has run out. Returns how many there were.
+        n = 0
+        now = time.time()
+        for unitid, filename in self.list('claimed'):
+            try:
+                if now - os.path.getmtime(filename) < self.lease_seconds:
+                    continue
+                unit = _read_json(filename)
+            except (OSError, IOError, ValueError):
+                continue
+            self.retry(filename, unit, 'lease expired (%s)' % os.path.basename(filename))
+            n += 1
+
+        return n
+
+    def count(self, folder):
+        return len(self.list(folder))
+
+    def finished(self):
+        return self.count('done') + self.count('failed') >= self.nunits
+
+    def results(self, poll_seconds=POLL_SECONDS):
+
+        # Yields (unit, result) for every unit as it is finished, until all of them are done
+        # or failed. Expired leases are put back while waiting.
+        while True:
+            for unitid, filename in self.list('done'):
+                if unitid in self.seen:
+                    continue
+                self.seen.add(unitid)
+                record = _read_json(filename)
+                yield record, record['result']
+
+            if self.finished():
+                return
+
+            self.requeue_expired()
+            time.sleep(poll_seconds)
+
+    def failed_units(self):
+        return [_read_json(filename) for unitid, filename in self.list('failed')]
+
+def run_worker(queue, process, poll_seconds=POLL_SECONDS):
+
+    # Claims units until the queue is finished. process is a function of a unit that returns
+    # its result (anything that can go in JSON). Returns the number of units completed.
+    ncompleted = 0
+    while True:
+        unit = queue.claim()
+        if unit is None:
+            if queue.finished():
+                return ncompleted
+            queue.requeue_expired()
+            time.sleep(poll_seconds)
+            continue
+
+        print "UNIT %d: " % unit['id'], ', '.join(rel or '.' for rel, recursive in unit['dirs'])
+        try:
+            with queue.lease(unit):
+                result = process(unit)
+        except Exception as e:
+            queue.fail(unit, '%s: %s' % (type(e).__name__, e))
+            continue
+
+        if queue.complete(unit, result):
+            ncompleted += 1
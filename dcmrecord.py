@@ -0,0 +1,82 @@
+###################################################################################################
+#
+#    Compact rows
+#
+# -Used by create_mr_db.py for the row of every file. A row used to be a dict of the values pydicom
+# read (PersonName, DSfloat, UID, ...), which costs around a kilobyte to pickle back from a worker
+# and several kilobytes to keep, for every file.
+#
+# -A Record is a fixed set of fields (in __slots__, so there is no dict per row):
+#   TEXT       kept as plain text. In the process that unpickles a row, the text is interned, so
+#              the UIDs and names shared by every file of a series are only kept once.
+#   NUMERIC    kept as a float (None if missing or not a number).
+#   anything else is kept as it is given (ie, "nimgs" and "dir").
+# -A row is pickled as its class and a tuple of its values.
+# -Rows can be used like the dicts they replace (row['seriesuid'], row.get, row.items, ...).
+#
+###################################################################################################
+
+from dcmindex import to_text
+
+def intern_text(value):
+
+    # Same as to_text, but the same text always gives back the same object
+    value = to_text(value)
+    return None if value is None else intern(value)
+
+def to_number(value):
+
+    # Float of a numeric field, or None if it is missing or not a single number
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class Record(object):
+
+    __slots__ = ()
+    TEXT = ()
+    NUMERIC = ()
+
+    def __init__(self, *values):
+        for name, value in map(None, self.__slots__, values):
+            self[name] = value
+
+    def __setitem__(self, name, value):
+        if value is not None:
+            if name in self.TEXT:
+                value = intern_text(value)
+            elif name in self.NUMERIC:
+                value = to_number(value)
+        setattr(self, name, value)
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def __reduce__(self):
+        return (self.__class__, self.values())
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % item for item in self.items()))
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in self.__slots__ else default
+
+    def pop(self, name):
+        value = self[name]
+        setattr(self, name, None)
+        return value
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def items(self):
+        return zip(self.__slots__, self.values())
@@ -19,21 +19,58 @@
 ###################################################################################################
 
 import os
+import sys
+import errno
+import shutil
 import dicom
 import time
-import shutil
 from dicom.filereader import InvalidDicomError
 from optparse import OptionParser
-from multiprocessing import Pool
-import pandas as pd
+from functools import partial
 import re
-
-isdcmname = re.compile('IMAGE\.\d{4}\.\d{4}')
-
-def readDicomFile(filename):
-
+from dcmheader import read_dicom_fields
+from dcmpipeline import walk_directories, walk_file_list, stream_directories, DicomSniffer, make_pool, BACKENDS
+from dcmstats import RunStats
+from dcmjournal import Journal
+from dcmarchive import is_member, member_path, extract_member
+from dcmmanifest import ManifestWriter, read_with_checksum, final_names
+from dcmcatalog import read_file_list
+from dcmindex import to_text
+from dcmqueue import WorkQueue, shard_tree, walk_unit, run_worker, relative_path, local_path
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+isdcmname = re.compile('IMAGE\.\d{4,}\.\d{4,}')
+
+# Header fields needed to sort a folder
+sortfields = ['SeriesInstanceUID','ProtocolName','SeriesNumber','InstanceNumber']
+
+# Ways to give a file a name in a separate output tree, cheapest first. "auto" tries them in this
+# order, so a file is only copied when it can't be linked.
+#   hardlink   same file, second name (changing one changes the other)
+#   reflink    new file sharing the same data on disk until either one changes (btrfs, xfs, ...)
+#   copy       new file with a full copy of the data
+LINK_STRATEGIES = ['hardlink', 'reflink', 'copy']
+
+# Linux ioctl for a reflink
+FICLONE = 0x40049409
+
+def readDicomFile(filename, force=False, checksum=False):
+
+    # Only the header is read. Parsing stops once all sortfields have been read.
+    # With checksum, the rest of the file is read too and the size and pixel data checksum are
+    # added to the end (see dcmmanifest.py).
+    # The values are sent back from the pool as plain text, which is much cheaper to pickle than
+    # the values pydicom reads.
     try:
-        dcminf = dicom.read_file(filename)
+        if checksum:
+            dcminf, size, digest = read_with_checksum(filename, force=force)
+            return [filename] + [to_text(getattr(dcminf, field, '')) for field in sortfields] + [size, digest]
+        dcmvals = [to_text(value) for value in read_dicom_fields(filename, sortfields, default='', force=force)]
     except IOError:
         return []
     except InvalidDicomError:
@@ -41,19 +78,7 @@ def readDicomFile(filename):
     except:
         return []
 
-    out = []
-    if dcminf:
-
-        fields = ['SeriesInstanceUID','ProtocolName','SeriesNumber','InstanceNumber']
-        out.append(filename)
-
-        for field in fields:
-            if hasattr(dcminf, field):
-                out.append(getattr(dcminf, field))
-            else:
-                out.append('')
-
-    return out
+    return [filename] + dcmvals
 
 def getDicomAttr(dcm):
     dcminfo = dcm[0]
@@ -64,28 +89,283 @@ def getDicomAttr(dcm):
     else:
         return ''
 
-def renameDicom(dcm):
-    oldname = dcm[0]
-    newname = dcm[1]
+# A plan is a list of steps, applied in order by executePlan:
+#   ('mkdir', folder)
+#   ('makedirs', folder)     (with any missing parents, only used for a separate output tree)
+#   ('rename', src, dst)     (files or folders, always a same-filesystem os.rename)
+#   ('link', src, dst)       (a new name for the file in a separate output tree, see linkFile)
+# Steps that can't be applied safely are left out of the plan and returned as "skipped".
 
-    try:
-        os.rename(oldname,newname)
-    except:
-        0
+def orderRenames(renames):
 
-def moveDicom(dcm):
-    src = dcm[0]
-    dst = dcm[1]
-    try:
-        shutil.move(src, dst)
-    except:
-        return
+    # renames is a list of (src, dst). Returns (steps, skipped).
+    # A file is only renamed once nothing else is still waiting to be moved away from its
+    # destination. Cycles (a -> b, b -> a) are broken by renaming one file to a temporary name.
+    pending = {}
+    skipped = []
+
+    # Files that already have the right name stay where they are
+    taken = set(src for src, dst in renames if src == dst)
+
+    for src, dst in renames:
+        if src == dst:
+            continue
+        # Two files that would end up with the same name
+        if dst in taken:
+            skipped.append((src, dst))
+            continue
+        taken.add(dst)
+        pending[src] = dst
+
+    # Destinations that already exist and aren't going to be moved away. Skipping one file
+    # can block another one, so keep going until nothing changes.
+    changed = True
+    while changed:
+        changed = False
+        for src in pending.keys():
+            dst = pending[src]
+            if dst not in pending and os.path.exists(dst):
+                skipped.append((src, dst))
+                del pending[src]
+                changed = True
+
+    steps = []
+    while pending:
+        ready = [src for src in pending if pending[src] not in pending]
+
+        if not ready:
+            # Everything left is part of a cycle
+            src = min(pending)
+            tmp = src + '.sorting'
+            steps.append(('rename', src, tmp))
+            pending[tmp] = pending.pop(src)
+            continue
+
+        for src in sorted(ready):
+            steps.append(('rename', src, pending.pop(src)))
+
+    return steps, skipped
+
+def orderLinks(links):
+
+    # links is a list of (src, dst). Returns (steps, skipped). The sources are never touched, so
+    # the only thing to check is that no two files get the same name and nothing is overwritten.
+    steps = []
+    skipped = []
+    taken = set()
+
+    for src, dst in links:
+        if dst in taken or os.path.exists(dst):
+            skipped.append((src, dst))
+            continue
+        taken.add(dst)
+        steps.append(('link', src, dst))
+
+    return steps, skipped
+
+# Zero-pads a SeriesNumber/InstanceNumber to at least 4 digits. Longer numbers are kept whole
+# (cutting them down to the last 4 digits would give different series/images the same name).
+def padNumber(value):
+    return str(value).zfill(4)
+
+def nameDirectory(dcminfo_container):
+
+    # dcminfo_container is a list of [filename, SeriesInstanceUID, ProtocolName, SeriesNumber,
+    # InstanceNumber] for every dicom in a folder (see readDicomFile).
+    # Returns (fnames, fldrs, single): the IMAGE.SSSS.IIII name and the DCMSSSS_PROTOCOLNAME folder
+    # of every file (in the same order) and whether the folder holds a single series.
+    fnames = []
+    fldrs = []
+
+    # A folder holds a handful of series and protocols, so each part of a name is only built the
+    # first time it shows up. After that, naming a file is two lookups and one concatenation.
+    fname_start = {}
+    in_pad = {}
+    fldr_names = {}
+
+    # Find out if you're dealing with many different dicoms or just a single folder
+    single = True
+    first_sid = dcminfo_container[0][1]
+    first_pn = dcminfo_container[0][2]
+
+    for fn, sid, pn, sn, inum in dcminfo_container:
+        try:
+            start = fname_start[sn]
+        except KeyError:
+            start = fname_start[sn] = 'IMAGE.' + padNumber(sn) + '.'
+        try:
+            pad = in_pad[inum]
+        except KeyError:
+            pad = in_pad[inum] = padNumber(inum)
+        fnames.append(start + pad)
+
+        key = (sn, pn)
+        try:
+            fldr = fldr_names[key]
+        except KeyError:
+            fldr = fldr_names[key] = 'DCM' + padNumber(sn) + '_' + pn
+        fldrs.append(fldr)
+
+        if sid != first_sid or pn != first_pn:
+            single = False
+
+    return fnames, fldrs, single
+
+def planDirectory(dirname, dcminfo_container, outdir=None):
+
+    # Returns (plan, fldrs_to_rename, skipped) for one folder. The folder renames are returned
+    # separately since they are all done at the end, once every file in the tree has been moved.
+    # With outdir (where dirname would be in a separate output tree), the files are linked into
+    # the sorted tree there and dirname is left as it is.
+    fns = [dcminfo[0] for dcminfo in dcminfo_container]
+    fnames, fldrs, single = nameDirectory(dcminfo_container)
+
+    plan = []
+    fldrs_to_rename = []
+
+    if single:
+        # Rename the directory so it follows "DCMXXXX_PROTOCOLNAME"
+        new_fldr = fldrs[0]
+
+        if outdir is None:
+            # Rename all filenames
+            fn2 = [os.path.join(dirname, fname) for fname in fnames]
+            steps, skipped = orderRenames(zip(fns, fn2))
+            plan.extend(steps)
+
+            fullfldrname = os.path.join(os.path.split(dirname)[0], new_fldr.upper())
+            fldrs_to_rename.append((dirname,fullfldrname))
+        else:
+            # The output folder gets its final name straight away
+            fullfldrname = os.path.join(os.path.split(outdir)[0], new_fldr.upper())
+            if not os.path.isdir(fullfldrname):
+                plan.append(('makedirs', fullfldrname))
+
+            fn2 = [os.path.join(fullfldrname, fname) for fname in fnames]
+            steps, skipped = orderLinks(zip(fns, fn2))
+            plan.extend(steps)
+
+    else:
+        # Need to create new folders for everything (in the order they first show up)
+        root = dirname if outdir is None else outdir
+        seen = set()
+        for fldr in fldrs:
+            if fldr in seen:
+                continue
+            seen.add(fldr)
+            fullfldrname = os.path.join(root, fldr)
+            if not os.path.isdir(fullfldrname):
+                plan.append(('mkdir' if outdir is None else 'makedirs', fullfldrname))
+
+        # Create new filenames
+        fn2 = [os.path.join(root, fldr, fname) for fldr, fname in zip(fldrs, fnames)]
+        if outdir is None:
+            steps, skipped = orderRenames(zip(fns, fn2))
+        else:
+            steps, skipped = orderLinks(zip(fns, fn2))
+        plan.extend(steps)
+
+    return plan, fldrs_to_rename, skipped
+
+def planFolderRenames(fldrs_to_rename):
+
+    # Folders are renamed deepest first so a parent rename can't break the path of a child.
+    # A folder is not renamed if another folder already has (or will get) the new name.
+    plan = []
+    skipped = []
+    taken = set()
+
+    for src, dst in sorted(fldrs_to_rename, reverse=True):
+        if src == dst:
+            continue
+        if dst in taken or os.path.exists(dst):
+            skipped.append((src, dst))
+            continue
+        taken.add(dst)
+        plan.append(('rename', src, dst))
+
+    return plan, skipped
+
+def reflinkFile(src, dst):
+
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, "Reflinks are not supported on this platform", dst)
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except IOError as e:
+                error = e
+
+    # The filesystem can't do it (or src and dst are on different ones)
+    os.remove(dst)
+    raise OSError(error.errno, error.strerror, dst)
+
+def linkFile(src, dst, strategy='auto'):
+
+    # Returns the strategy that was used. Raises the error of the last one if none of them work.
+    # A file inside an archive can only be extracted, whatever the strategy.
+    if is_member(src):
+        extract_member(src, dst)
+        return 'extract'
+
+    strategies = LINK_STRATEGIES if strategy == 'auto' else [strategy]
+    for ind, name in enumerate(strategies):
+        try:
+            if name == 'hardlink':
+                if not hasattr(os, 'link'):
+                    raise OSError(errno.ENOSYS, "Hardlinks are not supported on this platform", dst)
+                os.link(src, dst)
+            elif name == 'reflink':
+                reflinkFile(src, dst)
+            else:
+                shutil.copy2(src, dst)
+            return name
+        except (OSError, IOError):
+            if ind == len(strategies) - 1:
+                raise
+
+def executePlan(plan, journal=None, kind='files', link='auto', strategies=None):
+
+    # Applies each step once, in order. Returns the steps that failed.
+    # With a journal, the plan and every step are recorded so an interrupted plan can be recovered.
+    # "link" is the strategy for link steps, and the number of files linked with each strategy
+    # is added to "strategies".
+    if journal is not None:
+        planid = journal.begin_plan(plan, kind)
+
+    failed = []
+    for ind, step in enumerate(plan):
+        try:
+            if step[0] == 'mkdir':
+                os.mkdir(step[1])
+            elif step[0] == 'makedirs':
+                os.makedirs(step[1])
+            elif step[0] == 'link':
+                used = linkFile(step[1], step[2], link)
+                if strategies is not None:
+                    strategies[used] = strategies.get(used, 0) + 1
+            else:
+                os.rename(step[1], step[2])
+        except (OSError, IOError):
+            failed.append(step)
+            continue
+
+        if journal is not None:
+            journal.step_done(planid, ind)
+
+    if journal is not None:
+        journal.end_plan(planid, kind)
+
+    return failed
 
 # Determines whether a folder has already been sorted based on the naming scheme
 def isFolderSorted(filenames):
 
-    tmp = [1 if isdcmname.findall(dcm) else 0 for dcm in filenames]
-    return all(tmp)
+    # Stops at the first file that isn't named yet
+    return all(isdcmname.search(dcm) for dcm in filenames)
 
 def test(df):
     return str(df['sn']) + '@@' + str(df['in'])
@@ -100,123 +380,357 @@ def main():
                       dest="directory",
                       default='',
                       help="Directory file to search through")
+    parser.add_option("--files",
+                      action="store",
+                      type="string",
+                      dest="files",
+                      default='',
+                      help="File list to sort (ie, written by dcmquery.py) instead of a directory. Without a target, the folders the files are in are sorted")
+    parser.add_option("--stats",
+                      action="store",
+                      type="string",
+                      dest="stats",
+                      default='',
+                      help="File to write run statistics to (one JSON line per folder and a summary)")
+    parser.add_option("--progress",
+                      action="store_true",
+                      dest="progress",
+                      default=False,
+                      help="Show a progress line while running")
+    parser.add_option("--lenient",
+                      action="store_true",
+                      dest="lenient",
+                      default=False,
+                      help="Also read files without the 128 byte preamble if they look like a dicom")
+    parser.add_option("-b", "--backend",
+                      action="store",
+                      type="choice",
+                      choices=BACKENDS,
+                      dest="backend",
+                      default='process',
+                      help="Workers to use: process, thread (for network shares) or hybrid")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=0,
+                      help="Number of workers. Default is to choose from the cores and the speed of the tree")
+    parser.add_option("--walk-threads",
+                      action="store",
+                      type="int",
+                      dest="walk_threads",
+                      default=0,
+                      help="Number of threads listing folders at once (for slow network shares). Default is one")
+    parser.add_option("--depth",
+                      action="store",
+                      type="int",
+                      dest="depth",
+                      default=None,
+                      help="Only walk this many levels of folders below the directory (0 is just the directory)")
+    parser.add_option("--include",
+                      action="append",
+                      type="string",
+                      dest="include",
+                      default=[],
+                      help="Only read files that match this pattern (ie, \"*.dcm\"). Can be given more than once")
+    parser.add_option("--exclude",
+                      action="append",
+                      type="string",
+                      dest="exclude",
+                      default=[],
+                      help="Leave out files and folders that match this pattern. Can be given more than once")
+    parser.add_option("-j", "--journal",
+                      action="store",
+                      type="string",
+                      dest="journal",
+                      default='',
+                      help="Journal file. A run with the same journal skips finished folders and recovers unfinished renames")
+    parser.add_option("--rollback",
+                      action="store_true",
+                      dest="rollback",
+                      default=False,
+                      help="Undo the unfinished renames in the journal instead of finishing them")
+    parser.add_option("-t", "--target",
+                      action="store",
+                      type="string",
+                      dest="target",
+                      default='',
+                      help="Build the sorted tree in this folder (with links) instead of sorting in place")
+    parser.add_option("--link",
+                      action="store",
+                      type="choice",
+                      choices=['auto'] + LINK_STRATEGIES,
+                      dest="link",
+                      default='auto',
+                      help="How files are put in the target: auto, hardlink, reflink or copy")
+    parser.add_option("-a", "--archives",
+                      action="store_true",
+                      dest="archives",
+                      default=False,
+                      help="Also read the dicoms inside zip and tar files. They are extracted into the target, or only planned without one")
+    parser.add_option("--manifest",
+                      action="store",
+                      type="string",
+                      dest="manifest",
+                      default='',
+                      help="File to add the old and new name, size and pixel data checksum of every sorted file to (see dcmverify.py)")
+    parser.add_option("--coordinator",
+                      action="store",
+                      type="string",
+                      dest="coordinator",
+                      default='',
+                      help="Queue folder to publish the tree to. Workers on any machine sort it, and the folders are renamed here at the end")
+    parser.add_option("--worker",
+                      action="store",
+                      type="string",
+                      dest="worker",
+                      default='',
+                      help="Queue folder to take work from (made by a coordinator), until the queue is finished")
+    parser.add_option("--unit-files",
+                      action="store",
+                      type="int",
+                      dest="unit_files",
+                      default=0,
+                      help="Files per unit of work for the coordinator. Default is one unit per top level folder")
 
     (options, args) = parser.parse_args()
 
     base = options.directory
 
-    if not base:
+    if options.files and options.target and not base:
+        parser.error("--files with --target needs the directory (-d) the files are under")
+
+    if not base and not options.files:
         print "No directory selected! Please follow pattern to choose directory: "
         print "python dcmsort.py -d C:\YOURDIRECTORYHERE"
 
-    p = Pool(10)
-
-    fldrs_failed_rename = []
-
-    for dirname, dirnames, filenames in os.walk(base):
-
-        # Check if folder has been previously sorted
-        if isFolderSorted(filenames):
-            continue
-
-        fullfilenames = [os.path.join(dirname, filename)for filename in filenames]
-
-        dcminfo_container = p.map(readDicomFile, fullfilenames)
-        dcminfo_container = filter(None, dcminfo_container)
-
-        # If dcminfo_container is empty, continue
-        if not dcminfo_container:
-            continue
-
-        print "Sorting ", dirname
+    # The sorted tree for base goes in target/<name of base>, so base itself can be sorted too.
+    # Nothing in base is changed.
+    outbase = None
+    if options.target:
+        realbase = os.path.realpath(base)
+        realtarget = os.path.realpath(options.target)
+        if realtarget == realbase or realtarget.startswith(os.path.join(realbase, '')):
+            parser.error("--target can't be inside the directory being sorted")
+        outbase = os.path.join(options.target, os.path.basename(os.path.normpath(base)))
+
+    if options.journal and (options.coordinator or options.worker):
+        parser.error("--journal can't be used with --coordinator or --worker (the queue keeps track of what is done)")
+    if options.manifest and (options.coordinator or options.worker):
+        parser.error("--manifest can't be used with --coordinator or --worker")
+    if options.depth is not None and (options.coordinator or options.worker):
+        parser.error("--depth can't be used with --coordinator or --worker")
+    if options.files and (options.coordinator or options.worker):
+        parser.error("--files can't be used with --coordinator or --worker")
+
+    # How the tree is walked, for every walk of the run
+    walk = dict(depth=options.depth, include=options.include, exclude=options.exclude, threads=options.walk_threads)
+
+    fldrs_to_rename = []
+    failed = []
+    skipped = []
+    planned = []
+
+    # Number of files put in the target with each strategy
+    strategies = {}
+    link = partial(linkFile, strategy=options.link)
+
+    stats = RunStats('dcmsort', options.stats, options.progress)
+
+    journal = None
+    manifest = ManifestWriter(options.manifest) if options.manifest else None
+
+    # Queues are only shared by runs that sort the same way
+    key = 'dcmsort' if outbase is None else 'dcmsort -> target'
+
+    if options.coordinator:
+        # The coordinator doesn't read any files. Workers sort the files, and send back the
+        # folder renames so they can all be done here at the end.
+        try:
+            queue = WorkQueue(options.coordinator, key, shard_tree(base, options.unit_files, options.exclude))
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+        print "UNITS: ", queue.nunits
+
+        nrejected = 0
+        for unit, result in queue.results():
+            fldrs_to_rename.extend((local_path(base, src), local_path(base, dst)) for src, dst in result['folders'])
+            skipped.extend((local_path(base, src), local_path(base, dst)) for src, dst in result['skipped'])
+            failed.extend(tuple(step) for step in result['failed'])
+            planned.extend(tuple(step) for step in result['planned'])
+            for strategy, n in result['strategies'].items():
+                strategies[strategy] = strategies.get(strategy, 0) + n
+            stats.merge(result['counts'], result['ndirs'])
+            nrejected += result['nondicom']
+
+        for unit in queue.failed_units():
+            print "UNIT FAILED: ", unit['dirs'], unit['errors'][-1]
 
-        # df_dcminfo = pd.DataFrame({'sid': series_uid, 'pn': protocol_name, 'sn': series_number, 'in': image_number})
-        df_dcminfo = pd.DataFrame(dcminfo_container, columns =['fn', 'sid', 'pn', 'sn', 'in'])
-
-        df_dcminfo.sort(['sn', 'in'])
+    else:
+        # Only the folders of the files in the list are walked
+        file_list = None
+        bases = [base]
+        if options.files:
+            file_list = read_file_list(options.files)
+            bases = sorted(set(os.path.dirname(filename) for filename in file_list))
+            if outbase is not None and any(os.path.relpath(filename, base).startswith(os.pardir) for filename in file_list):
+                parser.error("Every file in the list has to be under the directory (-d) with --target")
+
+        p, workers = make_pool(options.backend, bases, options.workers)
+        print "WORKERS: ", options.backend, "(%s)" % workers
+
+        stats.info.update(backend=options.backend, workers=workers)
+
+        # Renames that were interrupted last time are finished (or undone) before anything else.
+        # Folder renames of the folders finished last time still need to be done at the end.
+        if options.journal:
+            try:
+                journal = Journal(options.journal, 'dcmsort' if outbase is None else 'dcmsort -> %s' % options.target)
+            except ValueError as e:
+                parser.error(str(e))
+            failed.extend(journal.recover(options.rollback, link))
+            fldrs_to_rename.extend(journal.folders)
+
+        # Folders that have been previously sorted are skipped by the walker (unless they are
+        # linked into a target, where they still need to show up)
+        def skip_sorted(filenames):
+            if outbase is None and isFolderSorted(filenames):
+                stats.add('skipped', len(filenames))
+                return True
+            return False
+
+        # Files that are clearly not dicoms are dropped by the walker. Files without a preamble
+        # are only let through when lenient, and then have to be forced.
+        sniffer = DicomSniffer(options.lenient, stats)
+
+        def sortWalker(walker):
+
+            # Files from all folders are read by the pool as they are found. A folder comes back
+            # once all of its files have been read.
+            read = partial(readDicomFile, force=options.lenient, checksum=manifest is not None)
+            stream = stream_directories(p, stats.timed(read), stats.walk(walker))
+            for dirname, dcminfo_container, nfailed in stats.stream(stream):
+
+                dcminfo_container = stats.directory(dirname, dcminfo_container, nfailed)
+                dcminfo_container = filter(None, dcminfo_container)
+
+                if manifest is not None:
+                    checksums = [dcminfo[5:] for dcminfo in dcminfo_container]
+                    dcminfo_container = [dcminfo[:5] for dcminfo in dcminfo_container]
+
+                # If dcminfo_container is empty, continue
+                if not dcminfo_container:
+                    if journal is not None and not nfailed:
+                        journal.mark_done(dirname)
+                    continue
+
+                # Nothing inside an archive can be renamed, so without a target the plan is only shown.
+                # Files are planned under the paths they would have if the archive was extracted next to it.
+                if is_member(dirname) and outbase is None:
+                    print "Planning ", dirname
+                    dcminfo_container = [[member_path(dcminfo[0])] + dcminfo[1:] for dcminfo in dcminfo_container]
+                    with stats.stage('plan'):
+                        plan, fldrs, dir_skipped = planDirectory(member_path(dirname), dcminfo_container)
+                    planned.extend(plan)
+                    planned.extend(('rename', src, dst) for src, dst in fldrs)
+                    skipped.extend(dir_skipped)
+                    continue
+
+                print "Sorting ", dirname
+
+                # Folders inside an archive go where they would be if it was extracted
+                outdir = None
+                if outbase is not None:
+                    outdir = os.path.normpath(os.path.join(outbase, os.path.relpath(member_path(dirname), base)))
+
+                with stats.stage('plan'):
+                    plan, fldrs, dir_skipped = planDirectory(dirname, dcminfo_container, outdir)
+                with stats.stage('rename'):
+                    dir_failed = executePlan(plan, journal, link=options.link, strategies=strategies)
+                failed.extend(dir_failed)
+                fldrs_to_rename.extend(fldrs)
+
+                if manifest is not None:
+                    dir_failed = set(dir_failed)
+                    names = final_names([step for step in plan if step not in dir_failed])
+                    for dcminfo, (size, digest) in zip(dcminfo_container, checksums):
+                        manifest.add_file(dcminfo[0], names.get(dcminfo[0], dcminfo[0]), size, digest)
+                skipped.extend(dir_skipped)
+
+                if journal is not None and not nfailed:
+                    journal.mark_done(dirname, fldrs)
+
+        if options.worker:
+            try:
+                queue = WorkQueue(options.worker, key)
+            except ValueError as e:
+                parser.error(str(e))
+
+            # Everything a unit added is sent back to the coordinator
+            def sortUnit(unit):
+                before = [len(fldrs_to_rename), len(skipped), len(failed), len(planned)]
+                counts = dict(stats.counts)
+                ndirs = stats.ndirs
+                nrejected = sniffer.nrejected
+                unit_strategies = dict(strategies)
+
+                sortWalker(walk_unit(base, unit, skip=skip_sorted, keep=sniffer, archives=options.archives, **walk))
+
+                return {'folders': [(relative_path(base, src), relative_path(base, dst)) for src, dst in fldrs_to_rename[before[0]:]],
+                        'skipped': [(relative_path(base, src), relative_path(base, dst)) for src, dst in skipped[before[1]:]],
+                        'failed': failed[before[2]:], 'planned': planned[before[3]:],
+                        'strategies': dict((strategy, n - unit_strategies.get(strategy, 0)) for strategy, n in strategies.items()),
+                        'counts': dict((counter, stats.counts[counter] - counts[counter]) for counter in counts),
+                        'ndirs': stats.ndirs - ndirs, 'nondicom': sniffer.nrejected - nrejected}
+
+            ncompleted = run_worker(queue, sortUnit)
+            print "UNITS COMPLETED: ", ncompleted
+
+            # The folders are renamed by the coordinator
+            fldrs_to_rename = []
+        elif file_list is not None and outbase is None:
+            # A folder is sorted as a whole (its files are renamed among each other, and the
+            # folder itself can be renamed), so every file in the folders of the list is sorted
+            sortWalker(walk_directories(bases, skip=skip_sorted, keep=sniffer, done=journal, recursive=False))
+        elif file_list is not None:
+            sortWalker(walk_file_list(file_list, skip=skip_sorted, keep=sniffer, done=journal))
+        else:
+            sortWalker(walk_directories([base], skip=skip_sorted, keep=sniffer, done=journal, archives=options.archives, **walk))
 
-        df_dcminfo['sn2'] = df_dcminfo['sn'].apply(lambda x: '000' + str(x))
-        df_dcminfo['in2'] = df_dcminfo['in'].apply(lambda x: '000' + str(x))
+        nrejected = sniffer.nrejected
 
-        # new dicom filenames
-        df_dcminfo['fname'] = 'IMAGE.' + df_dcminfo['sn2'].apply(lambda x: x[-4:]) + '.' + \
-            df_dcminfo['in2'].apply(lambda x: x[-4:])
+    # Leave all folder renaming for the end, once every file in the tree has been moved.
+    with stats.stage('rename'):
+        plan, fldrs_skipped = planFolderRenames(fldrs_to_rename)
+        fldrs_failed = executePlan(plan, journal, kind='folders')
+    failed.extend(fldrs_failed)
+    skipped.extend(fldrs_skipped)
 
-        # Find out if you're dealing with many different dicoms or just a single folder
-        uniq_sid = df_dcminfo['sid'].unique()
-        uniq_pn = df_dcminfo['pn'].unique()
+    if journal is not None:
+        journal.close()
 
-        fldrs_to_rename = []
+    if manifest is not None:
+        for step in plan:
+            if step not in fldrs_failed:
+                manifest.add_folder(step[1], step[2])
+        manifest.close()
 
+    stats.close()
 
-        if len(uniq_sid) == 1 | len(uniq_pn) == 1:
-            # Rename all filenames
-            df_dcminfo['fn2'] = dirname + '\\' + df_dcminfo['fname']
-            tuple_rename = zip(df_dcminfo.fn, df_dcminfo.fn2)
-            p.map(renameDicom, tuple_rename)
+    print "NON-DICOM FILES SKIPPED: ", nrejected
 
-            # Rename the directory so it follows "DCMXXXX_PROTOCOLNAME"
-            new_fldr = 'DCM' + df_dcminfo['sn2'][0][-4:] + \
-                '_' + df_dcminfo['pn'][0]
-            fullfldrname = os.path.join(os.path.split(dirname)[0], new_fldr).upper()
+    for src, dst in skipped:
+        print "SKIPPED (NAME ALREADY TAKEN): ", src, "->", dst
 
-            fldrs_to_rename.append((dirname,fullfldrname))
+    for step in failed:
+        print "FAILED TO SORT: ", step
 
-        else:
-            # Need to create new folders for everything
-            df_dcminfo['fldr'] = 'DCM' + df_dcminfo['sn2'].apply(lambda x: x[-4:]) + \
-                '_' + df_dcminfo['pn']
-
-            fullfldrname = [os.path.join(dirname, fldr) for fldr in df_dcminfo['fldr'].unique().tolist()]
-            fldrs_to_make = []
-
-            for fldr in fullfldrname:
-                if not os.path.isdir(fldr):
-                    fldrs_to_make.append(fldr)
-
-            p.map(os.mkdir, fldrs_to_make)
-
-            # Create new filenames
-            df_dcminfo['fn2'] = dirname + '\\' + df_dcminfo['fldr'] + '\\' + df_dcminfo['fname']
-            tuple_move = zip(df_dcminfo.fn, df_dcminfo.fn2)
-
-            p.map(moveDicom,tuple_move)
-
-        # Sleep for a little bit so it has time to "complete moving" before renaming folders
-        time.sleep(0.25)
-
-        # Leave all folder renaming for the end because it interferes at time with file renaming.
-        for fldr_pair in fldrs_to_rename:
-            if not os.path.isdir(fldr_pair[1]):
-                for x in xrange(5):
-                    try:
-                        # Use the pool to parallelze encryption
-                        os.rename(fldr_pair[0],fldr_pair[1])
-                    except:
-                        # If it's the fourth try, print the failed directory.
-                        fldrs_failed_rename.append(fldr_pair)
-                        continue
-
-                    break
-
-                try:
-                    os.rename(fldr_pair[0],fldr_pair[1])
-                except:
-                    fldrs_failed_rename.append(fldr_pair)
-
-    # There is a second try in case the first try fails. Not the best way to do it, but deal with it.
-    for fldr_pair in fldrs_failed_rename:
-        for x in xrange(5):
-            try:
-                os.rename(fldr_pair[0],fldr_pair[1])
-            except:
-                
-                if x == 4:
-                    print "DIRECTORY FAILED TO ANONYMIZE: ", fldr_pair
-                # Continue onto next "iteration" if it fails; skip the break
-                continue
+    for step in planned:
+        print "PLANNED (IN ARCHIVE): ", step
 
-            break
+    for strategy in LINK_STRATEGIES + ['extract']:
+        if strategy in strategies:
+            print "FILES LINKED (%s): " % strategy.upper(), strategies[strategy]
 
     print("--- %s seconds ---" % (time.time() - start_time))
 
@@ -0,0 +1,216 @@
+###################################################################################################
+#
+#    Run statistics
+#
+# -Shared by dcmsort.py, create_mr_db.py and dcmanon.py to see where a run spends its time.
+#
+# -Time is recorded for each stage:
+#   walk      listing directories (in the walker)
+#   pool      sending files to the pool and waiting for results
+#   parse     time the workers spend on each file (summed over all workers), named after the tool's
+#             step ("parse", "anonymize")
+#   ...       any directory level step timed with stats.stage (rename, write, etc.)
+# -Files are counted as processed, skipped, failed or nondicom.
+# -Every directory gets a files/s number, which goes into a histogram.
+#
+# -With a stats file, one JSON line is written per directory and a summary line at the end.
+# -With progress on, a single status line is kept up to date on stderr.
+#
+###################################################################################################
+
+import sys
+import time
+import json
+from contextlib import contextmanager
+
+# Upper edges of the files/s histogram buckets (the last bucket is everything above)
+HISTOGRAM_EDGES = [1, 10, 100, 1000, 10000]
+
+# Seconds between updates of the progress line
+PROGRESS_INTERVAL = 0.5
+
+# Runs a function in the pool and also returns how long it took
+class TimedCall(object):
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        start_time = time.time()
+        result = self.func(item)
+        return result, time.time() - start_time
+
+def histogram_label(ind):
+
+    if ind == 0:
+        return '<%d' % HISTOGRAM_EDGES[0]
+    elif ind == len(HISTOGRAM_EDGES):
+        return '>=%d' % HISTOGRAM_EDGES[-1]
+    return '%d-%d' % (HISTOGRAM_EDGES[ind - 1], HISTOGRAM_EDGES[ind])
+
+class RunStats(object):
+
+    def __init__(self, tool, filename='', progress=False, worker_stage='parse'):
+
+        self.tool = tool
+        self.progress = progress
+        self.worker_stage = worker_stage
+        self.start_time = time.time()
+        self.last_progress = 0
+
+        self.stages = {}
+        self.counts = {'processed': 0, 'skipped': 0, 'failed': 0, 'nondicom': 0}
+        self.ndirs = 0
+        self.histogram = [0] * (len(HISTOGRAM_EDGES) + 1)
+
+        # When each directory was sent to the pool
+        self.dispatched = {}
+
+        # Anything else about the run that should go in the summary (backend, workers, etc.)
+        self.info = {}
+
+        self.f = open(filename, 'w') if filename else None
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add(self, counter, n=1):
+        self.counts[counter] += n
+
+    def merge(self, counts, ndirs=0):
+
+        # Adds the counts of another run (ie, a worker on another machine)
+        for counter, n in counts.items():
+            self.counts[counter] += n
+        self.ndirs += ndirs
+        self.show_progress()
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start_time)
+
+    def walk(self, walker):
+
+        # Wraps a walker that yields (dirname, items) and times it
+        walker = iter(walker)
+        while True:
+            start_time = time.time()
+            try:
+                dirname, items = next(walker)
+            except StopIteration:
+                self.add_time('walk', time.time() - start_time)
+                return
+            self.add_time('walk', time.time() - start_time)
+            self.dispatched[dirname] = time.time()
+            yield dirname, items
+
+    def stream(self, stream):
+
+        # Wraps stream_directories. Time spent in it, apart from walking, is the pool stage.
+        stream = iter(stream)
+        while True:
+            walk_time = self.stages.get('walk', 0.0)
+            start_time = time.time()
+            try:
+                out = next(stream)
+            except StopIteration:
+                return
+            finally:
+                seconds = time.time() - start_time - (self.stages.get('walk', 0.0) - walk_time)
+                self.add_time('pool', seconds)
+            yield out
+
+    def timed(self, func):
+        return TimedCall(func)
+
+    def directory(self, dirname, results, nfailed=0):
+
+        # results are the (result, seconds) from a timed function. Returns the results only,
+        # in the same order (None for files that failed in the pool).
+        out = []
+        counts = {'processed': 0, 'skipped': 0, 'failed': 0, 'nondicom': 0}
+        for result in results:
+            if result is None:
+                out.append(None)
+                counts['failed'] += 1
+                continue
+
+            result, seconds = result
+            self.add_time(self.worker_stage, seconds)
+            out.append(result)
+
+            if result:
+                counts['processed'] += 1
+            elif result is False:
+                counts['skipped'] += 1
+            else:
+                counts['nondicom'] += 1
+
+        for counter in counts:
+            self.counts[counter] += counts[counter]
+
+        seconds = time.time() - self.dispatched.pop(dirname, time.time())
+        rate = len(results) / seconds if seconds > 0 else 0
+        if results:
+            ind = 0
+            while ind < len(HISTOGRAM_EDGES) and rate >= HISTOGRAM_EDGES[ind]:
+                ind += 1
+            self.histogram[ind] += 1
+
+        self.ndirs += 1
+
+        if self.f is not None:
+            record = {'type': 'directory', 'dirname': dirname, 'nfiles': len(results),
+                      'seconds': seconds, 'files_per_s': rate}
+            record.update(counts)
+            self.f.write(json.dumps(record) + '\n')
+
+        self.show_progress()
+
+        return out
+
+    def nfiles(self):
+        return sum(self.counts.values())
+
+    def show_progress(self, force=False):
+
+        if not self.progress:
+            return
+
+        now = time.time()
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+
+        elapsed = now - self.start_time
+        rate = self.nfiles() / elapsed if elapsed > 0 else 0
+        sys.stderr.write("\r%s: %d dirs, %d files (%d skipped, %d failed, %d non-DICOM), %.1f files/s   " %
+                         (self.tool, self.ndirs, self.nfiles(), self.counts['skipped'],
+                          self.counts['failed'], self.counts['nondicom'], rate))
+        sys.stderr.flush()
+
+    def summary(self):
+
+        wall = time.time() - self.start_time
+        return {'type': 'summary', 'tool': self.tool, 'wall': wall, 'ndirs': self.ndirs,
+                'nfiles': self.nfiles(), 'files_per_s': self.nfiles() / wall if wall > 0 else 0,
+                'counts': dict(self.counts), 'stages': dict(self.stages), 'info': dict(self.info),
+                'histogram': dict((histogram_label(ind), n) for ind, n in enumerate(self.histogram))}
+
+    def close(self):
+
+        if self.progress:
+            self.show_progress(force=True)
+            sys.stderr.write('\n')
+
+        summary = self.summary()
+        if self.f is not None:
+            self.f.write(json.dumps(summary) + '\n')
+            self.f.close()
+            self.f = None
+
+        return summary
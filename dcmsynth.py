@@ -0,0 +1,185 @@
+###################################################################################################
+#
+#    Creating a synthetic DICOM tree
+#
+# -The purpose of this script is to make a DICOM tree that looks like the ones the tools run on,
+# so that they can be tested and benchmarked without real (patient) data.
+#
+# -The tree is PATIENTxxx/STUDYxx/SERIESxxx with a configurable number of patients, studies per
+# patient, series per study and slices per series. On top of that:
+#   mixed      fraction of studies where all series are dumped into a single folder
+#   presorted  fraction of series folders that are already sorted (DCMxxxx_PROTOCOL/IMAGE.SSSS.IIII)
+#   encrypted  fraction of patients whose names are already encrypted ("_JNO")
+#   junk       number of non-DICOM files (thumbnails, reports) in every unsorted folder
+#
+# -The same options and seed always give the same tree.
+#
+# -To test out, type in:
+# python dcmsynth.py -o "C:\Temp\synthetic" -p 2 -t 2 -s 4 -n 20
+#
+###################################################################################################
+
+import os
+import random
+import dicom
+from dicom.dataset import Dataset, FileDataset
+from optparse import OptionParser
+from dcmanon import encrypt_string
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+PROTOCOLS = ['T1_SE', 'T2_TSE', 'FLAIR', 'DWI', 'T1_MPRAGE', 'LGE_PSIR', 'CINE_SSFP']
+
+def make_uid(rand):
+    return '2.25.%d' % rand.getrandbits(96)
+
+def make_dicom(filename, info, instance, rows):
+
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = make_uid(info['rand'])
+    file_meta.TransferSyntaxUID = dicom.UID.ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = '2.25.1'
+
+    ds = FileDataset(filename, {}, file_meta=file_meta, preamble="\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyDate = info['date']
+    ds.AcquisitionTime = info['time']
+    ds.Modality = 'MR'
+    ds.Manufacturer = 'SYNTHETIC'
+    ds.SeriesDescription = info['protocol']
+    ds.PatientsName = info['name']
+    ds.PatientID = info['pxid']
+    ds.FlipAngle = '15'
+    ds.RepetitionTime = '2000'
+    ds.EchoTime = '30'
+    ds.InversionTime = '0'
+    ds.ProtocolName = info['protocol']
+    ds.StudyInstanceUID = info['studyuid']
+    ds.SeriesInstanceUID = info['seriesuid']
+    ds.SeriesNumber = str(info['series'])
+    ds.InstanceNumber = str(instance)
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = rows
+    ds.Columns = rows
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = info['rand'].choice('abcdefgh') * (rows * rows * 2)
+    ds[0x7fe00010].VR = 'OW'
+
+    ds.save_as(filename)
+
+def make_junk(dirname, njunk, rand):
+
+    for ind in xrange(njunk):
+        if ind % 2:
+            filename = os.path.join(dirname, 'report%d.pdf' % ind)
+            data = '%PDF-1.4\n' + 'x' * rand.randint(100, 5000)
+        else:
+            filename = os.path.join(dirname, 'thumb%d.jpg' % ind)
+            data = '\xff\xd8\xff\xe0' + 'x' * rand.randint(100, 5000)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+def generate_tree(root, npatients=2, nstudies=1, nseries=3, nslices=10, mixed=0.0, presorted=0.0,
+                  encrypted=0.0, njunk=0, rows=64, seed=0):
+
+    # Returns a summary of what was made: number of folders with files, dicoms, junk files and bytes
+    rand = random.Random(seed)
+    summary = {'nfolders': 0, 'ndicoms': 0, 'njunk': 0, 'nbytes': 0}
+
+    def add_folder(dirname, junk=True):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+            summary['nfolders'] += 1
+        if junk:
+            make_junk(dirname, njunk, rand)
+            summary['njunk'] += njunk
+
+    for patient in xrange(npatients):
+        name = 'PATIENT%03d^SYNTHETIC' % patient
+        if rand.random() < encrypted:
+            name = encrypt_string(name) + '_JNO'
+
+        for study in xrange(nstudies):
+            studydir = os.path.join(root, 'PATIENT%03d' % patient, 'STUDY%02d' % study)
+            is_mixed = rand.random() < mixed
+            if is_mixed:
+                add_folder(os.path.join(studydir, 'MIXED'))
+
+            info = {'rand': rand, 'name': name, 'pxid': 'SYN%05d' % patient,
+                    'studyuid': make_uid(rand), 'date': '2015%02d%02d' % (study % 12 + 1, patient % 28 + 1),
+                    'time': '%02d%02d00' % (8 + study % 10, patient % 60)}
+
+            for series in xrange(1, nseries + 1):
+                info['series'] = series
+                info['seriesuid'] = make_uid(rand)
+                info['protocol'] = PROTOCOLS[series % len(PROTOCOLS)]
+
+                if is_mixed:
+                    dirname = os.path.join(studydir, 'MIXED')
+                    names = ['%s_%04d' % (info['protocol'], ind) for ind in xrange(1, nslices + 1)]
+                elif rand.random() < presorted:
+                    dirname = os.path.join(studydir, 'DCM%04d_%s' % (series, info['protocol']))
+                    names = ['IMAGE.%04d.%04d' % (series, ind) for ind in xrange(1, nslices + 1)]
+                    # Junk files would make the folder look unsorted
+                    add_folder(dirname, junk=False)
+                else:
+                    dirname = os.path.join(studydir, 'SERIES%03d' % series)
+                    names = ['IM%06d' % rand.getrandbits(20) for ind in xrange(nslices)]
+                    add_folder(dirname)
+
+                for ind, filename in enumerate(names):
+                    filename = os.path.join(dirname, filename)
+                    # Random names can repeat, keep going until there is a free one
+                    while os.path.exists(filename):
+                        filename += '_'
+                    make_dicom(filename, info, ind + 1, rows)
+                    summary['ndicoms'] += 1
+
+    for dirname, dirnames, filenames in os.walk(root):
+        summary['nbytes'] += sum(os.path.getsize(os.path.join(dirname, filename)) for filename in filenames)
+
+    return summary
+
+def main():
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-o", "--output", dest="output", default='synthetic',
+                      help="Folder to create the tree in")
+    parser.add_option("-p", "--patients", type="int", dest="npatients", default=2,
+                      help="Number of patients")
+    parser.add_option("-t", "--studies", type="int", dest="nstudies", default=1,
+                      help="Number of studies per patient")
+    parser.add_option("-s", "--series", type="int", dest="nseries", default=3,
+                      help="Number of series per study")
+    parser.add_option("-n", "--slices", type="int", dest="nslices", default=10,
+                      help="Number of slices per series")
+    parser.add_option("-m", "--mixed", type="float", dest="mixed", default=0.0,
+                      help="Fraction of studies with all series in one folder")
+    parser.add_option("-r", "--sorted", type="float", dest="presorted", default=0.0,
+                      help="Fraction of series folders that are already sorted")
+    parser.add_option("-e", "--encrypted", type="float", dest="encrypted", default=0.0,
+                      help="Fraction of patients with encrypted names")
+    parser.add_option("-j", "--junk", type="int", dest="njunk", default=0,
+                      help="Number of non-DICOM files in every unsorted folder")
+    parser.add_option("-x", "--rows", type="int", dest="rows", default=64,
+                      help="Image size (rows = columns)")
+    parser.add_option("--seed", type="int", dest="seed", default=0,
+                      help="Random seed")
+
+    (options, args) = parser.parse_args()
+
+    summary = generate_tree(options.output, options.npatients, options.nstudies, options.nseries,
+                            options.nslices, options.mixed, options.presorted, options.encrypted,
+                            options.njunk, options.rows, options.seed)
+    print summary
+
+if __name__ == '__main__':
+    main()
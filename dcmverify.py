@@ -0,0 +1,219 @@
+###################################################################################################
+#
+#    Verifying a tree against a manifest
+#
+# -The purpose of this script is to make sure nothing was lost or damaged by dcmsort.py or
+# dcmanon.py, without having to trust either of them. Both can write a manifest (--manifest) with
+# where every file went, its size and a checksum of its pixel data (see dcmmanifest.py).
+#
+# -Every file in the manifest is checked where it is now: it has to exist, have the same size and
+# have the same pixel data checksum. The size is checked first, so a missing or truncated file
+# costs a single stat. Files are checked in parallel by the same pool as the other tools.
+# -A manifest of a tree as it is can also be made (-d), ie before sorting it. Given as the source
+# (-s), every file in it has to show up in the manifest of the tool with the same checksum, or still
+# be where it was, unchanged (ie, a folder that dcmsort.py found already sorted and skipped).
+#
+# -To test out, type in:
+# python dcmverify.py -d "Z:\Images\Incoming" -m before.jsonl
+# python dcmsort.py -d "Z:\Images\Incoming" --manifest sorted.jsonl
+# python dcmverify.py -m sorted.jsonl -s before.jsonl
+# -d = directory to make a manifest of
+# -m = manifest to write (with -d) or check
+# -s = manifest from before the tool was run
+#
+###################################################################################################
+
+import os
+import time
+from functools import partial
+from optparse import OptionParser
+from dcmpipeline import walk_directories, stream_directories, DicomSniffer, make_pool, BACKENDS
+from dcmstats import RunStats
+from dcmmanifest import ManifestWriter, read_manifest, file_checksum
+
+# For a single file in the manifest. item is [path, size, checksum].
+# Returns "ok", "missing", "size" or "changed".
+def check_file(item, force=False):
+
+    filename, size, checksum = item
+    try:
+        if os.path.getsize(filename) != size:
+            return 'size'
+    except OSError:
+        return 'missing'
+
+    result = file_checksum(filename, force)
+    if result is None or result[1] != checksum:
+        return 'changed'
+
+    return 'ok'
+
+def manifest_walker(records):
+
+    # Yields (dirname, items) for the files of a manifest, grouped by the folder they are in now
+    dirs = {}
+    for record in records:
+        dirs.setdefault(os.path.dirname(record['dst']), []).append([record['dst'], record['size'], record['checksum']])
+
+    for dirname in sorted(dirs):
+        yield dirname, dirs[dirname]
+
+def main():
+    start_time = time.time()
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-m", "--manifest",
+                      action="store",
+                      type="string",
+                      dest="manifest",
+                      default='',
+                      help="Manifest to check (or to write, with -d)")
+    parser.add_option("-d", "--dir",
+                      action="store",
+                      type="string",
+                      dest="directory",
+                      default='',
+                      help="Make a manifest of this directory instead of checking one")
+    parser.add_option("-s", "--source",
+                      action="store",
+                      type="string",
+                      dest="source",
+                      default='',
+                      help="Manifest from before the tool was run. Every file in it has to be in the manifest")
+    parser.add_option("--stats",
+                      action="store",
+                      type="string",
+                      dest="stats",
+                      default='',
+                      help="File to write run statistics to (one JSON line per folder and a summary)")
+    parser.add_option("--progress",
+                      action="store_true",
+                      dest="progress",
+                      default=False,
+                      help="Show a progress line while running")
+    parser.add_option("--lenient",
+                      action="store_true",
+                      dest="lenient",
+                      default=False,
+                      help="Also read files without the 128 byte preamble if they look like a dicom")
+    parser.add_option("-b", "--backend",
+                      action="store",
+                      type="choice",
+                      choices=BACKENDS,
+                      dest="backend",
+                      default='process',
+                      help="Workers to use: process, thread (for network shares) or hybrid")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=0,
+                      help="Number of workers. Default is to choose from the cores and the speed of the tree")
+
+    (options, args) = parser.parse_args()
+
+    if not options.manifest:
+        parser.error("A manifest (-m) is needed")
+
+    stats = RunStats('dcmverify', options.stats, options.progress, worker_stage='checksum')
+
+    # The file of every result is needed, so the filenames of each folder are kept until it comes back
+    filenames = {}
+    def named(walker):
+        for dirname, items in walker:
+            filenames[dirname] = [item if isinstance(item, basestring) else item[0] for item in items]
+            yield dirname, items
+
+    if options.directory:
+        if os.path.exists(options.manifest):
+            parser.error("Manifest %s already exists" % options.manifest)
+
+        p, workers = make_pool(options.backend, [options.directory], options.workers)
+        print "WORKERS: ", options.backend, "(%s)" % workers
+        stats.info.update(backend=options.backend, workers=workers)
+
+        sniffer = DicomSniffer(options.lenient, stats)
+        manifest = ManifestWriter(options.manifest)
+
+        walker = stats.walk(named(walk_directories([options.directory], keep=sniffer)))
+        stream = stream_directories(p, stats.timed(partial(file_checksum, force=options.lenient)), walker)
+
+        nfiles = 0
+        for dirname, results, nfailed in stats.stream(stream):
+            results = stats.directory(dirname, results, nfailed)
+            for filename, result in zip(filenames.pop(dirname), results):
+                if result is not None:
+                    manifest.add_file(filename, filename, result[0], result[1])
+                    nfiles += 1
+
+        manifest.close()
+        stats.close()
+
+        print "NON-DICOM FILES SKIPPED: ", sniffer.nrejected
+        print "FILES IN MANIFEST: ", nfiles
+        print("--- %s seconds ---" % (time.time() - start_time))
+        return
+
+    records = read_manifest(options.manifest)
+
+    problems = []
+
+    # Every file from before has to have gone somewhere, without its pixel data changing. A file
+    # that isn't in the manifest is checked where it was, since the tool may have left it alone.
+    # It is only a problem if it has gone or changed there (or something else was put in its place).
+    unmoved = set()
+    if options.source:
+        by_src = dict((record['src'], record) for record in records)
+        dsts = set(record['dst'] for record in records)
+        for record in read_manifest(options.source):
+            after = by_src.get(record['dst'])
+            if after is None:
+                if record['dst'] in dsts:
+                    problems.append(('NOT IN MANIFEST', record['dst']))
+                else:
+                    unmoved.add(record['dst'])
+                    records.append(record)
+            elif after['checksum'] != record['checksum']:
+                problems.append(('CHANGED BY TOOL', record['dst']))
+
+    bases = sorted(set(os.path.dirname(record['dst']) for record in records))[:1]
+    p, workers = make_pool(options.backend, bases, options.workers)
+    print "WORKERS: ", options.backend, "(%s)" % workers
+    stats.info.update(backend=options.backend, workers=workers)
+
+    # The manifest is the list of files, the tree isn't walked
+    nok = 0
+    nunmoved = 0
+    walker = stats.walk(named(manifest_walker(records)))
+    stream = stream_directories(p, stats.timed(partial(check_file, force=options.lenient)), walker)
+    for dirname, results, nfailed in stats.stream(stream):
+        results = stats.directory(dirname, results, nfailed)
+        for filename, result in zip(filenames.pop(dirname), results):
+            if filename in unmoved:
+                if result == 'ok':
+                    nunmoved += 1
+                else:
+                    problems.append(('NOT IN MANIFEST', filename))
+            elif result == 'ok':
+                nok += 1
+            elif result == 'missing':
+                problems.append(('MISSING', filename))
+            elif result == 'size':
+                problems.append(('SIZE CHANGED', filename))
+            else:
+                problems.append(('CHANGED', filename))
+
+    stats.close()
+
+    for problem, filename in problems:
+        print "%s: " % problem, filename
+
+    print "FILES OK: ", nok
+    if options.source:
+        print "FILES LEFT WHERE THEY WERE: ", nunmoved
+    print "FILES WITH PROBLEMS: ", len(problems)
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
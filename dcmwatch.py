@@ -0,0 +1,412 @@
+###################################################################################################
+#
+#    Watching an inbox for new studies
+#
+# -The purpose of this script is to ingest studies as they arrive instead of after the transfer is
+# done. It runs until it is stopped (Ctrl-C), with the same worker pool the whole time, so nothing
+# is paid again for every new study (process startup, walking the whole tree, etc.).
+#
+# -Every folder of the inbox is watched (with inotify on Linux, otherwise by listing the inbox
+# every few seconds). A folder is ingested once it has stopped changing for a while, which is when
+# the series in it has finished arriving. Only the new files are read:
+#   catalog     a database row (same fields as create_mr_db.py), taken before anonymizing
+#   anonymize   the new values are patched into the file (same as dcmanon.py)
+#   sort        the file is moved into the sorted tree in the target (same as dcmsort.py -t)
+# -Files that can't be ingested (not dicoms, unreadable, name already taken in the target) are left
+# in the inbox and are only looked at again if they change.
+#
+# -To test out, type in:
+# python dcmwatch.py -i "Z:\Images\Inbox" -t "Z:\Images\Sorted" -f "MRDB_Inbox.csv" -o "Z:\Images\Databases"
+# -i = inbox to watch
+# -t = folder for the sorted tree
+# -f = filename of the database (.csv, .parquet or .db)
+# -o = location of the database
+#
+###################################################################################################
+
+import os
+import time
+import errno
+import struct
+import select
+from functools import partial
+from optparse import OptionParser
+from dcmpipeline import walk_directories, stream_directories, DicomSniffer, make_pool, BACKENDS
+from dcmstats import RunStats
+from dcmoutput import DatabaseWriter
+from create_mr_db import remove_same_series
+from dcmsort import planDirectory, executePlan, LINK_STRATEGIES
+from dcmingest import ingest_file
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(_libc, 'inotify_init'):
+        _libc = None
+except (ImportError, OSError):
+    # Windows, or no libc
+    _libc = None
+
+# Seconds a folder has to go without changing before it is ingested
+SETTLE_SECONDS = 30
+
+# Seconds between looks at the inbox
+POLL_SECONDS = 2
+
+# inotify events (from <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+class InotifyWatcher(object):
+
+    # Finds the folders that changed from the events of the kernel. New folders are watched as
+    # soon as they show up.
+    def __init__(self, inbox):
+        self.fd = _libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.dirs = {}
+        self.changed = set()
+        self.watch_tree(inbox)
+
+    def watch_tree(self, top):
+        # Anything already in a new folder is counted as a change, since it arrived before the watch
+        for dirname, dirnames, filenames in os.walk(top):
+            wd = _libc.inotify_add_watch(self.fd, dirname, WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = dirname
+            self.changed.add(dirname)
+
+    def changes(self, timeout):
+
+        # Returns the folders that changed since the last call. Waits up to timeout for a change.
+        if not self.changed:
+            select.select([self.fd], [], [], timeout)
+
+        while select.select([self.fd], [], [], 0)[0]:
+            data = os.read(self.fd, 64 * 1024)
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+                name = data[pos + 16:pos + 16 + length].rstrip('\0')
+                pos += 16 + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so anything could have changed
+                    self.changed.update(self.dirs.values())
+                elif mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                elif wd in self.dirs:
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        self.watch_tree(os.path.join(self.dirs[wd], name))
+                    else:
+                        self.changed.add(self.dirs[wd])
+
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+class PollWatcher(object):
+
+    # Finds the folders that changed by listing the whole inbox (and the size and modification
+    # time of every file) each time
+    def __init__(self, inbox):
+        self.inbox = inbox
+        self.signatures = {}
+
+    def changes(self, timeout):
+
+        if self.signatures:
+            time.sleep(timeout)
+
+        signatures = {}
+        for dirname, dirnames, filenames in os.walk(self.inbox):
+            signature = []
+            for filename in filenames:
+                try:
+                    st = os.stat(os.path.join(dirname, filename))
+                except OSError:
+                    continue
+                signature.append((filename, st.st_size, st.st_mtime))
+            signatures[dirname] = sorted(signature)
+
+        changed = set(dirname for dirname in signatures if signatures[dirname] != self.signatures.get(dirname))
+        self.signatures = signatures
+        return changed
+
+def make_watcher(inbox, polling=False):
+
+    if not polling and _libc is not None:
+        try:
+            return InotifyWatcher(inbox), 'inotify'
+        except OSError:
+            pass
+    return PollWatcher(inbox), 'polling'
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime)
+
+def main():
+    start_time = time.time()
+
+    fields = ['pxname','pxid','datestr','acqtstr','studyuid','seriesuid','mrseq','manu','fa','tr','te','ti','nimgs','dir']
+    export = ['pxname','pxid','date','acqt','studyuid','seriesuid','mrseq','manu','fa','tr','te','ti','nimgs','dir']
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-i", "--inbox",
+                      action="store",
+                      type="string",
+                      dest="inbox",
+                      default='',
+                      help="Folder to watch for new files")
+    parser.add_option("-t", "--target",
+                      action="store",
+                      type="string",
+                      dest="target",
+                      default='',
+                      help="Folder to build the sorted tree in. Files are moved there from the inbox")
+    parser.add_option("-f", "--filename",
+                      action="store",
+                      type="string",
+                      dest="filename",
+                      default='MR_Database.csv',
+                      help="Name of output file (.csv, .parquet or .db)")
+    parser.add_option("-o", "--output",
+                      dest="output",
+                      default=os.getcwd(),
+                      help="Folder to write the output file to")
+    parser.add_option("-u", "--decrypt",
+                      action="store_false",
+                      dest="encrypt",
+                      default=True,
+                      help="Decrypt the dicom fields instead of encrypting them")
+    parser.add_option("-n", "--numbers",
+                      action="store_true",
+                      dest="numbers",
+                      default=False,
+                      help="Check for numbers (0-9) in the field. If numbers exist in field, do not encrypt")
+    parser.add_option("--no-anon",
+                      action="store_false",
+                      dest="anon",
+                      default=True,
+                      help="Don't anonymize the files")
+    parser.add_option("--settle",
+                      action="store",
+                      type="float",
+                      dest="settle",
+                      default=SETTLE_SECONDS,
+                      help="Seconds a folder has to stay the same before it is ingested")
+    parser.add_option("--poll",
+                      action="store",
+                      type="float",
+                      dest="poll",
+                      default=POLL_SECONDS,
+                      help="Seconds between looks at the inbox")
+    parser.add_option("--polling",
+                      action="store_true",
+                      dest="polling",
+                      default=False,
+                      help="List the inbox every time instead of using inotify (ie, for network shares)")
+    parser.add_option("--once",
+                      action="store_true",
+                      dest="once",
+                      default=False,
+                      help="Stop once everything in the inbox has been ingested")
+    parser.add_option("--link",
+                      action="store",
+                      type="choice",
+                      choices=['auto'] + LINK_STRATEGIES,
+                      dest="link",
+                      default='auto',
+                      help="How files are put in the target before they are removed from the inbox: auto, hardlink, reflink or copy")
+    parser.add_option("--stats",
+                      action="store",
+                      type="string",
+                      dest="stats",
+                      default='',
+                      help="File to write run statistics to (one JSON line per folder and a summary)")
+    parser.add_option("--progress",
+                      action="store_true",
+                      dest="progress",
+                      default=False,
+                      help="Show a progress line while running")
+    parser.add_option("--lenient",
+                      action="store_true",
+                      dest="lenient",
+                      default=False,
+                      help="Also read files without the 128 byte preamble if they look like a dicom")
+    parser.add_option("-b", "--backend",
+                      action="store",
+                      type="choice",
+                      choices=BACKENDS,
+                      dest="backend",
+                      default='process',
+                      help="Workers to use: process, thread (for network shares) or hybrid")
+    parser.add_option("-w", "--workers",
+                      action="store",
+                      type="int",
+                      dest="workers",
+                      default=0,
+                      help="Number of workers. Default is to choose from the cores and the speed of the inbox")
+
+    (options, args) = parser.parse_args()
+
+    inbox = options.inbox
+    if not inbox or not options.target:
+        parser.error("Both an inbox (-i) and a target (-t) are needed")
+
+    realinbox = os.path.realpath(inbox)
+    realtarget = os.path.realpath(options.target)
+    if realtarget == realinbox or realtarget.startswith(os.path.join(realinbox, '')):
+        parser.error("--target can't be inside the inbox")
+
+    writer = DatabaseWriter(os.path.join(options.output, options.filename), fields, export)
+
+    # The pool is started once and kept for every folder that comes in
+    p, workers = make_pool(options.backend, [inbox], options.workers)
+    print "WORKERS: ", options.backend, "(%s)" % workers
+
+    watcher, method = make_watcher(inbox, options.polling)
+    print "WATCHING: ", inbox, "(%s)" % method
+
+    stats = RunStats('dcmwatch', options.stats, options.progress, worker_stage='ingest')
+    stats.info.update(backend=options.backend, workers=workers, watcher=method)
+
+    sniffer = DicomSniffer(options.lenient, stats)
+    ingest = stats.timed(partial(ingest_file, force=options.lenient))
+    opt_tuple = (options.anon, options.encrypt, options.numbers)
+
+    # Files that were left in the inbox, with their size and modification time when they were
+    left_behind = {}
+
+    def is_new(filename):
+        try:
+            signature = file_signature(filename)
+        except OSError:
+            return False
+        if left_behind.get(filename) == signature:
+            return False
+        if not sniffer(filename):
+            left_behind[filename] = signature
+            return False
+        return True
+
+    def leave(filename):
+        try:
+            left_behind[filename] = file_signature(filename)
+        except OSError:
+            pass
+
+    strategies = {}
+
+    def ingest_folders(dirnames):
+
+        # Only the files in each folder are read (its subfolders are watched on their own)
+        walker = stats.walk(walk_directories(sorted(dirnames), keep=is_new, recursive=False))
+
+        filenames = {}
+        def items(walker):
+            for dirname, fullfilenames in walker:
+                filenames[dirname] = fullfilenames
+                yield dirname, [[filename, opt_tuple] for filename in fullfilenames]
+
+        for dirname, results, nfailed in stats.stream(stream_directories(p, ingest, items(walker))):
+
+            results = stats.directory(dirname, results, nfailed)
+            fullfilenames = filenames.pop(dirname)
+
+            for filename, result in zip(fullfilenames, results):
+                if not result:
+                    leave(filename)
+            results = [result for result in results if result]
+            if not results:
+                continue
+
+            print "Ingesting ", dirname
+
+            # Files are linked into the target, then removed from the inbox
+            outdir = os.path.normpath(os.path.join(options.target, os.path.relpath(dirname, inbox)))
+            with stats.stage('plan'):
+                plan, fldrs, skipped = planDirectory(dirname, [sortinfo for row, sortinfo, changed in results], outdir)
+            with stats.stage('rename'):
+                failed = set(executePlan(plan, link=options.link, strategies=strategies))
+
+            moved = {}
+            for step in plan:
+                if step[0] == 'link' and step not in failed:
+                    try:
+                        os.remove(step[1])
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            print "FAILED TO REMOVE FROM INBOX: ", step[1]
+                            continue
+                    moved[step[1]] = step[2]
+
+            for src, dst in skipped:
+                print "SKIPPED (NAME ALREADY TAKEN): ", src, "->", dst
+            for step in failed:
+                print "FAILED TO SORT: ", step
+
+            # Rows are for the folder the files ended up in
+            rows = []
+            for row, sortinfo, changed in results:
+                filename = sortinfo[0]
+                if filename in moved:
+                    row['dir'] = os.path.dirname(moved[filename])
+                else:
+                    row['dir'] = dirname
+                    leave(filename)
+                rows.append(row)
+
+            with stats.stage('write'):
+                writer.append(remove_same_series(rows))
+
+        # Written out now, so the rows show up without waiting for a full batch
+        with stats.stage('write'):
+            writer.flush()
+
+    # Folder -> time it last changed
+    last_change = {}
+
+    try:
+        while True:
+            for dirname in watcher.changes(options.poll):
+                last_change[dirname] = time.time()
+
+            now = time.time()
+            settled = [dirname for dirname in last_change if now - last_change[dirname] >= options.settle]
+            for dirname in settled:
+                del last_change[dirname]
+
+            if settled:
+                ingest_folders(settled)
+            elif options.once and not last_change:
+                break
+    except KeyboardInterrupt:
+        print "STOPPING"
+
+    with stats.stage('write'):
+        writer.close()
+
+    stats.close()
+
+    print "NON-DICOM FILES SKIPPED: ", sniffer.nrejected
+
+    for strategy in LINK_STRATEGIES:
+        if strategy in strategies:
+            print "FILES MOVED (%s): " % strategy.upper(), strategies[strategy]
+
+    print("--- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()